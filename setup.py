@@ -5,7 +5,7 @@ setup(
     version='0.1.0',
     py_modules=['main'],
     install_requires=[
-        'pandas==1.3.5',
+        'pandas==1.5.3',
         'requests==2.27.1',
         'SQLAlchemy==1.4.36',
         'GeoAlchemy2==0.11.1',
@@ -14,6 +14,9 @@ setup(
         'geopandas==0.10.2',
         'click==8.1.3'
     ],
+    extras_require={
+        'parquet': ['pyarrow>=8.0'],
+    },
     entry_points={
         'console_scripts': [
             'gtfs_import=main:cli',
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Sequence, Unicode
-from sqlalchemy.types import Date, String, Integer, DateTime, SmallInteger, Float, Text, ARRAY
+import hashlib
+
+from sqlalchemy import Column, Index, Sequence, Unicode, text
+from sqlalchemy.types import Date, String, Integer, BigInteger, Boolean, DateTime, SmallInteger, Float, Text, ARRAY
 
 from sqlalchemy.ext.declarative import declarative_base
 from geoalchemy2 import Geometry, Geography
@@ -8,10 +10,55 @@ metadata = Base.metadata
 metadata.schema = 'gtfs'
 
 
+def deferred_indexes(gtfs_cls) -> list:
+    """
+    Return columns of the gtfs_cls indexes built after the data is loaded:
+    the model deferred_indexes and (feed_id, natural_key), used by per feed queries and the incremental re-import
+    """
+    indexes = list(getattr(gtfs_cls, 'deferred_indexes', ()))
+    feed_key = ('feed_id',) + tuple(getattr(gtfs_cls, 'natural_key', ()))
+    if feed_key not in indexes:
+        indexes.append(feed_key)
+    return indexes
+
+
+def spatial_indexes(gtfs_cls) -> list:
+    """Return (name, using, column) of the gtfs_cls spatial indexes (model spatial_indexes), built after the load"""
+    return [(f'idx_{gtfs_cls.__tablename__}_{column}', using, column)
+            for column, using in getattr(gtfs_cls, 'spatial_indexes', ())]
+
+
+def import_classes() -> list:
+    """Return the GTFS models loaded by a feed import: the feed files models and the tables derived from them"""
+    return [c for c in Base.__subclasses__() if c.filename is not None] + [TripPattern]
+
+
+def schema_version() -> str:
+    """Return version of the models schema: hash of the tables, their columns (name and type) and indexes"""
+    items = list()
+    for table in metadata.sorted_tables:
+        items.append(table.fullname)
+        items.extend(f'{c.name} {c.type}' for c in table.columns)
+        items.extend(sorted(i.name for i in table.indexes))
+    return hashlib.blake2b('\n'.join(items).encode(), digest_size=16).hexdigest()
+
+
 class FeedImport(Base):
     filename = None
+    # done values
+    PENDING = 0
+    DONE = 1
+    ERROR = 2
+    RUNNING = 3
+    UNCHANGED = 4
+    # duplicate of a source url, kept with its data but no longer synced or imported
+    SUPERSEDED = 5
+
     __tablename__ = 'gtfs_feed_import'
-    __table_args__ = {u'schema': 'gtfs'}
+    __table_args__ = (Index('ix_gtfs_feed_import_feed_url', 'feed_url', unique=True,
+                            postgresql_where=text(f'done <> {SUPERSEDED}'),
+                            sqlite_where=text(f'done <> {SUPERSEDED}')),
+                      {u'schema': 'gtfs'})
 
     feed_id = Column(Integer, Sequence(None, optional=True), primary_key=True, nullable=True)
     feed_source = Column(String(255))
@@ -21,14 +68,24 @@ class FeedImport(Base):
     feed_size_kb = Column(Float)
     feed_checksum = Column(String(255))
     download_dt = Column(DateTime)
-    done = Column(SmallInteger, default=0)
+    etag = Column(String(255))
+    last_modified = Column(String(255))
+    done = Column(SmallInteger, default=PENDING)
     error = Column(Text)
+    # extent of the feed stops, computed by the post-load spatial stage (GTFSSpatial)
+    bbox = Column(Geometry(srid=4326, spatial_index=False))
+    centroid = Column(Geometry(geometry_type='POINT', srid=4326, spatial_index=False))
+    # time the feed was claimed by a worker, renewed on each file loaded, a RUNNING feed not renewed is stale
+    claim_dt = Column(DateTime)
+    # times the feed was claimed again since its last claim from the queue (resumed after a stale claim)
+    resumes = Column(Integer, default=0)
 
 
 class Agency(Base):
     filename = 'agency.txt'
     __tablename__ = 'gtfs_agency'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('agency_id',)
 
     id = Column(Integer, Sequence(None, optional=True), primary_key=True, nullable=True)
     feed_id = Column(Integer)
@@ -40,19 +97,16 @@ class Agency(Base):
     agency_phone = Column(String(50))
     agency_fare_url = Column(String(255))
 
-    @classmethod
-    def dict2Obj(cls, dict):
-        obj = cls()
-        for k, v in dict.items():
-            if v:
-                setattr(obj, k, v.encode("utf-8").decode('utf-8', 'ignore'))
-        return obj
-
 
 class Stop(Base):
     filename = 'stops.txt'
     __tablename__ = 'gtfs_stops'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('stop_id',)
+    # built after the data is loaded
+    spatial_indexes = (('stop_loc', 'gist'),)
+    # file columns required by the validation (FeedValidator) on top of the NOT NULL columns
+    required_columns = ('stop_id',)
 
     id = Column(Integer, primary_key=True)
     feed_id = Column(Integer)
@@ -62,7 +116,7 @@ class Stop(Base):
     stop_desc = Column(String(255))
     # stop_lat = Column(Numeric(12, 9), nullable=False)
     # stop_lon = Column(Numeric(12, 9), nullable=False)
-    stop_loc = Column(Geography(geometry_type='POINT'))
+    stop_loc = Column(Geography(geometry_type='POINT', spatial_index=False))
     zone_id = Column(String(50))
     stop_url = Column(String(255))
     location_type = Column(Integer, index=True, default=0)
@@ -75,22 +129,16 @@ class Stop(Base):
 
     stop_lat = None
     stop_lon = None
-
-    @classmethod
-    def dict2Obj(cls, dict):
-        obj = cls()
-        for k, v in dict.items():
-            if v:
-                setattr(obj, k, v)
-        stop_loc = 'POINT({0} {1})'.format(dict['stop_lon'], dict['stop_lat'])
-        setattr(obj, 'stop_loc', stop_loc)
-        return obj
+    # point columns built from (lon, lat) file columns
+    point_columns = {'stop_loc': ('stop_lon', 'stop_lat')}
 
 
 class Route(Base):
     filename = 'routes.txt'
     __tablename__ = 'gtfs_routes'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('route_id',)
+    required_columns = ('route_id',)
 
     id = Column(Integer, primary_key=True)
     feed_id = Column(Integer)
@@ -106,19 +154,43 @@ class Route(Base):
     route_sort_order = Column(Integer, index=True)
     min_headway_minutes = Column(Integer)  # Trillium extension.
 
-    @classmethod
-    def dict2Obj(cls, dict):
-        obj = cls()
-        for k, v in dict.items():
-            if v:
-                setattr(obj, k, v.encode("utf-8").decode('utf-8', 'ignore'))
-        return obj
+
+class StopTime(Base):
+    filename = 'stop_times.txt'
+    __tablename__ = 'gtfs_stop_times'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('trip_id', 'stop_sequence')
+    # GTFS times stored as seconds since midnight
+    time_columns = ('arrival_time', 'departure_time')
+    # (column, referenced key column, referenced files) checked by the validation (FeedValidator)
+    references = (('trip_id', 'trip_id', ('trips.txt',)), ('stop_id', 'stop_id', ('stops.txt',)))
+    # built after the data is loaded (GTFSImport), not maintained row by row while loading
+    deferred_indexes = (('feed_id', 'trip_id', 'stop_sequence'), ('feed_id', 'stop_id'))
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    trip_id = Column(String(255), nullable=False)
+    arrival_time = Column(Integer)
+    departure_time = Column(Integer)
+    stop_id = Column(String(255), nullable=False)
+    stop_sequence = Column(Integer, nullable=False)
+    stop_headsign = Column(String(255))
+    pickup_type = Column(SmallInteger)
+    drop_off_type = Column(SmallInteger)
+    shape_dist_traveled = Column(Float)
+    timepoint = Column(SmallInteger)
 
 
 class Trip(Base):
     filename = 'trips.txt'
     __tablename__ = 'gtfs_trips'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('trip_id',)
+    deferred_indexes = (('feed_id', 'pattern_id'),)
+    required_columns = ('trip_id', 'route_id')
+    references = (('route_id', 'route_id', ('routes.txt',)),
+                  ('service_id', 'service_id', ('calendar.txt', 'calendar_dates.txt')),
+                  ('shape_id', 'shape_id', ('shapes.txt',)))
 
     id = Column(Integer, primary_key=True)
     feed_id = Column(Integer)
@@ -133,32 +205,117 @@ class Trip(Base):
     trip_short_name = Column(String(255))
     bikes_allowed = Column(Integer, default=0)
     wheelchair_accessible = Column(Integer, default=0)
-    stops = Column(ARRAY(String))
+    # stop pattern of the trip, gtfs_trip_patterns (feed_id, pattern_id)
+    pattern_id = Column(BigInteger)
 
-    @classmethod
-    def dict2Obj(cls, dict):
-        obj = cls()
-        for k, v in dict.items():
-            if v:
-                setattr(obj, k, v)
-        return obj
+
+class TripPattern(Base):
+    # distinct stop sequences of the feed trips, built from stop_times
+    filename = None
+    __tablename__ = 'gtfs_trip_patterns'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('pattern_id',)
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    pattern_id = Column(BigInteger)
+    stops = Column(ARRAY(String))
 
 
 class Shape(Base):
     filename = 'shapes.txt'
     __tablename__ = 'gtfs_shapes'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('shape_id',)
+    # built after the data is loaded, shapes are read by shape_id, BRIN is enough for the spatial scans of a feed
+    spatial_indexes = (('shape', 'brin'),)
+    required_columns = ('shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence')
+    # (lon, lat) file columns, the shape is built from the points
+    coordinate_columns = (('shape_pt_lon', 'shape_pt_lat'),)
 
     id = Column(Integer, primary_key=True)
     feed_id = Column(Integer)
     shape_id = Column(String(255), index=True)
-    shape = Column(Geometry(geometry_type='LINESTRING'))
+    shape = Column(Geometry(geometry_type='LINESTRING', spatial_index=False))
+
+
+class RouteGeometry(Base):
+    # shapes of the route trips by route and direction, built by the post-load spatial stage (GTFSSpatial)
+    filename = None
+    __tablename__ = 'gtfs_route_geometries'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('route_id', 'direction_id')
+    spatial_indexes = (('geom', 'gist'),)
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer, index=True)
+    route_id = Column(String(255))
+    direction_id = Column(String(255))
+    shapes = Column(Integer)
+    trips = Column(Integer)
+    geom = Column(Geometry(geometry_type='MULTILINESTRING', srid=4326, spatial_index=False))
+
+
+class FeedFile(Base):
+    """
+    Files of an imported feed, checksum from the zip directory (crc32 and size).
+    Written with the file rows, the records are the checkpoints of an import: feed_checksum is the checksum of the
+    feed zip the file was loaded from.
+    """
+    filename = None
+    __tablename__ = 'gtfs_feed_files'
+    __table_args__ = {u'schema': 'gtfs'}
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer, index=True)
+    file_name = Column(String(255))
+    checksum = Column(String(64))
+    rows = Column(Integer)
+    feed_checksum = Column(String(255))
+    import_dt = Column(DateTime)
+
+
+class ImportStat(Base):
+    """Import timing and throughput of a feed (file_name is null) and of each of its files"""
+    filename = None
+    __tablename__ = 'gtfs_import_stats'
+    __table_args__ = {u'schema': 'gtfs'}
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer, index=True)
+    file_name = Column(String(255))
+    status = Column(SmallInteger)
+    download_s = Column(Float)
+    unzip_s = Column(Float)
+    validate_s = Column(Float)
+    parse_s = Column(Float)
+    load_s = Column(Float)
+    total_s = Column(Float)
+    rows = Column(BigInteger)
+    bytes = Column(BigInteger)
+    rows_per_s = Column(Float)
+    peak_rss_kb = Column(BigInteger)
+    db_round_trips = Column(Integer)
+    import_dt = Column(DateTime)
+
+
+class SchemaVersion(Base):
+    """Version of the schema (schema_version) created or migrated last, a matching version skips the bootstrap"""
+    filename = None
+    __tablename__ = 'gtfs_schema_version'
+    __table_args__ = {u'schema': 'gtfs'}
+
+    id = Column(Integer, primary_key=True)
+    version = Column(String(64))
+    partitioned = Column(Boolean)
+    schema_dt = Column(DateTime)
 
 
 class FeedInfo(Base):
     filename = 'feed_info.txt'
     __tablename__ = 'gtfs_feed_info'
     __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ()
 
     id = Column(Integer, primary_key=True)
     feed_id = Column(Integer)
@@ -170,10 +327,74 @@ class FeedInfo(Base):
     feed_version = Column(String(255))
     feed_license = Column(String(255))
 
-    @classmethod
-    def dict2Obj(cls, dict):
-        obj = cls()
-        for k, v in dict.items():
-            if v:
-                setattr(obj, k, v)
-        return obj
+
+class Calendar(Base):
+    filename = 'calendar.txt'
+    __tablename__ = 'gtfs_calendar'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('service_id',)
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    service_id = Column(String(255), index=True, nullable=False)
+    monday = Column(SmallInteger, nullable=False)
+    tuesday = Column(SmallInteger, nullable=False)
+    wednesday = Column(SmallInteger, nullable=False)
+    thursday = Column(SmallInteger, nullable=False)
+    friday = Column(SmallInteger, nullable=False)
+    saturday = Column(SmallInteger, nullable=False)
+    sunday = Column(SmallInteger, nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+
+
+class CalendarDate(Base):
+    filename = 'calendar_dates.txt'
+    __tablename__ = 'gtfs_calendar_dates'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('service_id', 'date')
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    service_id = Column(String(255), index=True, nullable=False)
+    date = Column(Date, nullable=False)
+    exception_type = Column(SmallInteger, nullable=False)
+
+
+class Frequency(Base):
+    filename = 'frequencies.txt'
+    __tablename__ = 'gtfs_frequencies'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ('trip_id', 'start_time')
+    # GTFS times stored as seconds since midnight
+    time_columns = ('start_time', 'end_time')
+    references = (('trip_id', 'trip_id', ('trips.txt',)),)
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    trip_id = Column(String(255), index=True, nullable=False)
+    start_time = Column(Integer, nullable=False)
+    end_time = Column(Integer, nullable=False)
+    headway_secs = Column(Integer, nullable=False)
+    exact_times = Column(SmallInteger, default=0)
+
+
+class Transfer(Base):
+    filename = 'transfers.txt'
+    __tablename__ = 'gtfs_transfers'
+    __table_args__ = {u'schema': 'gtfs'}
+    natural_key = ()
+    references = (('from_stop_id', 'stop_id', ('stops.txt',)), ('to_stop_id', 'stop_id', ('stops.txt',)),
+                  ('from_route_id', 'route_id', ('routes.txt',)), ('to_route_id', 'route_id', ('routes.txt',)),
+                  ('from_trip_id', 'trip_id', ('trips.txt',)), ('to_trip_id', 'trip_id', ('trips.txt',)))
+
+    id = Column(Integer, primary_key=True)
+    feed_id = Column(Integer)
+    from_stop_id = Column(String(255), index=True)
+    to_stop_id = Column(String(255))
+    from_route_id = Column(String(255))
+    to_route_id = Column(String(255))
+    from_trip_id = Column(String(255))
+    to_trip_id = Column(String(255))
+    transfer_type = Column(SmallInteger, default=0)
+    min_transfer_time = Column(Integer)
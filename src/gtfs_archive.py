@@ -0,0 +1,80 @@
+import io
+import mmap
+import os
+from zipfile import ZipFile
+
+
+class _MappedFile(io.RawIOBase):
+    """Read only seekable file object over a memory map (mmap is not a complete file object before python 3.13)"""
+
+    def __init__(self, data: mmap.mmap):
+        self.__data = data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.__data.seek(offset, whence)
+        return self.__data.tell()
+
+    def tell(self) -> int:
+        return self.__data.tell()
+
+    def read(self, size: int = -1) -> bytes:
+        return self.__data.read(None if size is None or size < 0 else size)
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class FeedArchive:
+    """
+    Downloaded feed zip, memory-mapped: members are decompressed straight from the page cache (no read / seek
+    system calls per chunk, no copy of the archive in memory), the threads reading members share the mapping.
+    The zip directory gives the members names, sizes and checksums without decompressing them.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: feed zip path
+        """
+        self.path = path
+        self.__file = open(path, 'rb')
+        self.__map = None
+        try:
+            # an empty file can not be mapped, ZipFile reports it as a bad zip
+            if os.fstat(self.__file.fileno()).st_size:
+                self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.zip = ZipFile(_MappedFile(self.__map) if self.__map is not None else self.__file)
+        except BaseException:
+            self.__close_file()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __close_file(self):
+        if self.__map is not None:
+            self.__map.close()
+        self.__file.close()
+
+    def close(self):
+        self.zip.close()
+        self.__close_file()
+
+    def names(self) -> list:
+        """Return the members names"""
+        return self.zip.namelist()
+
+    def checksum(self, filename: str) -> str:
+        """Return checksum of member from the zip directory (crc32 and size), without decompressing it"""
+        info = self.zip.getinfo(filename)
+        return f'{info.CRC:08x}:{info.file_size}'
@@ -0,0 +1,345 @@
+import datetime
+import io
+import json
+import logging
+import math
+import os
+import platform
+import subprocess
+import sys
+from typing import Iterator
+from zipfile import ZipFile, ZIP_DEFLATED
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from gtfs_import import GTFSImport
+from gtfs_loaders import CopyLoader, ErrorLoaderTarget
+
+logger = logging.getLogger(__name__)
+
+# frames are generated in chunks of rows, the generator memory does not grow with the feed size
+GENERATE_CHUNK_ROWS = 1000000
+# libraries imported by the commands that need them, not at CLI startup
+LAZY_MODULES = ('pandas', 'numpy', 'sqlalchemy', 'geoalchemy2', 'shapely', 'geopandas', 'requests')
+
+
+def feed_counts(stop_times: int, stops_per_trip: int = 20, trips_per_route: int = 50, shape_points: int = 200) -> dict:
+    """Return the rows of each file of a synthetic feed of stop_times rows"""
+    trips = max(1, stop_times // stops_per_trip)
+    routes = math.ceil(trips / trips_per_route)
+    return {'agency.txt': 1, 'calendar.txt': 1, 'routes.txt': routes, 'stops.txt': max(2 * stops_per_trip, trips // 5),
+            'trips.txt': trips, 'stop_times.txt': trips * stops_per_trip, 'shapes.txt': routes * shape_points}
+
+
+def _chunks(total: int, rows: int = GENERATE_CHUNK_ROWS) -> Iterator[np.ndarray]:
+    for start in range(0, total, rows):
+        yield np.arange(start, min(total, start + rows))
+
+
+def _ids(prefix: str, values: np.ndarray) -> pd.Series:
+    return prefix + pd.Series(values).astype(str)
+
+
+def _times(seconds: np.ndarray) -> pd.Series:
+    """Return GTFS times (HH:MM:SS, hours past 24) of seconds since midnight"""
+    seconds = pd.Series(seconds)
+    return (seconds // 3600).astype(str).str.zfill(2) + ':' + (seconds // 60 % 60).astype(str).str.zfill(2) + \
+        ':' + (seconds % 60).astype(str).str.zfill(2)
+
+
+def _write_csv(zf: ZipFile, filename: str, frames: Iterator[pd.DataFrame]):
+    """Write DataFrames as one csv member of the zip, streamed"""
+    with zf.open(filename, 'w', force_zip64=True) as raw, \
+            io.TextIOWrapper(raw, encoding='utf-8', newline='') as out:
+        for i, frame in enumerate(frames):
+            frame.to_csv(out, header=i == 0, index=False)
+
+
+def generate_feed(path: str, stop_times: int = 100000, stops_per_trip: int = 20, trips_per_route: int = 50,
+                  shape_points: int = 200, seed: int = 0) -> dict:
+    """
+    Write a synthetic GTFS zip, the same arguments always generate the same feed.
+    Every route has one shape and trips_per_route trips (both directions) of stops_per_trip stops.
+    :param path: zip path
+    :param stop_times: stop_times rows, the other files are scaled from it
+    :param stops_per_trip: stops of each trip
+    :param trips_per_route: trips of each route
+    :param shape_points: points of each shape
+    :param seed: random seed of the coordinates
+    :return: rows of each file
+    """
+    counts = feed_counts(stop_times, stops_per_trip, trips_per_route, shape_points)
+    rng = np.random.default_rng(seed)
+    n_stops, n_routes, n_trips = counts['stops.txt'], counts['routes.txt'], counts['trips.txt']
+    stop_lat = rng.uniform(31.5, 32.5, n_stops).round(6)
+    stop_lon = rng.uniform(34.5, 35.5, n_stops).round(6)
+
+    def stops():
+        for i in _chunks(n_stops):
+            yield pd.DataFrame({'stop_id': _ids('S', i), 'stop_name': _ids('Stop ', i),
+                                'stop_lat': stop_lat[i], 'stop_lon': stop_lon[i], 'location_type': 0})
+
+    def routes():
+        for i in _chunks(n_routes):
+            yield pd.DataFrame({'route_id': _ids('R', i), 'agency_id': 'A', 'route_short_name': i,
+                                'route_long_name': _ids('Route ', i), 'route_type': 3})
+
+    def route_stops(route: np.ndarray, k: np.ndarray) -> np.ndarray:
+        return (route * stops_per_trip + k) % n_stops
+
+    def shapes():
+        for i in _chunks(n_routes * shape_points):
+            route, point = i // shape_points, i % shape_points
+            # shape along the route stops, point p between stop k and k + 1
+            k = point * (stops_per_trip - 1) // max(1, shape_points - 1)
+            frac = point * (stops_per_trip - 1) / max(1, shape_points - 1) - k
+            a, b = route_stops(route, k), route_stops(route, np.minimum(k + 1, stops_per_trip - 1))
+            yield pd.DataFrame({'shape_id': _ids('SH', route),
+                                'shape_pt_lat': (stop_lat[a] + (stop_lat[b] - stop_lat[a]) * frac).round(6),
+                                'shape_pt_lon': (stop_lon[a] + (stop_lon[b] - stop_lon[a]) * frac).round(6),
+                                'shape_pt_sequence': point + 1})
+
+    def trips():
+        for i in _chunks(n_trips):
+            route = i // trips_per_route
+            yield pd.DataFrame({'route_id': _ids('R', route), 'service_id': 'WK', 'trip_id': _ids('T', i),
+                                'direction_id': i % 2, 'shape_id': _ids('SH', route)})
+
+    def stop_times_():
+        for i in _chunks(n_trips * stops_per_trip):
+            trip, k = i // stops_per_trip, i % stops_per_trip
+            route, direction = trip // trips_per_route, trip % 2
+            stop = route_stops(route, np.where(direction == 0, k, stops_per_trip - 1 - k))
+            arrival = 5 * 3600 + (trip % trips_per_route) * 900 + k * 120
+            yield pd.DataFrame({'trip_id': _ids('T', trip), 'arrival_time': _times(arrival),
+                                'departure_time': _times(arrival + 30), 'stop_id': _ids('S', stop),
+                                'stop_sequence': k + 1})
+
+    with ZipFile(path, 'w', ZIP_DEFLATED) as zf:
+        _write_csv(zf, 'agency.txt', iter([pd.DataFrame({
+            'agency_id': ['A'], 'agency_name': ['Bench agency'], 'agency_url': ['http://example.com'],
+            'agency_timezone': ['Asia/Jerusalem']})]))
+        _write_csv(zf, 'calendar.txt', iter([pd.DataFrame({
+            'service_id': ['WK'], 'monday': [1], 'tuesday': [1], 'wednesday': [1], 'thursday': [1], 'friday': [1],
+            'saturday': [0], 'sunday': [0], 'start_date': ['20220101'], 'end_date': ['20221231']})]))
+        _write_csv(zf, 'stops.txt', stops())
+        _write_csv(zf, 'routes.txt', routes())
+        _write_csv(zf, 'shapes.txt', shapes())
+        _write_csv(zf, 'trips.txt', trips())
+        _write_csv(zf, 'stop_times.txt', stop_times_())
+    return counts
+
+
+class _FileQuery:
+    """Empty query, the file sink stores no feed"""
+
+    def filter(self, *args):
+        return self
+
+    def order_by(self, *args):
+        return self
+
+    def delete(self, synchronize_session='evaluate') -> int:
+        return 0
+
+    def update(self, values: dict, synchronize_session='evaluate') -> int:
+        return 0
+
+    def first(self):
+        return None
+
+    def __iter__(self):
+        return iter(())
+
+
+class _FileResult:
+    rowcount = 0
+
+    def scalar(self):
+        return None
+
+    def __iter__(self):
+        return iter(())
+
+
+class _FileCursor:
+    """dbapi cursor writing the COPY data to a file per table"""
+
+    def __init__(self, sink):
+        self.__sink = sink
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def copy_expert(self, sql: str, data, size: int = 1024 * 1024):
+        table = sql.split()[1]
+        with open(os.path.join(self.__sink.out_dir, f'{table}.copy'), 'a') as f:
+            for chunk in iter(lambda: data.read(size), ''):
+                f.write(chunk)
+                self.__sink.bytes_written += len(chunk)
+
+    def execute(self, sql: str, params=None):
+        self.__sink.execute(sql, params)
+
+
+class _FileConnection:
+    """sqlalchemy connection, its dbapi connection is the sink"""
+
+    def __init__(self, sink):
+        self.connection = sink
+
+
+class FileSink:
+    """
+    Stand-in of a postgres session for benchmarks without a database: COPY data is written to a file per table
+    (out_dir/<table>.copy), statements are appended to out_dir/statements.sql, queries return no rows.
+    Only the copy loader writes through it.
+    """
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        self.bytes_written = 0
+        self.added = list()
+        os.makedirs(out_dir, exist_ok=True)
+        for name in os.listdir(out_dir):
+            if name.endswith('.copy') or name == 'statements.sql':
+                os.remove(os.path.join(out_dir, name))
+        # postgres dialect and engine events, never connected
+        self.bind = create_engine('postgresql://')
+
+    def connection(self) -> _FileConnection:
+        return _FileConnection(self)
+
+    def cursor(self) -> _FileCursor:
+        return _FileCursor(self)
+
+    def execute(self, statement, params=None) -> _FileResult:
+        with open(os.path.join(self.out_dir, 'statements.sql'), 'a') as f:
+            f.write(f'{statement};\n')
+        return _FileResult()
+
+    def query(self, *entities) -> _FileQuery:
+        return _FileQuery()
+
+    def add(self, obj):
+        self.added.append(obj)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def git_commit() -> str:
+    """Return the current git commit of the source tree, None outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(zip_path: str, db_con_str: str = None, out_dir: str = None, feed_id: int = 0, repeat: int = 1,
+                  **import_kwargs) -> list:
+    """
+    Import zip_path repeat times, return the import stats of each run
+    :param zip_path: feed zip
+    :param db_con_str: benchmark database, default: FileSink writing to out_dir
+    :param out_dir: FileSink directory
+    :param feed_id: feed id of the imported rows, a database run replaces the rows of the previous run
+    :param repeat: number of runs
+    :param import_kwargs: GTFSImport arguments (loader, chunk_rows, max_chunk_mb)
+    """
+    if db_con_str is None and import_kwargs.get('loader', CopyLoader.name) != CopyLoader.name:
+        raise ErrorLoaderTarget(f'the file sink supports only the {CopyLoader.name} loader')
+    runs = list()
+    for run in range(repeat):
+        if db_con_str is None:
+            sink = FileSink(out_dir)
+            stats = GTFSImport(sink, create_schema=False, **import_kwargs).import_zip(feed_id, zip_path)
+            record = dict(stats.record(), sink_bytes=sink.bytes_written)
+        else:
+            engine = create_engine(db_con_str)
+            try:
+                with Session(engine) as sa_session:
+                    stats = GTFSImport(sa_session, **import_kwargs).import_zip(feed_id, zip_path)
+                record = stats.record()
+            finally:
+                engine.dispose()
+        record['files'] = [f.record() for f in stats.files]
+        logger.info(f"run {run + 1}/{repeat}: {record['rows']:,} rows, {record['rows_per_s']:,.0f} rows/s")
+        runs.append(record)
+    return runs
+
+
+def benchmark(work_dir: str, db_con_str: str = None, stop_times: int = 100000, stops_per_trip: int = 20,
+              trips_per_route: int = 50, shape_points: int = 200, seed: int = 0, repeat: int = 1,
+              **import_kwargs) -> dict:
+    """
+    Generate (or reuse) a synthetic feed in work_dir and benchmark its import, return machine readable results:
+    environment (commit, python), parameters, feed rows and the stats of each run (gtfs_import_stats records)
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    zip_path = os.path.join(work_dir, f'gtfs_bench_{stop_times}_{stops_per_trip}_{trips_per_route}_'
+                                      f'{shape_points}_{seed}.zip')
+    if os.path.exists(zip_path):
+        counts = feed_counts(stop_times, stops_per_trip, trips_per_route, shape_points)
+    else:
+        logger.info(f'generate {zip_path}')
+        counts = generate_feed(zip_path + '.tmp', stop_times, stops_per_trip, trips_per_route, shape_points, seed)
+        os.replace(zip_path + '.tmp', zip_path)
+    runs = run_benchmark(zip_path, db_con_str, os.path.join(work_dir, 'sink'), repeat=repeat, **import_kwargs)
+    return {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+            'dt': datetime.datetime.now().isoformat(), 'sink': 'postgres' if db_con_str else 'file',
+            'params': dict(import_kwargs, stop_times=stop_times, stops_per_trip=stops_per_trip,
+                           trips_per_route=trips_per_route, shape_points=shape_points, seed=seed),
+            'feed': dict(counts, zip_bytes=os.path.getsize(zip_path)), 'runs': runs}
+
+
+def startup_profile(module: str = 'main', repeat: int = 5) -> dict:
+    """
+    Import module in a new interpreter (python -X importtime) repeat times, return the fastest import time (ms),
+    the modules imported and the slowest top level packages, and the LAZY_MODULES imported at startup
+    """
+    path = [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, path)))
+    runs = list()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], env=env,
+                                stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+        # import time: self [us] | cumulative | imported package, nested imports are indented and listed first
+        imports, pending = dict(), dict()
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'imported package' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            pending[name.strip()] = int(cumulative) / 1000
+            if not name[1:].startswith(' '):
+                # top level import, the interpreter startup (site) is not part of module
+                if name.strip() == module:
+                    imports.update(pending)
+                pending = dict()
+        runs.append(imports)
+    imports = min(runs, key=lambda run: run.get(module, 0))
+    packages = {name: ms for name, ms in imports.items() if '.' not in name and name != module}
+    return {'commit': git_commit(), 'python': platform.python_version(), 'module': module, 'repeat': repeat,
+            'import_ms': imports.get(module, 0), 'modules': len(imports),
+            'slowest': dict(sorted(packages.items(), key=lambda item: -item[1])[:10]),
+            'eager_modules': [name for name in LAZY_MODULES if name in imports]}
+
+
+def write_results(results: dict, path: str = None):
+    """Write benchmark results as JSON to path, or to stdout"""
+    text = json.dumps(results, indent=2)
+    if path is None:
+        print(text)
+        return
+    with open(path, 'w') as f:
+        f.write(text + '\n')
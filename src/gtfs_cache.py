@@ -0,0 +1,129 @@
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+class FeedCache:
+    """
+    Local content addressed cache of downloaded feed zips.
+    Files are keyed by their checksum (FeedImport.feed_checksum) and evicted least recently used first once the
+    cache grows over max_size_mb. The cache can be shared by the workers of a machine: the cache size is kept in an
+    index file updated under a file lock, the directory is scanned only when the cache is over its size.
+    """
+    LOCK_FILE = '.lock'
+    SIZE_FILE = '.size'
+
+    def __init__(self, cache_dir: str, max_size_mb: float = 10240, in_use_s: float = 3600):
+        """
+        :param cache_dir: cache directory
+        :param max_size_mb: max cache size (MB)
+        :param in_use_s: files used (downloaded or taken from the cache) since are not evicted, they can be
+            waiting for their import (prefetched feeds) or being imported
+        """
+        self.__cache_dir = cache_dir
+        self.__max_size = int(max_size_mb * 1024 * 1024)
+        self.__in_use_s = in_use_s
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger(__name__)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, checksum: str) -> str:
+        """Return cache path of checksum"""
+        return os.path.join(self.__cache_dir, checksum[:2], f'{checksum}.zip')
+
+    def get(self, checksum: str) -> str:
+        """Return cached file path of checksum or None, a hit refresh the file LRU position"""
+        path = self.path(checksum)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, src_path: str, checksum: str) -> str:
+        """Move downloaded file into the cache, return its cache path"""
+        path = self.path(checksum)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # moved next to its cache path first, a copy when the spool directory is on another file system
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.move(src_path, tmp_path)
+        with self.__locked():
+            if os.path.exists(path):
+                os.remove(tmp_path)
+                os.utime(path)
+                return path
+            # rename is atomic on the same file system, readers never see a partial file
+            os.replace(tmp_path, path)
+            total = self.__read_size()
+            # without index (new or older cache), the scan counts the new file
+            total = self.__scan_size() if total is None else total + os.path.getsize(path)
+            if total > self.__max_size:
+                total = self.__evict()
+            self.__write_size(total)
+        return path
+
+    def evict(self):
+        """Remove least recently used files until the cache size is under max_size_mb, the size index is rebuilt"""
+        with self.__locked():
+            self.__write_size(self.__evict())
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """Lock the cache against the threads of the process and the other processes (flock)"""
+        with self.__lock, open(os.path.join(self.__cache_dir, self.LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __read_size(self) -> int:
+        """Return the cache size of the index, None when there is no index"""
+        try:
+            with open(os.path.join(self.__cache_dir, self.SIZE_FILE)) as size_file:
+                return int(size_file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def __write_size(self, total: int):
+        with open(os.path.join(self.__cache_dir, self.SIZE_FILE), 'w') as size_file:
+            size_file.write(str(total))
+
+    def __files(self) -> list:
+        """Return (mtime, size, path) of the cached files"""
+        files = list()
+        for root, _, names in os.walk(self.__cache_dir):
+            for name in names:
+                if name.endswith('.zip'):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return files
+
+    def __scan_size(self) -> int:
+        return sum(size for _, size, _ in self.__files())
+
+    def __evict(self) -> int:
+        """Remove least recently used files not in use until the cache is under max_size_mb, return cache size"""
+        files = self.__files()
+        total = sum(size for _, size, _ in files)
+        in_use_dt = time.time() - self.__in_use_s
+        for mtime, size, path in sorted(files):
+            if total <= self.__max_size:
+                break
+            if mtime >= in_use_dt:
+                self.__logger.warning(f'cache over {self.__max_size:,} bytes ({total:,}), remaining files in use')
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.__logger.debug(f'evict {path}')
+        return total
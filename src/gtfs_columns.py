@@ -0,0 +1,92 @@
+import pandas as pd
+from geoalchemy2 import Geography, Geometry
+from sqlalchemy.types import ARRAY, BigInteger, Date, Float, Integer, SmallInteger, String
+
+
+class TableSchema:
+    """
+    Columnar transform of a GTFS file chunk (read as strings) to the typed columns of its table, derived from the
+    model Column types: strings cleaned and truncated to the column length, integers / floats / dates / GTFS times
+    parsed, empty values as nulls (or the column default), points built from their coordinate columns.
+    Every step runs on whole columns, there are no per row objects.
+    Columns that are not read from the file (ARRAY, Geometry) are left to the caller.
+    """
+
+    def __init__(self, gtfs_cls):
+        self.gtfs_cls = gtfs_cls
+        self.__time_columns = set(getattr(gtfs_cls, 'time_columns', ()))
+        self.__point_columns = getattr(gtfs_cls, 'point_columns', dict())
+        self.columns = [c for c in gtfs_cls.__table__.columns if not c.primary_key and c.name != 'feed_id']
+
+    @staticmethod
+    def __strings(values: pd.Series, length: int = None) -> pd.Series:
+        # NUL is not valid in postgres text, undecodable bytes were replaced when the file was decoded
+        values = values.str.replace('\x00', '', regex=False)
+        if length:
+            values = values.str.slice(0, length)
+        return values.where(values != '')
+
+    @staticmethod
+    def integer_limits(column_type: Integer) -> tuple:
+        """Return (min, max + 1) of the values of an integer column type"""
+        bits = 16 if isinstance(column_type, SmallInteger) else 64 if isinstance(column_type, BigInteger) else 32
+        return -2 ** (bits - 1), 2 ** (bits - 1)
+
+    @staticmethod
+    def integers(values: pd.Series, column_type: Integer) -> pd.Series:
+        """Return values parsed as integers of column_type (rounded), null when not a number or out of its range"""
+        numbers = pd.to_numeric(values, errors='coerce').round()
+        low, high = TableSchema.integer_limits(column_type)
+        # compared as floats: high is a power of 2, exact as a float
+        return numbers.where((numbers >= low) & (numbers < high)).astype('Int64')
+
+    @staticmethod
+    def times_to_seconds(values: pd.Series) -> pd.Series:
+        """Return GTFS times (H:MM:SS, may be past 24:00:00) as seconds since midnight"""
+        # a feed has few distinct times, parse each of them once
+        codes, uniques = pd.factorize(values)
+        seconds = pd.to_timedelta(pd.Series(uniques, dtype=object).str.strip(), errors='coerce') \
+            .dt.total_seconds().to_numpy()
+        result = pd.Series(seconds[codes] if len(seconds) else float('nan'), index=values.index)
+        return result.where(codes >= 0).astype('Int64')
+
+    def __point(self, chunk: pd.DataFrame, lon_column: str, lat_column: str) -> pd.Series:
+        """Return EWKT points, null where a coordinate is missing or not a number"""
+        if lon_column not in chunk or lat_column not in chunk:
+            return pd.Series(None, index=chunk.index, dtype=object)
+        # the file text is kept (no float formatting), numbers are only validated
+        lon, lat = chunk[lon_column].str.strip(), chunk[lat_column].str.strip()
+        valid = pd.to_numeric(lon, errors='coerce').notna() & pd.to_numeric(lat, errors='coerce').notna()
+        return ('SRID=4326;POINT(' + lon + ' ' + lat + ')').where(valid)
+
+    def transform(self, chunk: pd.DataFrame) -> pd.DataFrame:
+        """Return the chunk (all columns strings) as a frame of the table columns (without feed_id)"""
+        chunk = chunk.rename(columns=lambda name: name.strip())
+        frame = pd.DataFrame(index=chunk.index)
+        for column in self.columns:
+            name = column.name
+            if name in self.__point_columns:
+                frame[name] = self.__point(chunk, *self.__point_columns[name])
+                continue
+            if isinstance(column.type, (ARRAY, Geometry, Geography)):
+                continue
+            if name not in chunk:
+                values = pd.Series(None, index=chunk.index, dtype=object)
+            elif name in self.__time_columns:
+                values = self.times_to_seconds(chunk[name])
+            elif isinstance(column.type, Integer):
+                values = self.integers(chunk[name], column.type)
+            elif isinstance(column.type, Float):
+                values = pd.to_numeric(chunk[name], errors='coerce')
+            elif isinstance(column.type, Date):
+                # GTFS dates are YYYYMMDD
+                values = pd.to_datetime(chunk[name].str.strip(), format='%Y%m%d', errors='coerce') \
+                    .dt.strftime('%Y-%m-%d')
+            elif isinstance(column.type, String):
+                values = self.__strings(chunk[name].fillna(''), column.type.length)
+            else:
+                values = chunk[name]
+            if column.default is not None and column.default.is_scalar:
+                values = values.fillna(column.default.arg)
+            frame[name] = values
+        return frame
@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from ftplib import FTP
+from typing import Iterable, Iterator, NamedTuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from gtfs_cache import FeedCache
+
+
+class ErrorUnknownFeedSource(Exception):
+    pass
+
+
+class DownloadResult(NamedTuple):
+    url: str
+    path: str = None
+    size: int = 0
+    checksum: str = None
+    etag: str = None
+    last_modified: str = None
+    not_modified: bool = False
+    elapsed: float = 0.0
+    # path is a file of the feeds cache, not of the spool directory
+    cached: bool = False
+
+
+class FeedDownloader:
+    """
+    Download feeds to a spool directory.
+    Feeds are prefetched by a thread pool ahead of the consumer, bodies are streamed to disk (hashed and sized on
+    the way) and failed downloads are retried with exponential backoff.
+    HTTP downloads send If-None-Match / If-Modified-Since, an unchanged feed returns not_modified without a body.
+    With a cache, downloaded files are moved into it and a wanted checksum already cached is not downloaded.
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, spool_dir: str = None, max_workers: int = 4, retries: int = 3, backoff: float = 2.0,
+                 timeout: float = 60, cache: FeedCache = None):
+        """
+        :param spool_dir: directory of downloaded files, default: temp dir
+        :param max_workers: max concurrent downloads
+        :param retries: retries of failed download
+        :param backoff: backoff factor (seconds) between retries
+        :param timeout: connect / read timeout (seconds)
+        :param cache: downloaded feeds cache (by checksum), default: no cache
+        """
+        self.__spool_dir = spool_dir or os.path.join(tempfile.gettempdir(), 'gtfs_spool')
+        os.makedirs(self.__spool_dir, exist_ok=True)
+        self.__max_workers = max_workers
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__timeout = timeout
+        self.__cache = cache
+        self.__local = threading.local()
+        self.__logger = logging.getLogger(__name__)
+
+    def __http_session(self) -> requests.Session:
+        """Return the thread http session, connections are reused between downloads of the same thread"""
+        if not hasattr(self.__local, 'session'):
+            session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=self.__max_workers))
+            session.mount('https://', HTTPAdapter(pool_maxsize=self.__max_workers))
+            self.__local.session = session
+        return self.__local.session
+
+    @contextmanager
+    def __spool_file(self):
+        """Yield a new spool file, removed when the download fails (a retry writes a new one)"""
+        f = tempfile.NamedTemporaryFile(dir=self.__spool_dir, suffix='.zip', delete=False)
+        try:
+            with f:
+                yield f
+        except BaseException:
+            os.remove(f.name)
+            raise
+
+    def __download_http(self, url: str, etag: str = None, last_modified: str = None) -> DownloadResult:
+        headers = dict()
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with self.__http_session().get(url, headers=headers, stream=True, timeout=self.__timeout) as response:
+            if response.status_code == 304:
+                return DownloadResult(url, etag=etag, last_modified=last_modified, not_modified=True)
+            response.raise_for_status()
+            md5 = hashlib.md5()
+            size = 0
+            with self.__spool_file() as f:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    f.write(chunk)
+                    md5.update(chunk)
+                    size += len(chunk)
+            return DownloadResult(url, path=f.name, size=size, checksum=md5.hexdigest(),
+                                  etag=response.headers.get('ETag'),
+                                  last_modified=response.headers.get('Last-Modified'))
+
+    def __download_ftp(self, url: str) -> DownloadResult:
+        o = urlparse(url)
+        md5 = hashlib.md5()
+        with FTP(o.netloc, timeout=self.__timeout) as ftp, self.__spool_file() as f:
+            ftp.login()
+
+            def write(chunk: bytes):
+                f.write(chunk)
+                md5.update(chunk)
+
+            ftp.retrbinary('RETR ' + o.path, write, blocksize=self.CHUNK_SIZE)
+            size = f.tell()
+        return DownloadResult(url, path=f.name, size=size, checksum=md5.hexdigest())
+
+    def download(self, url: str, etag: str = None, last_modified: str = None, checksum: str = None) -> DownloadResult:
+        """
+        Download url to the spool directory (moved to the cache), retry with backoff on failure
+        :param checksum: version of the feed wanted, taken from the cache without a download when cached
+        """
+        scheme = urlparse(url).scheme
+        if scheme not in ['http', 'https', 'ftp']:
+            raise ErrorUnknownFeedSource(f'feed url: {url}')
+        if checksum is not None and self.__cache is not None:
+            path = self.__cache.get(checksum)
+            if path is not None:
+                self.__logger.info(f'{url} version {checksum} taken from the cache')
+                return DownloadResult(url, path=path, size=os.path.getsize(path), checksum=checksum, cached=True)
+        start = time.perf_counter()
+        for attempt in range(self.__retries + 1):
+            try:
+                self.__logger.debug(f'downloading from url: {url}')
+                if scheme == 'ftp':
+                    result = self.__download_ftp(url)
+                else:
+                    result = self.__download_http(url, etag, last_modified)
+                if result.path is not None and self.__cache is not None:
+                    result = result._replace(path=self.__cache.put(result.path, result.checksum), cached=True)
+                return result._replace(elapsed=time.perf_counter() - start)
+            except (requests.RequestException, OSError, EOFError) as e:
+                # http 4xx errors will not be fixed by a retry
+                response = getattr(e, 'response', None)
+                if attempt == self.__retries or (response is not None and response.status_code < 500):
+                    raise
+                wait = self.__backoff * 2 ** attempt
+                self.__logger.warning(f'download {url} failed ({e}), retry in {wait:.0f}s')
+                time.sleep(wait)
+
+    def prefetch(self, items: Iterable[tuple], lookahead: int = None) -> Iterator[tuple]:
+        """
+        Download ahead of the consumer.
+        :param items: (key, url, etag, last_modified, checksum) tuples, consumed lazily
+        :param lookahead: max downloads in flight or waiting for the consumer, default: 2 * max_workers
+        :return: (key, future of DownloadResult) in items order
+        """
+        lookahead = lookahead or 2 * self.__max_workers
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix='gtfs_download') as executor:
+            pending = deque()
+            for key, url, etag, last_modified, checksum in items:
+                pending.append((key, executor.submit(self.download, url, etag, last_modified, checksum)))
+                if len(pending) >= lookahead:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+
+    @staticmethod
+    def remove(result: DownloadResult):
+        """Remove downloaded file from the spool directory, cached files are kept"""
+        if result.path and not result.cached and os.path.exists(result.path):
+            os.remove(result.path)
@@ -1,152 +1,526 @@
-import io
 import traceback
-from urllib.parse import urlparse
-from zipfile import ZipFile
-import csv
+import json
+from concurrent.futures import Future
 import logging
+import os
 import pandas as pd
 import sqlalchemy
-from geopandas import GeoDataFrame
-from shapely.geometry import Point, LineString
-from geoalchemy2.shape import from_shape
+import numpy as np
+from pandas.api.types import union_categoricals
 import datetime
-import requests
-from io import BytesIO
-import sys
-import hashlib
-from ftplib import FTP
+import functools
+import struct
+from typing import Iterable, Iterator
 
-from gtfs import FeedImport, Trip, Shape, Base, metadata
+from gtfs_archive import FeedArchive
+from gtfs import FeedImport, FeedFile, Stop, StopTime, Trip, TripPattern, Shape, Base, deferred_indexes, \
+    import_classes, spatial_indexes
+from gtfs_cache import FeedCache
+from gtfs_columns import TableSchema
+from gtfs_download import DownloadResult, FeedDownloader, ErrorUnknownFeedSource  # noqa: F401
+from gtfs_loaders import CopyLoader, ErrorLoaderTarget, PreparedBatch, get_loader
+from gtfs_merge import GTFSMerge
+from gtfs_parquet import ErrorParquetUnavailable, ParquetFeed, ParquetStore
+from gtfs_partitions import GTFSPartitions
+from gtfs_patterns import TripPatterns
+from gtfs_pipeline import BatchPipeline
+from gtfs_profile import LoadProfile
+from gtfs_stats import FeedStats, StatsRecorder
+from gtfs_stream import CSVStream
+from gtfs_schema import GTFSSchema
 from gtfs_sources import GTFSSources
+from gtfs_spatial import GTFSSpatial
+from gtfs_staging import GTFSStaging
+from gtfs_validate import ErrorInvalidFeed, FeedValidator  # noqa: F401
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('urllib3').setLevel(logging.INFO)
 
 
-class ErrorUnknownFeedSource(Exception):
+class ErrorMissingStopFile(Exception):
     pass
 
 
-class ErrorMissingStopFile(Exception):
+class ErrorMissingStopsTimesFile(Exception):
     pass
 
 
-class ErrorMissingStopsTimesFile(Exception):
+class ErrorFeedClaimLost(Exception):
     pass
 
 
 class GTFSImport(object):
-    def __init__(self, sa_session):
+    def __init__(self, sa_session, loader: str = CopyLoader.name, chunk_rows: int = 50000, max_chunk_mb: float = 64,
+                 spool_dir: str = None, download_workers: int = 4,
+                 cache_dir: str = None, cache_size_mb: float = 10240, partitioned: bool = False,
+                 incremental: bool = False, stats_json: str = None, stats_prometheus: str = None,
+                 create_schema: bool = True, parse_workers: int = 1, pipeline_batches: int = 4,
+                 stale_claim_minutes: float = 60, spatial: bool = False, load_profile: LoadProfile = None,
+                 parquet_dir: str = None, validation: str = FeedValidator.QUARANTINE, defer_indexes: bool = False,
+                 max_resumes: int = 3):
+        """
+        :param sa_session: sqlalchemy session
+        :param loader: loader engine name, 'copy' (COPY FROM STDIN) or 'orm' (bulk_insert_mappings)
+        :param chunk_rows: max rows read from a feed file at once
+        :param max_chunk_mb: memory ceiling (MB) of the rows read from a feed file at once
+        :param spool_dir: directory of downloaded feeds, default: temp dir
+        :param download_workers: max concurrent downloads, ahead of the import
+        :param cache_dir: directory of the downloaded feeds cache (by checksum), default: no cache
+        :param cache_size_mb: max size of the feeds cache (MB)
+        :param partitioned: GTFS tables partitioned by feed_id, feeds are loaded to staging tables and swapped in
+        :param incremental: re-import of a stored feed applies only the changes of the files changed since
+        :param stats_json: append feeds import stats (gtfs_import_stats) as JSON lines to this file
+        :param stats_prometheus: write import stats totals as Prometheus textfile metrics to this file
+        :param create_schema: create or migrate the schema when the stored schema version is not current
+        :param parse_workers: threads parsing the next feed files while the current one is written, 0: no pipeline
+        :param pipeline_batches: max parsed batches of a file waiting for the writer
+        :param stale_claim_minutes: a RUNNING feed without a file loaded for this long (its worker died) is claimed
+            again, the import resumes from its checkpoints
+        :param max_resumes: a feed whose claim went stale more than max_resumes times in a row is marked ERROR
+            instead of being claimed again (eg: a feed killing its worker)
+        :param spatial: run the post-load spatial stage of each feed (route geometries, feed extent, clustering and
+            ANALYZE of the feed tables)
+        :param load_profile: connection settings of the load (synchronous_commit, work_mem, ...), set on the session
+            connections, the pool and executemany settings apply to an engine created by the profile
+        :param parquet_dir: directory of the Parquet staging of the parsed feeds (ParquetStore), written while the
+            feeds are loaded and read by import_parquet
+        :param validation: pre-flight validation of the feeds (FeedValidator) before any write, 'quarantine': invalid
+            rows are not loaded, 'reject': a feed with invalid rows is not loaded, 'off': no validation
+        :param defer_indexes: the indexes of the GTFS tables are not built by the loads, they are dropped before a
+            bulk load (drop_indexes) and built once it is done (build_indexes), not partitioned schema only
+        """
+        if (partitioned or incremental) and loader != CopyLoader.name:
+            raise ErrorLoaderTarget(f'partitioned schema and incremental import require the {CopyLoader.name} loader')
         self.__sa_gtfs_session = sa_session
+        self.__loader = get_loader(loader, sa_session)
+        # a cached zip of a claimed feed (prefetched or importing) is in use until its claim goes stale
+        cache = FeedCache(cache_dir, cache_size_mb, in_use_s=stale_claim_minutes * 60) if cache_dir else None
+        self.__downloader = FeedDownloader(spool_dir=spool_dir, max_workers=download_workers, cache=cache)
+        self.__chunk_rows = chunk_rows
+        self.__max_chunk_mb = max_chunk_mb
+        self.__parse_workers = parse_workers
+        self.__pipeline_batches = pipeline_batches
+        self.__stale_claim_minutes = stale_claim_minutes
+        self.__max_resumes = max_resumes
+        # feed_id -> claim_dt of the feeds claimed by this worker (prefetched or importing)
+        self.__claims = dict()
+        self.__validation = validation
+        self.__defer_indexes = defer_indexes
+        self.__partitions = None
+        self.__incremental = incremental
+        self.__merge = GTFSMerge(sa_session)
         self.__logger = logging.getLogger(__name__)
+        if load_profile is not None:
+            load_profile.apply(sa_session)
+
+        gtfs_classes = import_classes()
+        if partitioned:
+            self.__partitions = GTFSPartitions(sa_session, gtfs_classes)
+        # a new feed version is loaded to staging tables and published in one transaction (not incremental)
+        self.__staging = self.__partitions or GTFSStaging(sa_session, gtfs_classes)
+        self.__spatial = GTFSSpatial(sa_session, gtfs_classes, self.__partitions)
+        self.__spatial_stage = spatial
+        self.__parquet = ParquetStore(parquet_dir, gtfs_classes) if parquet_dir else None
 
-        # Create schema if not exists
-        engine = sa_session.bind
-        if not engine.dialect.has_schema(engine, metadata.schema):
-            engine.execute(sqlalchemy.schema.CreateSchema(metadata.schema))
-        metadata.create_all(engine, checkfirst=True)
-
-    @staticmethod
-    def __build_shapes(data: io.StringIO) -> list:
-        """Return list of LineString geometries"""
-        df = pd.read_csv(data)
-        geometry = [Point(xy) for xy in zip(df.shape_pt_lon, df.shape_pt_lat)]
-        df = GeoDataFrame(df, geometry=geometry)
-        df = df.groupby(['shape_id'])['geometry'].apply(lambda x: LineString(x.tolist()))
-        shapes = df.to_dict()
-        return shapes
-
-    @staticmethod
-    def __generate_trip_stops(input_zip: ZipFile) -> pd.DataFrame:
-        """Return dataframe of trip stops"""
-        data = io.StringIO(input_zip.read('stop_times.txt').decode())
-        df = pd.read_csv(data)
-        trip_stops = df.groupby('trip_id')['stop_id'].apply(tuple).drop_duplicates()
-        return trip_stops
+        # create or migrate the schema, unless the stored schema version is current
+        if create_schema:
+            GTFSSchema(sa_session, self.__partitions).bootstrap()
+        self.__stats = StatsRecorder(sa_session, json_path=stats_json, prometheus_path=stats_prometheus)
+
+    def __build_shapes(self, stream: CSVStream) -> Iterator[pd.DataFrame]:
+        """
+        Yield frames of shapes (shape_id, shape as hex WKB LineString).
+        Points are sorted once by (shape_id, shape_pt_sequence) and split into shapes by offsets, no per point objects.
+        """
+        shape_ids, lon, lat, seq = list(), list(), list(), list()
+        # read as text, the quarantined rows (stream row_filter) may not be numbers
+        for chunk in stream.frames(Shape.filename,
+                                   usecols=['shape_id', 'shape_pt_lat', 'shape_pt_lon', 'shape_pt_sequence'],
+                                   dtype=str):
+            shape_ids.append(chunk['shape_id'].astype('category').values)
+            # float64 whatever the inferred type (integer coordinates), the WKB points are doubles
+            lon.append(pd.to_numeric(chunk['shape_pt_lon']).to_numpy(dtype='float64'))
+            lat.append(pd.to_numeric(chunk['shape_pt_lat']).to_numpy(dtype='float64'))
+            seq.append(pd.to_numeric(chunk['shape_pt_sequence']).to_numpy(dtype='float64'))
+        if not shape_ids:
+            return
+        shape_ids = union_categoricals(shape_ids)
+        codes = shape_ids.codes
+        order = np.lexsort((np.concatenate(seq), codes))
+        codes = codes[order]
+        coords = np.column_stack((np.concatenate(lon)[order], np.concatenate(lat)[order]))
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1))
+        ends = np.append(starts[1:], len(codes))
+
+        max_batch_bytes = self.__max_chunk_mb * 1024 * 1024
+        batch_ids, batch_shapes = list(), list()
+        batch_bytes = 0
+        for start, end in zip(starts, ends):
+            shape_id = shape_ids.categories[codes[start]]
+            if end - start < 2:
+                self.__logger.warning(f"shape {shape_id} has less than 2 points, skipped")
+                continue
+            # WKB LineString: little endian byte order, geometry type 2, number of points, x y doubles
+            wkb = (struct.pack('<BII', 1, 2, end - start) + coords[start:end].tobytes()).hex()
+            batch_ids.append(shape_id)
+            batch_shapes.append(wkb)
+            batch_bytes += len(wkb)
+            if len(batch_ids) >= self.__chunk_rows or batch_bytes >= max_batch_bytes:
+                yield pd.DataFrame({'shape_id': batch_ids, 'shape': batch_shapes})
+                batch_ids, batch_shapes = list(), list()
+                batch_bytes = 0
+        if batch_ids:
+            yield pd.DataFrame({'shape_id': batch_ids, 'shape': batch_shapes})
+
+    def __file_frames(self, gtfs_cls, stream: CSVStream, patterns: TripPatterns) -> Iterator[pd.DataFrame]:
+        """
+        Yield typed frames of the file table columns (TableSchema), read once as string columns.
+        The trips patterns are built from the stop_times frames, the trips frames get their pattern_id.
+        """
+        schema = TableSchema(gtfs_cls)
+        for chunk in stream.frames(gtfs_cls.filename, dtype=str):
+            frame = schema.transform(chunk)
+            if gtfs_cls is StopTime:
+                patterns.add(frame)
+            elif gtfs_cls is Trip:
+                frame['pattern_id'] = patterns.pattern_ids(frame['trip_id'])
+                missing = int(frame['pattern_id'].isna().sum())
+                if missing:
+                    self.__logger.warning(f"{missing:,} trips without stop times")
+            yield frame
+        if gtfs_cls is StopTime:
+            patterns.build()
+
+    def __build_deferred_indexes(self, gtfs_cls):
+        """
+        Create the indexes of gtfs_cls that are built after the data is loaded. They are missing only until the
+        first load of the table, the next loads maintain them row by row (see drop_indexes for bulk loads)
+        """
+        for columns in deferred_indexes(gtfs_cls):
+            name = f"ix_{gtfs_cls.__tablename__}_{'_'.join(columns)}"
+            self.__sa_gtfs_session.execute(
+                sqlalchemy.text(f"CREATE INDEX IF NOT EXISTS {name} "
+                                f"ON {gtfs_cls.__table__.fullname} ({', '.join(columns)})"))
+            self.__sa_gtfs_session.commit()
+        self.__spatial.build_indexes(gtfs_cls)
+
+    def drop_indexes(self):
+        """
+        Drop the secondary indexes of the GTFS tables (model, deferred and spatial indexes) before a bulk load, the
+        rows are then loaded without index maintenance. Not partitioned schema: the feed partitions are indexed
+        after their load anyway. The lookups by feed are full scans until build_indexes
+        """
+        for gtfs_cls in import_classes():
+            names = [index.name for index in gtfs_cls.__table__.indexes]
+            names += [f"ix_{gtfs_cls.__tablename__}_{'_'.join(columns)}" for columns in deferred_indexes(gtfs_cls)]
+            names += [name for name, _, _ in spatial_indexes(gtfs_cls)]
+            for name in names:
+                self.__sa_gtfs_session.execute(
+                    sqlalchemy.text(f'DROP INDEX IF EXISTS {gtfs_cls.__table__.schema}.{name}'))
+            self.__sa_gtfs_session.commit()
+            self.__logger.info(f"{gtfs_cls.__tablename__}: {len(names)} indexes dropped until the load is done")
+
+    def build_indexes(self):
+        """Create the indexes of the GTFS tables missing after a bulk load (drop_indexes)"""
+        for gtfs_cls in import_classes():
+            for index in gtfs_cls.__table__.indexes:
+                index.create(self.__sa_gtfs_session.connection(), checkfirst=True)
+            self.__sa_gtfs_session.commit()
+            self.__build_deferred_indexes(gtfs_cls)
+            self.__logger.info(f"{gtfs_cls.__tablename__}: indexes built")
 
     def validate_zip_file(self, input_zip):
         if 'stops.txt' not in input_zip.namelist():
             raise ErrorMissingStopFile
         if 'stop_times.txt' not in input_zip.namelist():
-            raise ErrorMissingStopFile
+            raise ErrorMissingStopsTimesFile
 
-    def __import_file(self, feed_id: int, input_zip: BytesIO):
-        zf = ZipFile(input_zip)
-        self.validate_zip_file(zf)
+    def __validate(self, stream: CSVStream, names: list, stats: FeedStats) -> FeedValidator:
+        """
+        Validate the feed files before any write, the quarantined rows are filtered out of the stream
+        :return: validator, its report is final once the feed is loaded, None when the validation is off
+        :raise ErrorInvalidFeed: feed rejected, nothing written
+        """
+        if self.__validation == FeedValidator.OFF:
+            return None
+        with stats.stage('validate'):
+            validator = FeedValidator(stream, names, [c for c in Base.__subclasses__() if c.filename is not None],
+                                      self.__validation, required_files=(Stop.filename, StopTime.filename))
+            validator.validate()
+        stream.row_filter = validator.valid_rows
+        return validator
+
+    def __prepare_file(self, gtfs_cls, feed_id: int, stream: CSVStream,
+                       patterns: TripPatterns) -> Iterator[PreparedBatch]:
+        """Yield GTFS file rows prepared for the loader, runs in a pipeline producer thread (no database access)"""
+        if gtfs_cls is Shape:
+            frames = self.__build_shapes(stream)
+        elif gtfs_cls is TripPattern:
+            frames = patterns.frames(self.__chunk_rows)
+        else:
+            frames = self.__file_frames(gtfs_cls, stream, patterns)
+        if self.__parquet is not None:
+            frames = self.__parquet.tee(gtfs_cls, feed_id, frames)
+        return self.__loader.prepare_frames(gtfs_cls, feed_id, frames)
+
+    def __prepare_snapshot(self, gtfs_cls, feed_id: int, snapshot: ParquetFeed) -> Iterator[PreparedBatch]:
+        """Yield the table rows of a feed Parquet snapshot prepared for the loader (pipeline producer)"""
+        return self.__loader.prepare_frames(gtfs_cls, feed_id, snapshot.frames(gtfs_cls, self.__chunk_rows))
+
+    def __write_file(self, gtfs_cls, stream: CSVStream, prepared: Iterator[PreparedBatch], table_name: str,
+                     stats: FeedStats) -> int:
+        """Write prepared GTFS file rows with the loader, return number of rows written"""
+        # tables built from other files (trip patterns) are reported by table name
+        file_name = gtfs_cls.filename or gtfs_cls.__tablename__
+        with stats.file(file_name, self.__loader) as file_stats:
+            file_stats.bytes = stream.size(gtfs_cls.filename) if gtfs_cls.filename else 0
+            self.__logger.info(f"Writing {file_name} , (size {file_stats.bytes:,} bytes)")
+            # parse time is the time the writer waits for the producer
+            file_stats.rows = self.__loader.load(gtfs_cls, stats.timed(prepared), table_name=table_name)
+            return file_stats.rows
+
+    def __checkpoint(self, feed_id: int, file_name: str, checksum: str, rows: int, feed_checksum: str):
+        """
+        Record file loaded (committed with the file rows, a restarted import skips it)
+        :param feed_checksum: checksum of the feed zip the file is loaded from
+        """
+        self.__sa_gtfs_session.query(FeedFile) \
+            .filter(FeedFile.feed_id == feed_id, FeedFile.file_name == file_name) \
+            .delete(synchronize_session=False)
+        self.__sa_gtfs_session.add(FeedFile(feed_id=feed_id, file_name=file_name, checksum=checksum, rows=rows,
+                                            feed_checksum=feed_checksum, import_dt=datetime.datetime.now()))
+
+    def __commit(self, feed_id: int = None):
+        """
+        Commit the session with the claims of the worker feeds renewed (claim_dt), the feeds claimed again by another
+        worker meanwhile (their claim went stale) are lost
+        :param feed_id: feed written by the transaction
+        :raise ErrorFeedClaimLost: the claim of feed_id is lost, the transaction must not be committed
+        """
+        now = datetime.datetime.now()
+        renewed = list()
+        for claimed_id, claim_dt in self.__claims.items():
+            if claim_dt is None:
+                continue
+            if self.__sa_gtfs_session.query(FeedImport) \
+                    .filter(FeedImport.feed_id == claimed_id, FeedImport.claim_dt == claim_dt) \
+                    .update({FeedImport.claim_dt: now}, synchronize_session=False):
+                renewed.append(claimed_id)
+            else:
+                self.__claims[claimed_id] = None
+        if feed_id in self.__claims and self.__claims[feed_id] is None:
+            raise ErrorFeedClaimLost(f'feed {feed_id} claimed again by another worker')
+        self.__sa_gtfs_session.commit()
+        # a rolled back renewal keeps the previous claim_dt
+        self.__claims.update((claimed_id, now) for claimed_id in renewed)
+
+    def __loaded_files(self, feed_id: int, checksums: dict, stored_files: dict, feed_checksum: str) -> set:
+        """Return the files already loaded (checkpoints) by an interrupted import of the same feed zip"""
+        if feed_checksum is None:
+            return set()
+        loaded = {name for name, f in stored_files.items()
+                  if f.feed_checksum == feed_checksum and f.checksum == checksums.get(name)}
+        # the staging tables of an interrupted import are kept until published or discarded
+        staged = {c.filename for c in Base.__subclasses__()
+                  if c.filename in loaded and self.__staging.is_staged(c, feed_id)}
+        if Trip.filename in staged and not self.__staging.is_staged(TripPattern, feed_id):
+            staged.discard(Trip.filename)
+        return staged
+
+    def __import_file(self, feed_id: int, zip_path: str, stats: FeedStats, feed_checksum: str = None) -> dict:
+        """
+        Load the feed zip, each file is committed with its checkpoint (FeedFile)
+        :param feed_checksum: checksum of the feed zip, files loaded by an interrupted import of the same zip are
+            skipped
+        :return: validation report
+        """
+        with FeedArchive(zip_path) as archive:
+            with stats.stage('unzip'):
+                self.validate_zip_file(archive.zip)
+            names = archive.names()
+            stream = CSVStream(archive.zip, chunk_rows=self.__chunk_rows, max_chunk_mb=self.__max_chunk_mb)
+            validator = self.__validate(stream, names, stats)
+            # StopTime is defined before Trip, trips patterns are built while loading stop_times
+            gtfs_classes = [c for c in Base.__subclasses__() if c.filename is not None]
+            checksums = {c.filename: archive.checksum(c.filename) for c in gtfs_classes if c.filename in names}
+            stored_files = {f.file_name: f for f in
+                            self.__sa_gtfs_session.query(FeedFile).filter(FeedFile.feed_id == feed_id)}
+
+            incremental = self.__incremental and bool(stored_files)
+            if incremental:
+                # incremental re-import, only files changed since the stored version are merged
+                loaded = {name for name, checksum in checksums.items()
+                          if name in stored_files and stored_files[name].checksum == checksum}
+            else:
+                loaded = self.__loaded_files(feed_id, checksums, stored_files, feed_checksum)
+            if StopTime.filename not in loaded:
+                # Trip.pattern_id is built from stop_times
+                loaded.discard(Trip.filename)
+            if loaded and not incremental:
+                self.__logger.info(f"resume feed {feed_id}, already loaded: {', '.join(sorted(loaded))}")
+
+            patterns = TripPatterns()
+            with BatchPipeline(workers=self.__parse_workers, queue_size=self.__pipeline_batches) as pipeline:
+                # files are parsed ahead of the writes, trips wait for the trips patterns built from stop_times
+                for gtfs_cls in gtfs_classes:
+                    if gtfs_cls.filename not in names:
+                        continue
+                    if gtfs_cls.filename in loaded:
+                        if gtfs_cls is StopTime and Trip.filename not in loaded:
+                            pipeline.submit(gtfs_cls.filename,
+                                            functools.partial(self.__file_frames, gtfs_cls, stream, patterns))
+                        continue
+                    pipeline.submit(gtfs_cls.filename,
+                                    functools.partial(self.__prepare_file, gtfs_cls, feed_id, stream, patterns),
+                                    after=StopTime.filename if gtfs_cls is Trip else None)
+                    if gtfs_cls is Trip:
+                        # the patterns are written with the trips
+                        pipeline.submit(TripPattern.__tablename__,
+                                        functools.partial(self.__prepare_file, TripPattern, feed_id, stream, patterns),
+                                        after=StopTime.filename)
+                staged_classes = self.__write_files(feed_id, stream, pipeline, gtfs_classes, names,
+                                                    incremental, loaded, checksums, stored_files, feed_checksum,
+                                                    stats)
+            report = validator.report() if validator is not None else None
+
+            if not incremental:
+                self.__publish(feed_id, staged_classes, names)
+            # the feed files records are the files of the imported zip
+            self.__sa_gtfs_session.query(FeedFile) \
+                .filter(FeedFile.feed_id == feed_id) \
+                .update({FeedFile.feed_checksum: feed_checksum}, synchronize_session=False)
+            self.__commit(feed_id)
+            if not incremental:
+                self.__staged_done(staged_classes)
+        if self.__parquet is not None:
+            tables = [c for c in gtfs_classes if c.filename in names]
+            self.__parquet.publish(feed_id, tables + [TripPattern] if Trip in tables else tables)
+        if self.__spatial_stage:
+            self.__spatial.build(feed_id)
+        return report
+
+    def __import_snapshot(self, snapshot: ParquetFeed, stats: FeedStats):
+        """Load the tables of a feed Parquet snapshot, files are committed with their checkpoints as from the zip"""
+        feed_id = snapshot.feed_id
+        feed_checksum = snapshot.records(FeedImport)[0]['feed_checksum']
         gtfs_classes = [c for c in Base.__subclasses__() if c.filename is not None]
+        names = [c.filename for c in gtfs_classes if snapshot.has(c)]
+        checksums = dict.fromkeys(names)
+        checksums.update((f['file_name'], f['checksum']) for f in snapshot.records(FeedFile)
+                         if f['file_name'] in names)
+        stats.bytes = sum(snapshot.size(name) for name in names)
+        stored_files = {f.file_name: f for f in
+                        self.__sa_gtfs_session.query(FeedFile).filter(FeedFile.feed_id == feed_id)}
+        with BatchPipeline(workers=self.__parse_workers, queue_size=self.__pipeline_batches) as pipeline:
+            for gtfs_cls in gtfs_classes:
+                if gtfs_cls.filename not in names:
+                    continue
+                pipeline.submit(gtfs_cls.filename,
+                                functools.partial(self.__prepare_snapshot, gtfs_cls, feed_id, snapshot))
+                if gtfs_cls is Trip:
+                    pipeline.submit(TripPattern.__tablename__,
+                                    functools.partial(self.__prepare_snapshot, TripPattern, feed_id, snapshot))
+            staged_classes = self.__write_files(feed_id, snapshot, pipeline, gtfs_classes, names, False, set(),
+                                                checksums, stored_files, feed_checksum, stats)
+        self.__publish(feed_id, staged_classes, names)
+        self.__sa_gtfs_session.commit()
+        self.__staged_done(staged_classes)
+        if self.__spatial_stage:
+            self.__spatial.build(feed_id)
+
+    def __write_files(self, feed_id: int, stream: CSVStream, pipeline: BatchPipeline, gtfs_classes: list,
+                      names: list, incremental: bool, loaded: set, checksums: dict, stored_files: dict,
+                      feed_checksum: str, stats: FeedStats) -> list:
+        """
+        Write the files prepared by the pipeline producers, in submit order, to the feed staging tables (published
+        by the caller), merged to the feed rows when incremental. Each file is committed with its checkpoint.
+        :return: GTFS classes written to staging tables
+        """
+        staged_classes = list()
         for gtfs_cls in gtfs_classes:
-            if gtfs_cls.filename not in zf.namelist():
+            # the trips patterns are written and replaced with the trips
+            tables = [gtfs_cls, TripPattern] if gtfs_cls is Trip else [gtfs_cls]
+            if gtfs_cls.filename not in names:
                 self.__logger.warning(f"{gtfs_cls.filename} not exists")
+                if incremental and gtfs_cls.filename in stored_files:
+                    # file removed from the new version, else its rows are removed by the publish
+                    for table_cls in tables:
+                        self.__merge.delete(table_cls, feed_id)
+                    self.__sa_gtfs_session.query(FeedFile) \
+                        .filter(FeedFile.feed_id == feed_id, FeedFile.file_name == gtfs_cls.filename) \
+                        .delete(synchronize_session=False)
+                    self.__commit(feed_id)
                 continue
 
-            # generate dataframe with trip_stops
-            if gtfs_cls is Trip:
-                stops_df = GTFSImport.__generate_trip_stops(zf)
-
-            data = io.StringIO(zf.read(gtfs_cls.filename).decode())
-            # read shape file
-            if gtfs_cls is Shape:
-                shapes = GTFSImport.__build_shapes(data)
-                for shape_id in shapes:
-                    shp = Shape(feed_id=feed_id, shape_id=shape_id, shape=from_shape(shapes[shape_id]))
-                    self.__sa_gtfs_session.add(shp)
-                self.__sa_gtfs_session.commit()
-                self.__logger.info("Insert {}".format(gtfs_cls.filename))
-            # read csv data files
-            else:
-                reader = csv.DictReader(data)
-                reader = list(reader)
-                obj_collection = list()
-                buffer_size = 10000
-                buffer_idx = 0
-                csv_lines = len(reader)
-                self.__logger.info("Writing {} , (num rows {})".format(gtfs_cls.filename, csv_lines))
-                for i, row in enumerate(reader):
-                    if gtfs_cls is Trip:
-                        try:
-                            trip_id = int(row['trip_id'])
-                        except ValueError:
-                            trip_id = row['trip_id']
-
-                        if trip_id in stops_df.index:
-                            row['stops'] = map(str, stops_df[trip_id])
-                        else:
-                            continue
-                    obj = gtfs_cls.dict2Obj(row)
-                    obj.feed_id = feed_id
-                    obj_collection.append(obj)
-                    if buffer_idx > buffer_size:
-                        self.__sa_gtfs_session.bulk_save_objects(obj_collection)
-                        self.__sa_gtfs_session.commit()
-                        buffer_idx = 0
-                    buffer_idx += 1
-
-                    sys.stdout.write("\r%d%%" % ((float(i)/csv_lines)*100))
-                    sys.stdout.flush()
-                self.__sa_gtfs_session.bulk_save_objects(obj_collection)
-                self.__sa_gtfs_session.commit()
-                self.__logger.info("Done insert {}".format(gtfs_cls.filename))
-
-    def __download_data(self, url: str):
-        # get content from url
-        self.__logger.debug(f'downloading from url: {url}')
-        o = urlparse(url)
-        if o.scheme in ['http', 'https']:
-            request = requests.get(url)
-            data_content = request.content
-        # get content from ftp
-        elif o.scheme == 'ftp':
-
-            ftp = FTP(o.netloc)
-            ftp.login()
-            r = io.StringIO()
-            ftp.retrbinary('RETR ' + o.path, r.write)
-
-            data_content = r.getvalue()
+            if gtfs_cls.filename in loaded:
+                self.__logger.info(f"{gtfs_cls.filename} {'unchanged' if incremental else 'already loaded'}")
+                if gtfs_cls is StopTime and Trip.filename not in loaded:
+                    # trips are written, their patterns are built without writing stop_times
+                    for _ in pipeline.items(gtfs_cls.filename):
+                        pass
+                if not incremental:
+                    staged_classes.extend(tables)
+                continue
+
+            counts = list()
+            for table_cls in tables:
+                prepared = pipeline.items(table_cls.filename or table_cls.__tablename__)
+                counts.append(self.__write_table(table_cls, feed_id, stream, prepared, incremental, staged_classes,
+                                                 stats))
+            self.__checkpoint(feed_id, gtfs_cls.filename, checksums[gtfs_cls.filename], counts[0], feed_checksum)
+            self.__commit(feed_id)
+            for table_cls, count in zip(tables, counts):
+                self.__table_done(table_cls, count)
+        return staged_classes
+
+    def __write_table(self, gtfs_cls, feed_id: int, stream: CSVStream, prepared: Iterator[PreparedBatch],
+                      incremental: bool, staged_classes: list, stats: FeedStats) -> int:
+        """
+        Write prepared rows of gtfs_cls merged to the feed rows when incremental, else to the feed staging table
+        (gtfs_cls is added to staged_classes). Return number of rows written
+        """
+        # incremental, write to a temporary table merged to the feed rows
+        if incremental:
+            table_name = self.__merge.stage(gtfs_cls)
         else:
-            raise ErrorUnknownFeedSource(f'feed url: {url}')
+            table_name = self.__staging.stage(gtfs_cls, feed_id)
+            staged_classes.append(gtfs_cls)
+
+        count = self.__write_file(gtfs_cls, stream, prepared, table_name, stats)
+        if incremental:
+            inserted, updated, deleted = self.__merge.merge(gtfs_cls, feed_id)
+            self.__logger.info(f"Merge {gtfs_cls.filename or gtfs_cls.__tablename__} "
+                               f"(inserted {inserted}, updated {updated}, deleted {deleted})")
+        return count
+
+    def __publish(self, feed_id: int, staged_classes: list, names: list):
+        """Publish the staged tables of the feed, the files records of the files removed from the feed are removed"""
+        self.__staging.publish(feed_id, staged_classes)
+        self.__sa_gtfs_session.query(FeedFile) \
+            .filter(FeedFile.feed_id == feed_id, FeedFile.file_name.notin_(names)) \
+            .delete(synchronize_session=False)
 
-        return data_content
+    def __staged_done(self, staged_classes: list):
+        """Build the deferred indexes of the published tables, missing until their first load (not partitioned)"""
+        if self.__partitions is None and not self.__defer_indexes:
+            for gtfs_cls in staged_classes:
+                self.__build_deferred_indexes(gtfs_cls)
+
+    def __table_done(self, gtfs_cls, count: int):
+        self.__logger.info(f"Done insert {gtfs_cls.filename or gtfs_cls.__tablename__} "
+                           f"({count} rows, {self.__loader.name} loader)")
+
+    def import_zip(self, feed_id: int, zip_path: str) -> FeedStats:
+        """Import a local feed zip as feed_id, return the import stats"""
+        stats = self.__stats.start(feed_id)
+        stats.bytes = os.path.getsize(zip_path)
+        status = FeedImport.ERROR
+        try:
+            self.__import_file(feed_id, zip_path, stats)
+            status = FeedImport.DONE
+        finally:
+            self.__stats.finish(stats, status)
+        return stats
 
     def update_feed_sources(self):
         """
@@ -155,41 +529,245 @@ class GTFSImport(object):
         """
         GTFSSources(self.__sa_gtfs_session).update_feed_sources()
 
-    def import_sources(self, offset_v: int = None, limit_v: int = None):
+    def __interrupted(self, feed: FeedImport) -> str:
         """
-        Download data source and update database.
-        :param offset_v: rows offset (table: gtfs_feed_import)
-        :param limit_v: rows limit (table: gtfs_feed_import)
-        :return:
+        Return the checksum of the zip of an interrupted import of the feed (files loaded from another zip than the
+        feed one), None when not interrupted
         """
-        # Fetch feeds info
-        feeds = self.__sa_gtfs_session.query(FeedImport) \
-            .filter(FeedImport.done == 0) \
-            .order_by(FeedImport.feed_id)
+        query = self.__sa_gtfs_session.query(FeedFile.feed_checksum) \
+            .filter(FeedFile.feed_id == feed.feed_id) \
+            .filter(FeedFile.feed_checksum.isnot(None))
+        if feed.feed_checksum is not None:
+            query = query.filter(FeedFile.feed_checksum != feed.feed_checksum)
+        row = query.first()
+        return row.feed_checksum if row is not None else None
 
-        if offset_v:
-            feeds = feeds.offset(offset_v)
-
-        if limit_v:
-            feeds = feeds.limit(limit_v)
+    def __download_items(self, feeds: Iterable[FeedImport]) -> Iterator[tuple]:
+        """
+        Yield downloader items (feed, url, etag, last_modified, checksum), validators are the feed ones (last import).
+        An interrupted import is resumed from the zip it was loading when cached, else from a full download (no
+        validators).
+        """
+        for feed in feeds:
+            interrupted = self.__interrupted(feed)
+            if interrupted is not None:
+                yield feed, feed.feed_url, None, None, interrupted
+            else:
+                yield feed, feed.feed_url, feed.etag, feed.last_modified, None
 
-        feeds = feeds.all()
+    def __mark_unchanged(self, feed: FeedImport, result: DownloadResult):
+        """Mark feed up to date, the GTFS tables and the feed version (checksum, size) are not touched"""
+        feed.etag = result.etag
+        feed.last_modified = result.last_modified
+        feed.done = FeedImport.UNCHANGED
+        self.__commit(feed.feed_id)
+        self.__logger.info(f"unchanged {feed.feed_url}")
 
-        for feed in feeds:
+    def __import_feed(self, feed: FeedImport, download: Future):
+        """
+        Load downloaded feed, feed status (done) is set to DONE, UNCHANGED or ERROR (or stays RUNNING, see
+        __import_error). A feed claimed again by another worker meanwhile is left to it.
+        """
+        result = None
+        stats = self.__stats.start(feed.feed_id)
+        try:
+            with stats.stage('download'):
+                # time waited on the prefetched download
+                result = download.result()
+            # claimed when prefetched, the claim is renewed once the feed is dequeued
+            self.__commit(feed.feed_id)
+            stats.download_s = max(stats.download_s, result.elapsed)
+            stats.bytes = result.size
+            feed.download_dt = datetime.datetime.now()
+            if result.not_modified:
+                self.__mark_unchanged(feed, result)
+                return
+            # the feed row is the only one of its url, its checksum is the one of its last successful import
+            if result.checksum == feed.feed_checksum and self.__interrupted(feed) is None:
+                self.__mark_unchanged(feed, result)
+                return
+            report = self.__import_file(feed.feed_id, result.path, stats, result.checksum)
+            # the feed version is recorded once all its files are loaded, with the rows left out by the validation
+            feed.error = json.dumps(report) if report is not None and report['errors'] else None
+            feed.feed_size_kb = result.size/1024
+            feed.feed_checksum = result.checksum
+            feed.etag = result.etag
+            feed.last_modified = result.last_modified
+            feed.done = FeedImport.DONE
+            self.__commit(feed.feed_id)
+            if self.__parquet is not None:
+                self.__parquet.write_records(feed, self.__sa_gtfs_session.query(FeedFile)
+                                             .filter(FeedFile.feed_id == feed.feed_id).all())
+            self.__logger.info(f"store {feed.feed_url}")
+        except ErrorFeedClaimLost as e:
+            self.__claim_lost(e)
+        except Exception as e:
+            self.__sa_gtfs_session.rollback()
+            self.__logger.error(f"store {feed.feed_url}")
+            self.__logger.error(traceback.format_exc())
             try:
-                content = self.__download_data(feed.feed_url)
-                with BytesIO(content) as zip_data_f:
-                    feed.feed_size_kb = sys.getsizeof(zip_data_f)/1024
-                    feed.feed_checksum = hashlib.md5(zip_data_f.read()).hexdigest()
-                    feed.download_dt = datetime.datetime.now()
-                    self.__import_file(feed.feed_id, zip_data_f)
-                    feed.done = 1
-                    self.__sa_gtfs_session.commit()
-                    self.__logger.info(f"store {feed.feed_url}")
-            except Exception as e:
+                self.__import_error(feed, result, e)
+            except ErrorFeedClaimLost as lost:
+                self.__claim_lost(lost)
+            except Exception:
+                # the error is not recorded, the feed stays RUNNING and is claimed again once its claim is stale
                 self.__sa_gtfs_session.rollback()
-                feed.error = str(e)
-                feed.done = 2
+                self.__logger.error(f"record error of feed {feed.feed_id}")
+                self.__logger.error(traceback.format_exc())
+        finally:
+            self.__claims.pop(feed.feed_id, None)
+            if result is not None:
+                FeedDownloader.remove(result)
+            self.__stats.finish(stats, feed.done)
+
+    def __claim_lost(self, error: ErrorFeedClaimLost):
+        """Abort the import of a feed claimed again by another worker, its staging and checkpoints are left to it"""
+        self.__sa_gtfs_session.rollback()
+        self.__logger.warning(f"{error}, import aborted")
+
+    def __replaced(self, feed: FeedImport, result: DownloadResult) -> bool:
+        """Return True when files of the downloaded version already replaced the feed ones (checkpoints)"""
+        if result is None or result.checksum == feed.feed_checksum:
+            return False
+        return self.__sa_gtfs_session.query(FeedFile.id) \
+            .filter(FeedFile.feed_id == feed.feed_id, FeedFile.feed_checksum == result.checksum) \
+            .first() is not None
+
+    def __import_error(self, feed: FeedImport, result: DownloadResult, error: Exception):
+        """
+        Record the failed import of feed, its staging is dropped. An incremental import whose files were already
+        merged stays RUNNING: it is resumed from its checkpoints once its claim is stale (at most max_resumes times),
+        rather than left as a mix of both versions.
+        """
+        # still claimed by the worker, before its staging is dropped
+        self.__commit(feed.feed_id)
+        if self.__parquet is not None:
+            self.__parquet.discard(feed.feed_id)
+        staged = self.__staging.discard(feed.feed_id)
+        if staged and result is not None:
+            # the staged files are dropped, so are their checkpoints
+            self.__sa_gtfs_session.query(FeedFile) \
+                .filter(FeedFile.feed_id == feed.feed_id, FeedFile.feed_checksum == result.checksum) \
+                .delete(synchronize_session=False)
+        feed.error = str(error)
+        if not staged and self.__replaced(feed, result):
+            self.__logger.warning(f"feed {feed.feed_id} partly replaced, resumed in {self.__stale_claim_minutes:g}m")
+        else:
+            feed.done = FeedImport.ERROR
+        self.__commit(feed.feed_id)
+
+    def import_sources(self, offset_v: int = None, limit_v: int = None) -> int:
+        """
+        Download data source and update database, the feeds are claimed as by the queue workers (import_queue)
+        :param offset_v: pending feeds skipped (table: gtfs_feed_import, by feed_id)
+        :param limit_v: max feeds to import
+        :return: number of feeds processed
+        """
+        return self.import_queue(int(limit_v) if limit_v else None, int(offset_v) if offset_v else None)
+
+    def import_parquet(self, offset_v: int = None, limit_v: int = None) -> int:
+        """
+        Reload the feeds of the Parquet staging (parquet_dir) without downloading nor parsing them: the feed record
+        is restored (or updated) and the feed tables are bulk-loaded from their Parquet files.
+        :param offset_v: feeds offset (by feed_id)
+        :param limit_v: feeds limit
+        :return: number of feeds loaded
+        """
+        if self.__parquet is None:
+            raise ErrorParquetUnavailable('import_parquet requires parquet_dir')
+        feed_ids = self.__parquet.feed_ids()[int(offset_v or 0):]
+        if limit_v:
+            feed_ids = feed_ids[:int(limit_v)]
+        count = 0
+        for feed_id in feed_ids:
+            snapshot = self.__parquet.feed(feed_id)
+            stats = self.__stats.start(feed_id)
+            status = FeedImport.ERROR
+            try:
+                feed = self.__sa_gtfs_session.merge(FeedImport(**snapshot.records(FeedImport)[0]))
                 self.__sa_gtfs_session.commit()
-                self.__logger.error(f"store {feed.feed_url}")
+                self.__import_snapshot(snapshot, stats)
+                feed.done = status = FeedImport.DONE
+                self.__sa_gtfs_session.commit()
+                count += 1
+                self.__logger.info(f"reload {feed.feed_url} from {self.__parquet.root_dir}")
+            except Exception:
+                self.__sa_gtfs_session.rollback()
+                self.__staging.discard(feed_id)
+                self.__logger.error(f"reload feed {feed_id}")
                 self.__logger.error(traceback.format_exc())
+            finally:
+                self.__stats.finish(stats, status)
+        # feed records restored with their feed_id, the next sources get new ids
+        table = FeedImport.__table__.fullname
+        self.__sa_gtfs_session.execute(sqlalchemy.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'feed_id'), "
+            f"(SELECT coalesce(max(feed_id), 1) FROM {table}))"))
+        self.__sa_gtfs_session.commit()
+        return count
+
+    def claim_feed(self, offset_v: int = None) -> FeedImport:
+        """
+        Claim the next pending feed (SELECT ... FOR UPDATE SKIP LOCKED) and mark it RUNNING.
+        Safe to call from many processes / machines draining the same gtfs_feed_import queue.
+        A RUNNING feed whose claim is stale (its worker died) is claimed again, at most max_resumes times in a row,
+        then it is marked ERROR.
+        :param offset_v: claimable feeds skipped (by feed_id)
+        :return: claimed feed or None when the queue is empty
+        """
+        now = datetime.datetime.now()
+        stale_dt = now - datetime.timedelta(minutes=self.__stale_claim_minutes)
+        stale = sqlalchemy.and_(FeedImport.done == FeedImport.RUNNING,
+                                sqlalchemy.or_(FeedImport.claim_dt.is_(None), FeedImport.claim_dt < stale_dt))
+        while True:
+            feed = self.__sa_gtfs_session.query(FeedImport) \
+                .filter(sqlalchemy.or_(FeedImport.done == FeedImport.PENDING, stale)) \
+                .order_by(FeedImport.feed_id) \
+                .with_for_update(skip_locked=True) \
+                .offset(offset_v) \
+                .limit(1) \
+                .first()
+            if feed is None or feed.done == FeedImport.PENDING:
+                break
+            if (feed.resumes or 0) < self.__max_resumes:
+                feed.resumes = (feed.resumes or 0) + 1
+                self.__logger.warning(f"stale claim of feed {feed.feed_id} (since {feed.claim_dt}), claimed again "
+                                      f"({feed.resumes}/{self.__max_resumes})")
+                break
+            self.__logger.error(f"feed {feed.feed_id} not resumed, claim went stale {feed.resumes + 1} times")
+            feed.done = FeedImport.ERROR
+            feed.error = f"import abandoned after {feed.resumes} resumes" + (f": {feed.error}" if feed.error else "")
+            self.__sa_gtfs_session.commit()
+        if feed is not None:
+            if feed.done == FeedImport.PENDING:
+                feed.resumes = 0
+            feed.done = FeedImport.RUNNING
+            feed.claim_dt = now
+        self.__sa_gtfs_session.commit()
+        if feed is not None:
+            self.__claims[feed.feed_id] = now
+        return feed
+
+    def __claim_feeds(self, limit_v: int = None, offset_v: int = None) -> Iterator[FeedImport]:
+        """Yield claimed feeds until the queue is empty"""
+        count = 0
+        while limit_v is None or count < limit_v:
+            feed = self.claim_feed(offset_v)
+            if feed is None:
+                break
+            yield feed
+            count += 1
+
+    def import_queue(self, limit_v: int = None, offset_v: int = None) -> int:
+        """
+        Claim pending feeds one by one and import them, until the queue is empty
+        :param limit_v: max feeds to import
+        :param offset_v: claimable feeds left to the other workers (by feed_id), single worker only
+        :return: number of feeds processed
+        """
+        count = 0
+        feeds = self.__claim_feeds(limit_v, offset_v)
+        for feed, download in self.__downloader.prefetch(self.__download_items(feeds)):
+            self.__import_feed(feed, download)
+            count += 1
+        return count
@@ -0,0 +1,180 @@
+import io
+import logging
+from typing import Iterable, Iterator
+
+import pandas as pd
+import sqlalchemy
+from geoalchemy2 import Geometry
+from geoalchemy2.elements import WKBElement
+from sqlalchemy.types import ARRAY
+
+
+class ErrorUnknownLoader(Exception):
+    pass
+
+
+class ErrorLoaderTarget(Exception):
+    pass
+
+
+class PreparedBatch:
+    """Batch of rows converted for a loader (COPY data, ORM objects or mappings), its len is the number of rows"""
+    __slots__ = ('rows', 'data')
+
+    def __init__(self, rows: int, data):
+        self.rows = rows
+        self.data = data
+
+    def __len__(self):
+        return self.rows
+
+
+class ORMLoader:
+    """
+    Fallback loader, insert each batch as mappings with Session.bulk_insert_mappings.
+    Writes are split in prepare (frames to mappings, no database access, may run in another thread) and load.
+    """
+    name = 'orm'
+    # statements run through the session, counted by the engine events
+    round_trips = 0
+
+    def __init__(self, sa_session):
+        self.__sa_gtfs_session = sa_session
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def prepare_frames(gtfs_cls, feed_id: int, frames: Iterable[pd.DataFrame]) -> Iterator[PreparedBatch]:
+        """Yield typed DataFrames of gtfs_cls (columns named as the table columns) as mappings"""
+        geometries = [c.name for c in gtfs_cls.__table__.columns if isinstance(c.type, Geometry)]
+        for frame in frames:
+            frame = frame.astype(object).where(frame.notna(), None)
+            frame['feed_id'] = feed_id
+            # hex WKB, bound as geometry by the column type
+            for name in geometries:
+                if name in frame:
+                    frame[name] = frame[name].map(WKBElement, na_action='ignore')
+            yield PreparedBatch(len(frame), frame.to_dict('records'))
+
+    def load(self, gtfs_cls, prepared: Iterable[PreparedBatch], table_name: str = None) -> int:
+        """
+        Insert prepared batches, return number of rows written
+        :param table_name: target table (schema.name) with the columns of the gtfs_cls table, eg: staging table,
+            default: gtfs_cls table
+        """
+        table = None
+        if table_name is not None:
+            schema, name = table_name.split('.')
+            # the column types bind the values as the model does (geometries)
+            table = gtfs_cls.__table__.to_metadata(sqlalchemy.MetaData(), schema=schema, name=name)
+        count = 0
+        for batch in prepared:
+            if table is None:
+                self.__sa_gtfs_session.bulk_insert_mappings(gtfs_cls, batch.data)
+            elif batch.data:
+                self.__sa_gtfs_session.execute(table.insert(), batch.data)
+            count += batch.rows
+        return count
+
+
+class _LineStream(io.TextIOBase):
+    """Read only file object over an iterator of text chunks, used as COPY input without materializing the data"""
+
+    def __init__(self, lines: Iterator[str]):
+        self.__lines = lines
+        self.__buffer = ''
+        self.__pos = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.__buffer[self.__pos:] + ''.join(self.__lines)
+            self.__buffer, self.__pos = '', 0
+            return data
+        # chunks may be large (a whole batch), read by offset rather than copying the rest of the chunk
+        while len(self.__buffer) - self.__pos < size:
+            line = next(self.__lines, None)
+            if line is None:
+                break
+            self.__buffer = self.__buffer[self.__pos:] + line
+            self.__pos = 0
+        data = self.__buffer[self.__pos:self.__pos + size]
+        self.__pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class CopyLoader:
+    """
+    Stream rows straight into postgres with COPY ... FROM STDIN (csv format).
+    Writes are split in prepare (frames to COPY data, no database access, may run in another thread) and load.
+    """
+    name = 'copy'
+
+    # bytes sent to the server per copy_expert read
+    COPY_BUFFER_SIZE = 1024 * 1024
+    __ARRAY_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
+    def __init__(self, sa_session):
+        self.__sa_gtfs_session = sa_session
+        self.round_trips = 0
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def copy_columns(gtfs_cls) -> list:
+        """Return table columns filled by COPY (the serial primary key is left to the database)"""
+        return [c for c in gtfs_cls.__table__.columns if not c.primary_key]
+
+    @staticmethod
+    def format_array(values) -> str:
+        """Return list as postgres array literal"""
+        return '{' + ','.join('"{}"'.format(str(v).translate(CopyLoader.__ARRAY_ESCAPE)) for v in values) + '}'
+
+    @staticmethod
+    def prepare_frames(gtfs_cls, feed_id: int, frames: Iterable[pd.DataFrame]) -> Iterator[PreparedBatch]:
+        """Yield typed DataFrames of gtfs_cls (columns named as the table columns) as COPY csv format data"""
+        columns = [c.name for c in CopyLoader.copy_columns(gtfs_cls)]
+        arrays = [c.name for c in CopyLoader.copy_columns(gtfs_cls) if isinstance(c.type, ARRAY)]
+        for frame in frames:
+            frame = frame.reindex(columns=columns)
+            frame['feed_id'] = feed_id
+            for name in arrays:
+                frame[name] = frame[name].map(CopyLoader.format_array, na_action='ignore')
+            # lines end with CRLF, so csv quotes values holding a CR as well as a LF
+            yield PreparedBatch(len(frame), frame.to_csv(header=False, index=False, lineterminator='\r\n'))
+
+    def load(self, gtfs_cls, prepared: Iterable[PreparedBatch], table_name: str = None) -> int:
+        """
+        Copy prepared batches (csv format) in a single COPY, return number of rows written
+        :param table_name: target table, default: gtfs_cls table
+        """
+        columns = ', '.join(c.name for c in self.copy_columns(gtfs_cls))
+        sql = f"COPY {table_name or gtfs_cls.__table__.fullname} ({columns}) FROM STDIN WITH (FORMAT csv)"
+        counter = [0]
+
+        def chunks():
+            for batch in prepared:
+                counter[0] += batch.rows
+                yield batch.data
+
+        dbapi_con = self.__sa_gtfs_session.connection().connection
+        with dbapi_con.cursor() as cursor:
+            cursor.copy_expert(sql, _LineStream(chunks()), size=self.COPY_BUFFER_SIZE)
+        self.round_trips += 1
+        return counter[0]
+
+
+LOADERS = {
+    CopyLoader.name: CopyLoader,
+    ORMLoader.name: ORMLoader,
+}
+
+
+def get_loader(name: str, sa_session):
+    """Return loader engine instance by name"""
+    if name not in LOADERS:
+        raise ErrorUnknownLoader(f'loader: {name}, expected one of {list(LOADERS)}')
+    return LOADERS[name](sa_session)
@@ -0,0 +1,81 @@
+import logging
+
+import sqlalchemy
+
+
+class GTFSMerge:
+    """
+    Apply a new version of a feed file to the stored rows of the feed.
+    The new rows are copied to a temporary staging table and merged by the model natural_key (null keys match
+    null keys, rows repeating a key are kept once, the last one of the file): rows missing from the new version
+    are deleted, rows whose content hash (md5 of the row text) differs are updated and new keys are
+    inserted. Unchanged rows are not written. Models without natural_key are replaced.
+    """
+
+    def __init__(self, sa_session):
+        self.__sa_gtfs_session = sa_session
+        self.__logger = logging.getLogger(__name__)
+
+    def __execute(self, sql: str, feed_id: int) -> int:
+        return self.__sa_gtfs_session.execute(sqlalchemy.text(sql), {'feed_id': feed_id}).rowcount
+
+    @staticmethod
+    def __key_match(gtfs_cls, key: str) -> str:
+        """Condition matching the key of stored (t) and new (s) rows, nullable keys with IS NOT DISTINCT FROM"""
+        if gtfs_cls.__table__.c[key].nullable:
+            return f't.{key} IS NOT DISTINCT FROM s.{key}'
+        # equality keeps hash joins on NOT NULL keys
+        return f't.{key} = s.{key}'
+
+    @staticmethod
+    def stage_name(gtfs_cls) -> str:
+        return f'{gtfs_cls.__tablename__}_merge'
+
+    def stage(self, gtfs_cls) -> str:
+        """Create the temporary staging table (dropped on commit), return its name"""
+        stage = self.stage_name(gtfs_cls)
+        self.__sa_gtfs_session.execute(sqlalchemy.text(
+            f'CREATE TEMPORARY TABLE {stage} (LIKE {gtfs_cls.__table__.fullname} INCLUDING DEFAULTS) '
+            f'ON COMMIT DROP'))
+        return stage
+
+    def merge(self, gtfs_cls, feed_id: int) -> tuple:
+        """Merge the staging table into the feed rows, return (inserted, updated, deleted)"""
+        target = gtfs_cls.__table__.fullname
+        stage = self.stage_name(gtfs_cls)
+        columns = [c.name for c in gtfs_cls.__table__.columns if not c.primary_key and c.name != 'feed_id']
+        self.__sa_gtfs_session.execute(sqlalchemy.text(f'ANALYZE {stage}'))
+
+        if not gtfs_cls.natural_key:
+            deleted = self.__execute(f'DELETE FROM {target} WHERE feed_id = :feed_id', feed_id)
+            inserted = self.__execute(
+                f"INSERT INTO {target} (feed_id, {', '.join(columns)}) "
+                f"SELECT feed_id, {', '.join(columns)} FROM {stage}", feed_id)
+            return inserted, 0, deleted
+
+        keys = ', '.join(gtfs_cls.natural_key)
+        duplicates = self.__execute(
+            f"DELETE FROM {stage} WHERE ctid IN (SELECT ctid FROM ("
+            f"SELECT ctid, row_number() OVER (PARTITION BY {keys} ORDER BY ctid DESC) AS n FROM {stage}) d "
+            f"WHERE n > 1)", feed_id)
+        if duplicates:
+            self.__logger.warning(f"{gtfs_cls.__tablename__}: {duplicates:,} rows repeating a key ({keys}) "
+                                  f"of the feed {feed_id} skipped")
+        key_match = ' AND '.join(self.__key_match(gtfs_cls, k) for k in gtfs_cls.natural_key)
+        t_hash = f"md5(ROW({', '.join('t.' + c for c in columns)})::text)"
+        s_hash = f"md5(ROW({', '.join('s.' + c for c in columns)})::text)"
+        deleted = self.__execute(
+            f'DELETE FROM {target} t WHERE t.feed_id = :feed_id '
+            f'AND NOT EXISTS (SELECT 1 FROM {stage} s WHERE {key_match})', feed_id)
+        updated = self.__execute(
+            f"UPDATE {target} t SET {', '.join(f'{c} = s.{c}' for c in columns)} FROM {stage} s "
+            f"WHERE t.feed_id = :feed_id AND {key_match} AND {t_hash} <> {s_hash}", feed_id)
+        inserted = self.__execute(
+            f"INSERT INTO {target} (feed_id, {', '.join(columns)}) "
+            f"SELECT s.feed_id, {', '.join('s.' + c for c in columns)} FROM {stage} s "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {target} t WHERE t.feed_id = :feed_id AND {key_match})", feed_id)
+        return inserted, updated, deleted
+
+    def delete(self, gtfs_cls, feed_id: int) -> int:
+        """Delete the feed rows of gtfs_cls, return number of rows deleted"""
+        return self.__execute(f'DELETE FROM {gtfs_cls.__table__.fullname} WHERE feed_id = :feed_id', feed_id)
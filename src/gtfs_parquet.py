@@ -0,0 +1,242 @@
+import glob
+import logging
+import os
+import shutil
+import threading
+from typing import Iterator
+
+import pandas as pd
+from geoalchemy2 import Geography, Geometry
+from sqlalchemy.types import ARRAY, Boolean, Date, DateTime, Float, Integer
+
+from gtfs import FeedFile, FeedImport
+
+
+class ErrorParquetUnavailable(Exception):
+    pass
+
+
+def _arrow():
+    """Return (pyarrow, pyarrow.parquet), optional dependency imported when a parquet store is used"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ErrorParquetUnavailable('the parquet stage requires pyarrow (pip install gtfs_import[parquet])') from e
+    return pyarrow, pyarrow.parquet
+
+
+class ParquetFeed:
+    """Parquet snapshot of a feed, read with memory-mapped Arrow reads, used as the file source of a reload"""
+
+    def __init__(self, store, feed_id: int):
+        self.__store = store
+        self.feed_id = feed_id
+
+    def __path(self, gtfs_cls) -> str:
+        return os.path.join(self.__store.partition_path(gtfs_cls, self.feed_id), ParquetStore.PART)
+
+    def has(self, gtfs_cls) -> bool:
+        return os.path.exists(self.__path(gtfs_cls))
+
+    def size(self, filename: str) -> int:
+        """Return size (bytes) of the parquet file of the GTFS file"""
+        gtfs_cls = [c for c in self.__store.gtfs_classes if c.filename == filename][0]
+        return os.path.getsize(self.__path(gtfs_cls))
+
+    def frames(self, gtfs_cls, chunk_rows: int = 50000) -> Iterator[pd.DataFrame]:
+        """Yield typed frames of the table columns, chunk_rows rows per frame"""
+        if not self.has(gtfs_cls):
+            return
+        parquet_file = self.__store.pq.ParquetFile(self.__path(gtfs_cls), memory_map=True)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows):
+            yield self.__store.from_arrow(gtfs_cls, batch)
+
+    def records(self, gtfs_cls) -> list:
+        """Return rows of gtfs_cls (feed record and files records) as dicts, feed_id from the partition"""
+        frame = pd.concat(list(self.frames(gtfs_cls)) or [pd.DataFrame()])
+        frame['feed_id'] = self.feed_id
+        frame = frame.astype(object).where(frame.notna(), None)
+        return frame.to_dict('records')
+
+
+class ParquetStore:
+    """
+    Columnar staging of the parsed feeds: the typed frames of each GTFS table are written as Parquet while the feed
+    is loaded, next to the feed record (gtfs_feed_import) and its files records (gtfs_feed_files). A reload of the
+    database (schema change, new replica) reads them back instead of downloading and parsing the CSV files.
+    One dataset per table, partitioned by feed_id (hive layout: <table>/feed_id=<feed_id>/part-0.parquet),
+    geometries stored as WKB, the directory can be read as is by Arrow / DuckDB / Spark.
+    A feed table is written to a hidden directory and swapped in once the feed is loaded, the tables of the
+    files that were not parsed again (unchanged, already loaded) are kept. The staging does not fail an import: a
+    feed whose tables could not be written is removed from the staging (a reload skips it).
+    """
+    PART = 'part-0.parquet'
+
+    def __init__(self, root_dir: str, gtfs_classes: list):
+        """
+        :param root_dir: datasets directory
+        :param gtfs_classes: GTFS models of the datasets (loaded by an import)
+        """
+        self.pa, self.pq = _arrow()
+        self.root_dir = root_dir
+        self.gtfs_classes = gtfs_classes
+        self.__written = dict()
+        self.__failed = set()
+        self.__lock = threading.Lock()
+        self.__logger = logging.getLogger(__name__)
+        os.makedirs(root_dir, exist_ok=True)
+
+    def partition_path(self, gtfs_cls, feed_id: int, hidden: bool = False) -> str:
+        name = f'feed_id={feed_id}'
+        # hidden directories ('.' prefix) are not part of the dataset
+        return os.path.join(self.root_dir, gtfs_cls.__tablename__, f'.{name}.tmp' if hidden else name)
+
+    def __type(self, gtfs_cls, column):
+        pa = self.pa
+        if column.name in getattr(gtfs_cls, 'point_columns', dict()):
+            # points as parsed, EWKT
+            return pa.string()
+        if isinstance(column.type, (Geometry, Geography)):
+            return pa.binary()
+        if isinstance(column.type, ARRAY):
+            return pa.list_(pa.string())
+        if isinstance(column.type, Boolean):
+            return pa.bool_()
+        if isinstance(column.type, Integer):
+            return pa.int64()
+        if isinstance(column.type, Float):
+            return pa.float64()
+        if isinstance(column.type, DateTime):
+            return pa.timestamp('us')
+        if isinstance(column.type, Date):
+            return pa.date32()
+        return pa.string()
+
+    def __schema(self, gtfs_cls, names: list):
+        columns = gtfs_cls.__table__.columns
+        return self.pa.schema([(name, self.__type(gtfs_cls, columns[name])) for name in names])
+
+    def to_arrow(self, gtfs_cls, frame: pd.DataFrame):
+        """Return typed frame of gtfs_cls as Arrow table, hex WKB as binary and dates as date32"""
+        frame = frame[[name for name in frame.columns if name in gtfs_cls.__table__.columns]].copy()
+        schema = self.__schema(gtfs_cls, list(frame.columns))
+        for field in schema:
+            if field.type == self.pa.binary():
+                frame[field.name] = frame[field.name].map(bytes.fromhex, na_action='ignore')
+            elif field.type == self.pa.date32():
+                frame[field.name] = pd.to_datetime(frame[field.name]).dt.date.where(frame[field.name].notna(), None)
+        return self.pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+    def from_arrow(self, gtfs_cls, table) -> pd.DataFrame:
+        """Return Arrow table (or record batch) as the typed frame of gtfs_cls, as built from the GTFS files"""
+        frame = table.to_pandas(types_mapper={self.pa.int64(): pd.Int64Dtype()}.get)
+        for field in table.schema:
+            if field.type == self.pa.binary():
+                frame[field.name] = frame[field.name].map(bytes.hex, na_action='ignore')
+            elif isinstance(field.type, self.pa.ListType):
+                frame[field.name] = frame[field.name].map(list, na_action='ignore')
+        return frame
+
+    def tee(self, gtfs_cls, feed_id: int, frames: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Yield frames of the feed table, written to its hidden partition directory as they go"""
+        path = self.partition_path(gtfs_cls, feed_id, hidden=True)
+        shutil.rmtree(path, ignore_errors=True)
+        writer = None
+        try:
+            for frame in frames:
+                if feed_id not in self.__failed:
+                    try:
+                        table = self.to_arrow(gtfs_cls, frame)
+                        if writer is None:
+                            os.makedirs(path)
+                            writer = self.pq.ParquetWriter(os.path.join(path, self.PART), table.schema)
+                        writer.write_table(table)
+                    except (OSError, self.pa.ArrowException) as e:
+                        self.__logger.error(f'parquet staging of feed {feed_id} {gtfs_cls.__tablename__}: {e}')
+                        self.__failed.add(feed_id)
+                yield frame
+        finally:
+            if writer is not None:
+                writer.close()
+        # an empty file replaces the previous version as well
+        with self.__lock:
+            self.__written.setdefault(feed_id, set()).add(gtfs_cls)
+
+    def __swap(self, gtfs_cls, feed_id: int):
+        """Replace the feed partition of gtfs_cls by its hidden directory (removed when there is none)"""
+        path = self.partition_path(gtfs_cls, feed_id)
+        hidden = self.partition_path(gtfs_cls, feed_id, hidden=True)
+        old = f'{hidden}.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(path):
+            os.rename(path, old)
+        if os.path.exists(hidden):
+            os.rename(hidden, path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def publish(self, feed_id: int, gtfs_classes: list):
+        """
+        Swap in the feed tables written by the import
+        :param gtfs_classes: tables of the imported feed version, the other tables of the feed are removed
+        """
+        with self.__lock:
+            written = self.__written.pop(feed_id, set())
+        try:
+            if feed_id in self.__failed:
+                raise OSError('tables not written')
+            # tables not written by this import are kept from the previous one, a feed staged before is complete
+            missing = [c.__tablename__ for c in gtfs_classes
+                       if c not in written and not os.path.exists(self.partition_path(c, feed_id))]
+            if missing:
+                raise OSError(f"tables not staged by a previous import: {', '.join(missing)}")
+            for gtfs_cls in self.gtfs_classes:
+                if gtfs_cls in written:
+                    self.__swap(gtfs_cls, feed_id)
+                elif gtfs_cls not in gtfs_classes:
+                    shutil.rmtree(self.partition_path(gtfs_cls, feed_id), ignore_errors=True)
+        except OSError as e:
+            self.__logger.error(f'parquet staging of feed {feed_id} removed: {e}')
+            self.remove(feed_id)
+
+    def discard(self, feed_id: int):
+        """Remove the tables written by a failed import of the feed"""
+        with self.__lock:
+            self.__written.pop(feed_id, None)
+        self.__failed.discard(feed_id)
+        for gtfs_cls in self.gtfs_classes:
+            shutil.rmtree(self.partition_path(gtfs_cls, feed_id, hidden=True), ignore_errors=True)
+
+    def remove(self, feed_id: int):
+        """Remove the feed from the staging, its record first so a reload does not read a partial feed"""
+        for gtfs_cls in [FeedImport, FeedFile] + self.gtfs_classes:
+            shutil.rmtree(self.partition_path(gtfs_cls, feed_id), ignore_errors=True)
+        self.discard(feed_id)
+
+    def write_records(self, feed: FeedImport, files: list):
+        """
+        Write the feed record (without the geometries, built by the spatial stage) and its files records.
+        feed_id is the partition key (directory name), it is not a column of the files
+        """
+        try:
+            # the feed record is written last, a feed is listed once its files records are written
+            for gtfs_cls, rows in ((FeedFile, files), (FeedImport, [feed])):
+                names = [c.name for c in gtfs_cls.__table__.columns
+                         if c.name not in ('id', 'feed_id') and not isinstance(c.type, (Geometry, Geography))]
+                frame = pd.DataFrame([[getattr(row, name) for name in names] for row in rows], columns=names)
+                path = self.partition_path(gtfs_cls, feed.feed_id, hidden=True)
+                shutil.rmtree(path, ignore_errors=True)
+                os.makedirs(path)
+                self.pq.write_table(self.to_arrow(gtfs_cls, frame), os.path.join(path, self.PART))
+                self.__swap(gtfs_cls, feed.feed_id)
+        except (OSError, self.pa.ArrowException) as e:
+            self.__logger.error(f'parquet staging of feed {feed.feed_id} removed: {e}')
+            self.remove(feed.feed_id)
+
+    def feed_ids(self) -> list:
+        """Return ids of the feeds stored with their record"""
+        paths = glob.glob(os.path.join(self.root_dir, FeedImport.__tablename__, 'feed_id=*', self.PART))
+        return sorted(int(os.path.basename(os.path.dirname(path))[len('feed_id='):]) for path in paths)
+
+    def feed(self, feed_id: int) -> ParquetFeed:
+        return ParquetFeed(self, feed_id)
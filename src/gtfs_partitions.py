@@ -0,0 +1,153 @@
+import logging
+
+import sqlalchemy
+from sqlalchemy.schema import CreateTable
+
+from gtfs import deferred_indexes, spatial_indexes
+
+
+class ErrorNotPartitioned(Exception):
+    pass
+
+
+class GTFSPartitions:
+    """
+    GTFS tables declaratively partitioned by feed_id (LIST), one partition per feed.
+    A feed is loaded into unindexed staging tables, their indexes are built after the load and the staging tables
+    are swapped in for the feed partitions in one transaction. Replacing or removing a feed is a detach / drop.
+    """
+
+    def __init__(self, sa_session, gtfs_classes: list):
+        """
+        :param sa_session: sqlalchemy session
+        :param gtfs_classes: partitioned GTFS models (tables with a feed_id column)
+        """
+        self.__sa_gtfs_session = sa_session
+        self.__gtfs_classes = gtfs_classes
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def partition_name(gtfs_cls, feed_id: int) -> str:
+        return f'{gtfs_cls.__tablename__}_p{feed_id}'
+
+    @staticmethod
+    def stage_name(gtfs_cls, feed_id: int) -> str:
+        return f'{gtfs_cls.__tablename__}_s{feed_id}'
+
+    @staticmethod
+    def __indexes(gtfs_cls) -> list:
+        """Return (name, using, columns) of the table indexes, including the indexes built after the load"""
+        indexes = list()
+        for index in gtfs_cls.__table__.indexes:
+            using = index.dialect_options['postgresql']['using'] or 'btree'
+            indexes.append((index.name, using, tuple(c.name for c in index.columns)))
+        for columns in deferred_indexes(gtfs_cls):
+            indexes.append((f"ix_{gtfs_cls.__tablename__}_{'_'.join(columns)}", 'btree', tuple(columns)))
+        for name, using, column in spatial_indexes(gtfs_cls):
+            indexes.append((name, using, (column,)))
+        return indexes
+
+    def __execute(self, sql: str):
+        self.__sa_gtfs_session.execute(sqlalchemy.text(sql))
+
+    def __relkind(self, gtfs_cls) -> str:
+        """Return pg_class.relkind of the table, 'p' for partitioned table, None when not exists"""
+        return self.__sa_gtfs_session.execute(
+            sqlalchemy.text("SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+                            "WHERE n.nspname = :schema AND c.relname = :name"),
+            {'schema': gtfs_cls.__table__.schema, 'name': gtfs_cls.__tablename__}).scalar()
+
+    def create_tables(self):
+        """Create the partitioned parent tables (primary key: id, feed_id), must run before metadata.create_all"""
+        for gtfs_cls in self.__gtfs_classes:
+            relkind = self.__relkind(gtfs_cls)
+            if relkind == 'p':
+                continue
+            if relkind is not None:
+                raise ErrorNotPartitioned(f'{gtfs_cls.__table__.fullname} exists and is not partitioned')
+            table = gtfs_cls.__table__.to_metadata(sqlalchemy.MetaData())
+            table.c.id.autoincrement = True
+            table.c.feed_id.primary_key = True
+            table.append_constraint(sqlalchemy.PrimaryKeyConstraint('id', 'feed_id'))
+            table.dialect_options['postgresql']['partition_by'] = 'LIST (feed_id)'
+            self.__execute(str(CreateTable(table).compile(dialect=self.__sa_gtfs_session.bind.dialect)))
+            for name, using, columns in self.__indexes(gtfs_cls):
+                self.__execute(f"CREATE INDEX IF NOT EXISTS {name} ON {gtfs_cls.__table__.fullname} "
+                               f"USING {using} ({', '.join(columns)})")
+            self.__logger.info(f'create partitioned table {gtfs_cls.__table__.fullname}')
+        self.__sa_gtfs_session.commit()
+
+    def stage(self, gtfs_cls, feed_id: int) -> str:
+        """Create an empty, unindexed staging table of the feed, return its full name"""
+        schema = gtfs_cls.__table__.schema
+        stage = f'{schema}.{self.stage_name(gtfs_cls, feed_id)}'
+        self.__execute(f'DROP TABLE IF EXISTS {stage}')
+        self.__execute(f'CREATE TABLE {stage} (LIKE {gtfs_cls.__table__.fullname} INCLUDING DEFAULTS)')
+        self.__sa_gtfs_session.commit()
+        return stage
+
+    def is_staged(self, gtfs_cls, feed_id: int) -> bool:
+        """Return True when the feed staging table of gtfs_cls exists"""
+        stage = f'{gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}'
+        return self.__sa_gtfs_session.execute(sqlalchemy.text('SELECT to_regclass(:name)'),
+                                              {'name': stage}).scalar() is not None
+
+    def __build_indexes(self, gtfs_cls, feed_id: int):
+        """
+        Build the staging table indexes, matching the parent indexes so ATTACH reuses them. Runs in the publish
+        transaction, the indexes and constraints left by an older interrupted publish are dropped first
+        """
+        schema = gtfs_cls.__table__.schema
+        stage_name = self.stage_name(gtfs_cls, feed_id)
+        stage = f'{schema}.{stage_name}'
+        self.__execute(f'ALTER TABLE {stage} DROP CONSTRAINT IF EXISTS {stage_name}_pkey')
+        self.__execute(f'ALTER TABLE {stage} DROP CONSTRAINT IF EXISTS {stage_name}_feed_id')
+        for index_name, in self.__sa_gtfs_session.execute(
+                sqlalchemy.text('SELECT indexname FROM pg_indexes WHERE schemaname = :schema AND tablename = :name'),
+                {'schema': schema, 'name': stage_name}):
+            self.__execute(f'DROP INDEX {schema}.{index_name}')
+        self.__execute(f'ALTER TABLE {stage} ADD CONSTRAINT {stage_name}_pkey PRIMARY KEY (id, feed_id)')
+        for _, using, columns in self.__indexes(gtfs_cls):
+            self.__execute(f"CREATE INDEX ON {stage} USING {using} ({', '.join(columns)})")
+        # let ATTACH skip the partition constraint validation scan
+        self.__execute(f'ALTER TABLE {stage} ADD CONSTRAINT {stage_name}_feed_id CHECK (feed_id = {int(feed_id)})')
+        self.__execute(f'ANALYZE {stage}')
+
+    def __drop_partition(self, gtfs_cls, feed_id: int):
+        partition = f'{gtfs_cls.__table__.schema}.{self.partition_name(gtfs_cls, feed_id)}'
+        if self.__sa_gtfs_session.execute(sqlalchemy.text('SELECT to_regclass(:name)'),
+                                          {'name': partition}).scalar() is not None:
+            self.__execute(f'ALTER TABLE {gtfs_cls.__table__.fullname} DETACH PARTITION {partition}')
+            self.__execute(f'DROP TABLE {partition}')
+
+    def publish(self, feed_id: int, staged_classes: list):
+        """
+        Build the staging tables indexes and swap them in for the feed partitions, in the transaction of the caller
+        (committed with the feed files checkpoints): an interrupted publish leaves the staging tables as they were
+        loaded
+        """
+        for gtfs_cls in staged_classes:
+            self.__build_indexes(gtfs_cls, feed_id)
+        for gtfs_cls in self.__gtfs_classes:
+            self.__drop_partition(gtfs_cls, feed_id)
+        for gtfs_cls in staged_classes:
+            self.__execute(f'ALTER TABLE {gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)} '
+                           f'RENAME TO {self.partition_name(gtfs_cls, feed_id)}')
+            self.__execute(f'ALTER TABLE {gtfs_cls.__table__.fullname} ATTACH PARTITION '
+                           f'{gtfs_cls.__table__.schema}.{self.partition_name(gtfs_cls, feed_id)} '
+                           f'FOR VALUES IN ({int(feed_id)})')
+        self.__logger.info(f'feed {feed_id} partitions swapped in')
+
+    def discard(self, feed_id: int) -> bool:
+        """Drop the feed staging tables, return True when there were some"""
+        staged = [gtfs_cls for gtfs_cls in self.__gtfs_classes if self.is_staged(gtfs_cls, feed_id)]
+        for gtfs_cls in staged:
+            self.__execute(f'DROP TABLE {gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}')
+        self.__sa_gtfs_session.commit()
+        return bool(staged)
+
+    def drop_feed(self, feed_id: int):
+        """Remove the feed data, detach and drop its partitions"""
+        for gtfs_cls in self.__gtfs_classes:
+            self.__drop_partition(gtfs_cls, feed_id)
+        self.__sa_gtfs_session.commit()
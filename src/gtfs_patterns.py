@@ -0,0 +1,84 @@
+import hashlib
+import logging
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+
+class TripPatterns:
+    """
+    Stop patterns of the feed trips: the stop_ids sequence of each trip, ordered by stop_sequence.
+    stop_times are collected in column batches (add), then sorted once by (trip_id, stop_sequence) and split into
+    trips by offsets (build). Trips with the same stops share a pattern, referenced by its pattern_id: a hash of the
+    stops, stable across imports of the feed so unchanged trips are not rewritten by an incremental re-import.
+    Trips are joined to their pattern by trip_id string, as read from the files.
+    """
+
+    def __init__(self):
+        self.__trip_ids = list()
+        self.__stop_ids = list()
+        self.__sequences = list()
+        self.__by_trip = pd.Series(dtype='int64')
+        self.__patterns = pd.DataFrame({'pattern_id': pd.Series(dtype='int64'), 'stops': pd.Series(dtype=object)})
+        self.__logger = logging.getLogger(__name__)
+
+    def add(self, stop_times: pd.DataFrame):
+        """Collect a typed stop_times frame (trip_id, stop_id, stop_sequence)"""
+        self.__trip_ids.append(stop_times['trip_id'].astype('category').values)
+        self.__stop_ids.append(stop_times['stop_id'].astype('category').values)
+        self.__sequences.append(stop_times['stop_sequence'].astype('float64').to_numpy())
+
+    @staticmethod
+    def pattern_id(stops: list) -> int:
+        """Return the pattern id of a stops sequence, signed 64 bits hash"""
+        digest = hashlib.blake2b('\x1f'.join(stops).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True)
+
+    def build(self):
+        """Build the trips patterns from the collected stop_times"""
+        if not self.__trip_ids:
+            return
+        trips = union_categoricals(self.__trip_ids)
+        stops = union_categoricals(self.__stop_ids)
+        sequences = np.concatenate(self.__sequences)
+        self.__trip_ids, self.__stop_ids, self.__sequences = list(), list(), list()
+
+        trip_codes, stop_codes = trips.codes, stops.codes.astype('int32')
+        # stop_times without trip_id or stop_id are not part of a pattern
+        valid = (trip_codes >= 0) & (stop_codes >= 0)
+        invalid = len(valid) - int(valid.sum())
+        if invalid:
+            self.__logger.warning(f'{invalid:,} stop_times without trip_id or stop_id')
+        trip_codes, stop_codes, sequences = trip_codes[valid], stop_codes[valid], sequences[valid]
+        if not len(trip_codes):
+            return
+
+        order = np.lexsort((sequences, trip_codes))
+        trip_codes, stop_codes = trip_codes[order], stop_codes[order]
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(trip_codes)) + 1))
+        ends = np.append(starts[1:], len(trip_codes))
+
+        # one key per trip (its stop codes), identical sequences are factorized to the same pattern
+        keys = pd.Series([stop_codes[start:end].tobytes() for start, end in zip(starts, ends)], dtype=object)
+        pattern_codes = pd.factorize(keys)[0]
+        first = np.unique(pattern_codes, return_index=True)[1]
+        pattern_stops = [stops.categories[stop_codes[starts[i]:ends[i]]].tolist() for i in first]
+        pattern_ids = np.array([TripPatterns.pattern_id(s) for s in pattern_stops], dtype='int64')
+
+        self.__by_trip = pd.Series(pattern_ids[pattern_codes], index=trips.categories[trip_codes[starts]])
+        self.__patterns = pd.DataFrame({'pattern_id': pattern_ids, 'stops': pattern_stops})
+        self.__logger.info(f'{len(starts):,} trips, {len(pattern_ids):,} stop patterns')
+
+    def pattern_ids(self, trip_ids: pd.Series) -> pd.Series:
+        """Return the pattern_id of the trips, null for trips without stop_times"""
+        # taken from a nullable integer array, a float step (map with missing trips) would round the 64 bits ids
+        rows = self.__by_trip.index.get_indexer(trip_ids)
+        ids = pd.array(self.__by_trip.to_numpy(), dtype='Int64').take(rows, allow_fill=True)
+        return pd.Series(ids, index=trip_ids.index)
+
+    def frames(self, chunk_rows: int) -> Iterator[pd.DataFrame]:
+        """Yield frames of the patterns (pattern_id, stops), chunk_rows patterns per frame"""
+        for start in range(0, len(self.__patterns), chunk_rows):
+            yield self.__patterns.iloc[start:start + chunk_rows]
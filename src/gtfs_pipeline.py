@@ -0,0 +1,104 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
+
+
+class _Done:
+    """End of a producer items, error is the producer exception if any"""
+
+    def __init__(self, error: BaseException = None):
+        self.error = error
+
+
+class BatchPipeline:
+    """
+    Run producers (parse and encode the rows of a GTFS file) in threads ahead of the consumer (the writer, owner of
+    the database connection). Each producer fills a bounded queue, a producer ahead of the writer blocks when its
+    queue is full, so memory is bounded by workers * queue_size batches.
+    The consumer must read the producers in submit order. With workers=0 producers run inline, in the consumer.
+    """
+    PUT_TIMEOUT = 0.5
+
+    def __init__(self, workers: int = 1, queue_size: int = 4):
+        """
+        :param workers: producer threads, 0: no threads
+        :param queue_size: max batches of a producer waiting for the consumer
+        """
+        self.__workers = workers
+        self.__queue_size = queue_size
+        self.__producers = dict()
+        self.__stop = threading.Event()
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gtfs_parse') if workers else None
+        self.__logger = logging.getLogger(__name__)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __put(self, items: queue.Queue, item) -> bool:
+        """Put item, wait while the queue is full, return False when the pipeline is closed"""
+        while not self.__stop.is_set():
+            try:
+                items.put(item, timeout=self.PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __run(self, produce: Callable[[], Iterator], items: queue.Queue, after: threading.Event,
+              done: threading.Event):
+        try:
+            if after is not None:
+                after.wait()
+            if self.__stop.is_set():
+                return
+            for item in produce():
+                if not self.__put(items, item):
+                    return
+            self.__put(items, _Done())
+        except BaseException as e:
+            self.__put(items, _Done(e))
+        finally:
+            done.set()
+
+    def submit(self, key: str, produce: Callable[[], Iterator], after: str = None):
+        """
+        Start producer
+        :param key: producer key, read with items(key)
+        :param produce: return the items iterator, called in the producer thread
+        :param after: key of a producer that must be complete before produce is called (e.g. its side effects)
+        """
+        done = threading.Event()
+        if self.__executor is None:
+            self.__producers[key] = (produce, None, done)
+            return
+        items = queue.Queue(maxsize=self.__queue_size)
+        after_done = self.__producers[after][2] if after in self.__producers else None
+        self.__executor.submit(self.__run, produce, items, after_done, done)
+        self.__producers[key] = (produce, items, done)
+
+    def items(self, key: str) -> Iterator:
+        """Yield the items of the key producer, raise the producer exception"""
+        produce, items, done = self.__producers.pop(key)
+        if items is None:
+            yield from produce()
+            done.set()
+            return
+        while True:
+            item = items.get()
+            if isinstance(item, _Done):
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+
+    def close(self):
+        """Stop the producers and wait for their threads"""
+        self.__stop.set()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+        self.__producers.clear()
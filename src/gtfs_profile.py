@@ -0,0 +1,108 @@
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+
+class ErrorLoadProfile(Exception):
+    pass
+
+
+class LoadProfile:
+    """
+    Connection and session settings of a load, to tune the ingestion for the hardware without patching the code:
+    connection pool size, psycopg2 executemany mode (ORM loader inserts), and per connection postgres settings
+    (synchronous_commit, work_mem, maintenance_work_mem of the index builds).
+    The settings are set on each new connection of the engine (connect event), so they apply to every connection
+    of the pool. The batch sizes (rows and MB) are the GTFSImport chunk_rows and max_chunk_mb.
+    """
+    EXECUTEMANY_MODES = ('values_only', 'values_plus_batch', 'batch')
+
+    def __init__(self, pool_size: int = None, max_overflow: int = None, executemany_mode: str = None,
+                 executemany_page_size: int = None, synchronous_commit: bool = True, work_mem: str = None,
+                 maintenance_work_mem: str = None):
+        """
+        :param pool_size: connections kept in the engine pool, default: the engine default
+        :param max_overflow: connections opened over pool_size, default: the engine default
+        :param executemany_mode: psycopg2 executemany mode (values_only: execute_values, batch: execute_batch),
+            default: the dialect default (values_only)
+        :param executemany_page_size: rows per statement of execute_values / execute_batch
+        :param synchronous_commit: False: SET synchronous_commit = off, commits do not wait for the WAL flush
+            (a server crash may lose the last commits, never corrupts the database)
+        :param work_mem: postgres work_mem of the sessions (sorts and hashes of the merges), eg: 256MB
+        :param maintenance_work_mem: postgres maintenance_work_mem of the sessions (index builds, CLUSTER), eg: 1GB
+        """
+        if executemany_mode is not None and executemany_mode not in self.EXECUTEMANY_MODES:
+            raise ErrorLoadProfile(f'executemany_mode: {executemany_mode}, expected one of {self.EXECUTEMANY_MODES}')
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.executemany_mode = executemany_mode
+        self.executemany_page_size = executemany_page_size
+        self.synchronous_commit = synchronous_commit
+        self.work_mem = work_mem
+        self.maintenance_work_mem = maintenance_work_mem
+
+    def settings(self) -> dict:
+        """Return postgres settings of the sessions"""
+        settings = dict()
+        if not self.synchronous_commit:
+            settings['synchronous_commit'] = 'off'
+        if self.work_mem:
+            settings['work_mem'] = self.work_mem
+        if self.maintenance_work_mem:
+            settings['maintenance_work_mem'] = self.maintenance_work_mem
+        return settings
+
+    def engine_kwargs(self, db_con_str: str, **defaults) -> dict:
+        """
+        Return create_engine arguments of the profile
+        :param defaults: create_engine arguments of the caller, overridden by the profile
+        """
+        kwargs = dict(defaults)
+        if self.pool_size is not None:
+            kwargs['pool_size'] = self.pool_size
+        if self.max_overflow is not None:
+            kwargs['max_overflow'] = self.max_overflow
+        if make_url(db_con_str).get_driver_name() == 'psycopg2':
+            if self.executemany_mode is not None:
+                kwargs['executemany_mode'] = self.executemany_mode
+            if self.executemany_page_size is not None:
+                page_size = 'executemany_batch_page_size' if self.executemany_mode == 'batch' \
+                    else 'executemany_values_page_size'
+                kwargs[page_size] = self.executemany_page_size
+        return kwargs
+
+    def create_engine(self, db_con_str: str, **defaults):
+        """
+        Return engine of the profile, its connections are set with the profile settings
+        :param defaults: create_engine arguments of the caller, overridden by the profile
+        """
+        engine = sqlalchemy.create_engine(db_con_str, **self.engine_kwargs(db_con_str, **defaults))
+        self.configure(engine)
+        return engine
+
+    def configure(self, engine):
+        """Set the profile settings on the new connections of engine"""
+        if self.settings() and not event.contains(engine, 'connect', self.__on_connect):
+            event.listen(engine, 'connect', self.__on_connect)
+
+    def __on_connect(self, dbapi_con, connection_record):
+        # set outside of a transaction, a rollback of the first transaction would reset the settings
+        autocommit = dbapi_con.autocommit
+        dbapi_con.autocommit = True
+        try:
+            with dbapi_con.cursor() as cursor:
+                for name, value in self.settings().items():
+                    cursor.execute('SELECT set_config(%s, %s, false)', (name, value))
+        finally:
+            dbapi_con.autocommit = autocommit
+
+    def apply(self, sa_session):
+        """Set the profile settings on the session connection, and on the next connections of its engine"""
+        settings = self.settings()
+        if not settings:
+            return
+        self.configure(sa_session.bind)
+        for name, value in settings.items():
+            sa_session.execute(sqlalchemy.text('SELECT set_config(:name, :value, false)'),
+                               {'name': name, 'value': value})
+        sa_session.commit()
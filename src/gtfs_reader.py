@@ -0,0 +1,278 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+
+from gtfs import FeedImport, Route, Stop, Trip, TripPattern
+
+# mean earth radius (m)
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = np.pi * EARTH_RADIUS_M / 180
+
+
+class FeedIndex:
+    """
+    In-memory tables of a loaded feed, array backed: stop coordinates as NumPy arrays with a grid spatial index
+    (stops sorted by cell, cell -> range of the sorted stops), the other columns as arrays, dict indexes by
+    stop_id, route_id and trip_id, trips grouped by route and trips patterns by pattern_id.
+    """
+    # grid cell size (degrees), about 1.1 km of latitude
+    CELL_DEG = 0.01
+    # cell key: lat cell * LON_CELLS + lon cell, lon cells are within +-18000
+    LON_CELLS = 100000
+
+    def __init__(self, feed_id: int, feed_checksum: str, stops: pd.DataFrame, routes: pd.DataFrame,
+                 trips: pd.DataFrame, patterns: pd.DataFrame):
+        """
+        :param feed_checksum: checksum of the feed version the tables are read from
+        :param stops: stops (stop_id, lon, lat and the other returned columns)
+        :param routes: routes (route_id and the other returned columns)
+        :param trips: trips (trip_id, route_id, pattern_id and the other returned columns)
+        :param patterns: trips patterns (pattern_id, stops), pattern_id of the same type as the trips pattern_id
+        """
+        self.feed_id = feed_id
+        self.feed_checksum = feed_checksum
+        self.nbytes = sum(int(frame.memory_usage(deep=True).sum()) for frame in (stops, routes, trips, patterns))
+
+        self.__stops = {name: stops[name].to_numpy() for name in stops.columns}
+        self.__stop_index = self.__index(stops['stop_id'])
+        self.__lon = stops['lon'].to_numpy(dtype='float64', na_value=np.nan)
+        self.__lat = stops['lat'].to_numpy(dtype='float64', na_value=np.nan)
+        self.__build_grid()
+
+        self.__routes = {name: routes[name].to_numpy() for name in routes.columns}
+        self.__route_index = self.__index(routes['route_id'])
+
+        self.__trips = {name: trips[name].to_numpy() for name in trips.columns}
+        self.__trip_index = self.__index(trips['trip_id'])
+        # route_id -> rows of the route trips
+        self.__route_trips = trips.groupby('route_id', sort=False).indices
+        self.__patterns = dict(zip(patterns['pattern_id'].tolist(), patterns['stops'].tolist()))
+        # dict entries: key, value and table slot
+        self.nbytes += 100 * (len(stops) + len(routes) + 2 * len(trips) + len(patterns) + len(self.__cells))
+
+    @staticmethod
+    def __index(ids: pd.Series) -> dict:
+        """Return id -> row dict, the first row of a duplicated id"""
+        return {key: row for row, key in reversed(list(enumerate(ids.tolist())))}
+
+    def __cell(self, lon, lat):
+        return np.floor(lat / self.CELL_DEG).astype('int64') * self.LON_CELLS + \
+            np.floor(lon / self.CELL_DEG).astype('int64')
+
+    def __build_grid(self):
+        """Sort the located stops by grid cell, cell key -> (start, end) of the sorted stops"""
+        located = np.flatnonzero(np.isfinite(self.__lon) & np.isfinite(self.__lat))
+        keys = self.__cell(self.__lon[located], self.__lat[located])
+        order = np.argsort(keys, kind='stable')
+        self.__grid_rows = located[order]
+        keys = keys[order]
+        cells, starts = np.unique(keys, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+        self.__cells = dict(zip(cells.tolist(), zip(starts.tolist(), ends.tolist())))
+
+    def __candidates(self, lon: float, lat: float, radius_m: float) -> np.ndarray:
+        """Return rows of the stops in the grid cells of the bounding box of the circle"""
+        dlat = radius_m / METERS_PER_DEGREE
+        dlon = dlat / max(np.cos(np.radians(min(abs(lat) + dlat, 90.0))), 1e-6)
+        lat_cells = range(int(np.floor((lat - dlat) / self.CELL_DEG)), int(np.floor((lat + dlat) / self.CELL_DEG) + 1))
+        lon_cells = range(int(np.floor((lon - dlon) / self.CELL_DEG)), int(np.floor((lon + dlon) / self.CELL_DEG) + 1))
+        if len(lat_cells) * len(lon_cells) >= len(self.__cells):
+            # large radius, all the stops
+            return self.__grid_rows
+        ranges = [self.__cells.get(lat_cell * self.LON_CELLS + lon_cell)
+                  for lat_cell in lat_cells for lon_cell in lon_cells]
+        ranges = [r for r in ranges if r is not None]
+        if not ranges:
+            return self.__grid_rows[:0]
+        return np.concatenate([self.__grid_rows[start:end] for start, end in ranges])
+
+    @staticmethod
+    def distance_m(lon: float, lat: float, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """Return haversine distances (m) from (lon, lat) to the points"""
+        lat1, lat2 = np.radians(lat), np.radians(lats)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(lons - lon) / 2) ** 2
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+    def stops_within(self, lon: float, lat: float, radius_m: float) -> list:
+        """Return (stop_id, distance in m) of the stops within radius_m of (lon, lat), nearest first"""
+        rows = self.__candidates(lon, lat, radius_m)
+        distances = self.distance_m(lon, lat, self.__lon[rows], self.__lat[rows])
+        within = distances <= radius_m
+        rows, distances = rows[within], distances[within]
+        order = np.argsort(distances, kind='stable')
+        return list(zip(self.__stops['stop_id'][rows[order]].tolist(), distances[order].tolist()))
+
+    @staticmethod
+    def __record(table: dict, row: int) -> dict:
+        if row is None:
+            return None
+        return {name: None if pd.isna(values[row]) else values[row] for name, values in table.items()}
+
+    def stop(self, stop_id: str) -> dict:
+        """Return the stop columns, None when not exists"""
+        return self.__record(self.__stops, self.__stop_index.get(stop_id))
+
+    def route(self, route_id: str) -> dict:
+        """Return the route columns, None when not exists"""
+        return self.__record(self.__routes, self.__route_index.get(route_id))
+
+    def trip(self, trip_id: str) -> dict:
+        """Return the trip columns, None when not exists"""
+        return self.__record(self.__trips, self.__trip_index.get(trip_id))
+
+    def route_trips(self, route_id: str) -> list:
+        """Return trip_id of the trips of the route"""
+        rows = self.__route_trips.get(route_id)
+        return [] if rows is None else self.__trips['trip_id'][rows].tolist()
+
+    def trip_stops(self, trip_id: str) -> list:
+        """Return stop_id of the trip stops (stop pattern), ordered by stop_sequence, None when the trip not exists"""
+        row = self.__trip_index.get(trip_id)
+        if row is None:
+            return None
+        pattern_id = self.__trips['pattern_id'][row]
+        return [] if pd.isna(pattern_id) else list(self.__patterns.get(pattern_id, []))
+
+
+class GTFSReader:
+    """
+    In-process read API of the loaded feeds, the companion of GTFSImport for the services querying the GTFS tables.
+    The stops, routes, trips and trips patterns of a feed are read once (one query per table) into a FeedIndex, the
+    lookups (stops within a radius, trips of a route, stop pattern of a trip) then run in memory.
+    Loaded feeds are kept in a LRU cache bounded by max_cache_mb, a feed is loaded again when its
+    FeedImport.feed_checksum changed (new version imported), checked at most every check_interval_s.
+    """
+
+    def __init__(self, sa_session, max_cache_mb: float = 512, check_interval_s: float = 60):
+        """
+        :param sa_session: sqlalchemy session, the feeds are read with connections of its engine (a session is not
+            shared between threads), so different feeds are loaded in parallel
+        :param max_cache_mb: max (estimated) size of the loaded feeds in MB, least recently used feeds are evicted
+        :param check_interval_s: seconds a loaded feed is used without checking its feed_checksum, 0: every lookup
+        """
+        self.__engine = sa_session.get_bind()
+        self.__max_cache_bytes = int(max_cache_mb * 1024 * 1024)
+        self.__check_interval_s = check_interval_s
+        # feed_id -> (FeedIndex, time of the last checksum check)
+        self.__feeds = OrderedDict()
+        # guards the cache, not held while a feed is read
+        self.__lock = threading.Lock()
+        # feed_id -> lock of the feed checks and loads, a feed is loaded once by concurrent lookups
+        self.__feed_locks = dict()
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def __frame(connection, sql: str, feed_id: int) -> pd.DataFrame:
+        return pd.read_sql(sqlalchemy.text(sql), connection, params={'feed_id': feed_id})
+
+    def __feed_checksum(self, feed_id: int) -> str:
+        with self.__engine.connect() as connection:
+            return connection.execute(sqlalchemy.select(FeedImport.feed_checksum)
+                                      .where(FeedImport.feed_id == feed_id)).scalar()
+
+    def __load(self, feed_id: int, feed_checksum: str) -> FeedIndex:
+        start = time.perf_counter()
+        # the connection is returned to the pool once read, the read transaction is not left open
+        with self.__engine.connect() as connection:
+            stops = self.__frame(
+                connection,
+                f"SELECT stop_id, stop_code, stop_name, ST_X(stop_loc::geometry) AS lon, "
+                f"ST_Y(stop_loc::geometry) AS lat, location_type, parent_station, wheelchair_boarding "
+                f"FROM {Stop.__table__.fullname} WHERE feed_id = :feed_id", feed_id)
+            routes = self.__frame(
+                connection,
+                f"SELECT route_id, agency_id, route_short_name, route_long_name, route_type, route_color "
+                f"FROM {Route.__table__.fullname} WHERE feed_id = :feed_id", feed_id)
+            trips = self.__frame(
+                connection,
+                f"SELECT trip_id, route_id, service_id, direction_id, shape_id, trip_headsign, pattern_id::text "
+                f"FROM {Trip.__table__.fullname} WHERE feed_id = :feed_id", feed_id)
+            # pattern_id (64 bits hash) as text, a null in the trips column would make it a float
+            patterns = self.__frame(
+                connection,
+                f"SELECT pattern_id::text, stops FROM {TripPattern.__table__.fullname} WHERE feed_id = :feed_id",
+                feed_id)
+        feed = FeedIndex(feed_id, feed_checksum, stops, routes, trips, patterns)
+        self.__logger.info(f'feed {feed_id} loaded: {len(stops):,} stops, {len(routes):,} routes, '
+                           f'{len(trips):,} trips ({feed.nbytes / 1024 / 1024:,.1f}MB) '
+                           f'in {time.perf_counter() - start:.2f}s')
+        return feed
+
+    def __evict(self):
+        """Remove least recently used feeds until the loaded feeds size is under max_cache_mb, keeps the last one"""
+        total = sum(feed.nbytes for feed, _ in self.__feeds.values())
+        while total > self.__max_cache_bytes and len(self.__feeds) > 1:
+            feed_id, (feed, _) = self.__feeds.popitem(last=False)
+            total -= feed.nbytes
+            self.__logger.debug(f'evict feed {feed_id}')
+
+    def __cached(self, feed_id: int) -> FeedIndex:
+        """Return the cached feed when its feed_checksum was checked within check_interval_s, else None"""
+        with self.__lock:
+            cached = self.__feeds.get(feed_id)
+            if cached is None or time.monotonic() - cached[1] >= self.__check_interval_s:
+                return None
+            self.__feeds.move_to_end(feed_id)
+            return cached[0]
+
+    def feed(self, feed_id: int) -> FeedIndex:
+        """
+        Return the loaded feed, loaded when not cached or its feed_checksum changed, None when not imported.
+        The check and the load run under the lock of the feed: lookups of the other feeds are not blocked
+        """
+        feed = self.__cached(feed_id)
+        if feed is not None:
+            return feed
+        with self.__lock:
+            feed_lock = self.__feed_locks.setdefault(feed_id, threading.Lock())
+        with feed_lock:
+            # checked or loaded by another lookup meanwhile
+            feed = self.__cached(feed_id)
+            if feed is not None:
+                return feed
+            now = time.monotonic()
+            feed_checksum = self.__feed_checksum(feed_id)
+            with self.__lock:
+                cached = self.__feeds.get(feed_id)
+            if feed_checksum is None:
+                feed = None
+            elif cached is not None and cached[0].feed_checksum == feed_checksum:
+                feed = cached[0]
+            else:
+                feed = self.__load(feed_id, feed_checksum)
+            with self.__lock:
+                if feed is None:
+                    self.__feeds.pop(feed_id, None)
+                    return None
+                self.__feeds[feed_id] = (feed, now)
+                self.__feeds.move_to_end(feed_id)
+                self.__evict()
+            return feed
+
+    def invalidate(self, feed_id: int = None):
+        """Remove the feed (default: all the feeds) from the cache, loaded again by the next lookup"""
+        with self.__lock:
+            if feed_id is None:
+                self.__feeds.clear()
+            else:
+                self.__feeds.pop(feed_id, None)
+
+    def stops_within(self, feed_id: int, lon: float, lat: float, radius_m: float) -> list:
+        """Return (stop_id, distance in m) of the feed stops within radius_m of (lon, lat), nearest first"""
+        feed = self.feed(feed_id)
+        return [] if feed is None else feed.stops_within(lon, lat, radius_m)
+
+    def route_trips(self, feed_id: int, route_id: str) -> list:
+        """Return trip_id of the trips of the feed route"""
+        feed = self.feed(feed_id)
+        return [] if feed is None else feed.route_trips(route_id)
+
+    def trip_stops(self, feed_id: int, trip_id: str) -> list:
+        """Return stop_id of the stops of the feed trip (stop pattern), None when the trip not exists"""
+        feed = self.feed(feed_id)
+        return None if feed is None else feed.trip_stops(trip_id)
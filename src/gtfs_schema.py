@@ -0,0 +1,82 @@
+import datetime
+import logging
+
+import sqlalchemy
+
+from gtfs import SchemaVersion, metadata, schema_version
+from gtfs_partitions import GTFSPartitions
+
+
+class GTFSSchema:
+    """
+    Bootstrap and migrations of the GTFS schema.
+    The version of the models schema (schema_version) is stored in gtfs_schema_version once the schema is created or
+    migrated: a load checks it with one query and skips the catalog round trips of the bootstrap (has_schema,
+    metadata.create_all checkfirst, columns inspection) when it matches. migrate (init-db) creates the schema, the
+    tables and the indexes, and adds the columns added to the models since the tables were created.
+    """
+
+    def __init__(self, sa_session, partitions: GTFSPartitions = None):
+        """
+        :param sa_session: sqlalchemy session
+        :param partitions: partitioned schema, the partitioned tables are created before the other tables
+        """
+        self.__sa_gtfs_session = sa_session
+        self.__partitions = partitions
+        self.__logger = logging.getLogger(__name__)
+
+    def stored_version(self) -> SchemaVersion:
+        """Return the stored schema version, None when the schema was not created by a versioned bootstrap"""
+        try:
+            return self.__sa_gtfs_session.query(SchemaVersion).order_by(SchemaVersion.id.desc()).first()
+        except sqlalchemy.exc.ProgrammingError:
+            # schema or version table not exists
+            self.__sa_gtfs_session.rollback()
+            return None
+
+    def is_current(self, stored: SchemaVersion) -> bool:
+        """Return True when the stored version is the models version (and layout, when partitioned)"""
+        if stored is None or stored.version != schema_version():
+            return False
+        return self.__partitions is None or bool(stored.partitioned)
+
+    def migrate(self):
+        """Create the schema, the tables and the indexes if not exists, add the missing columns, store the version"""
+        engine = self.__sa_gtfs_session.bind
+        if not engine.dialect.has_schema(engine, metadata.schema):
+            engine.execute(sqlalchemy.schema.CreateSchema(metadata.schema))
+        if self.__partitions is not None:
+            self.__partitions.create_tables()
+        metadata.create_all(engine, checkfirst=True)
+        self.__add_missing_columns(engine)
+
+        stored = self.stored_version()
+        partitioned = self.__partitions is not None or bool(stored is not None and stored.partitioned)
+        self.__sa_gtfs_session.query(SchemaVersion).delete(synchronize_session=False)
+        self.__sa_gtfs_session.add(SchemaVersion(version=schema_version(), partitioned=partitioned,
+                                                 schema_dt=datetime.datetime.now()))
+        self.__sa_gtfs_session.commit()
+        self.__logger.info(f'schema {metadata.schema} version {schema_version()}'
+                           f'{" (partitioned)" if partitioned else ""}')
+
+    def bootstrap(self) -> bool:
+        """Migrate the schema unless the stored version is current, return True when migrated"""
+        current = self.is_current(self.stored_version())
+        # end the read transaction, the session connection is not left idle in transaction
+        self.__sa_gtfs_session.commit()
+        if current:
+            return False
+        self.migrate()
+        return True
+
+    @staticmethod
+    def __add_missing_columns(engine):
+        """Add columns added to the models after their table was created"""
+        inspector = sqlalchemy.inspect(engine)
+        for table in metadata.sorted_tables:
+            existing = {c['name'] for c in inspector.get_columns(table.name, schema=table.schema)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    engine.execute(f'ALTER TABLE {table.fullname} '
+                                   f'ADD COLUMN IF NOT EXISTS {column.name} {column_type}')
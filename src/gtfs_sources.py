@@ -6,6 +6,9 @@ from datetime import datetime
 import dateutil
 import pandas as pd
 import requests
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+from urllib.parse import urlsplit, urlunsplit
 from gtfs import FeedImport
 
 
@@ -18,6 +21,9 @@ from gtfs import FeedImport
 
 
 class GTFSSources:
+    # sources per INSERT ... ON CONFLICT statement
+    UPSERT_ROWS = 1000
+
     def __init__(self, sa_session):
         self.__sa_gtfs_session = sa_session
         self.__logger = logging.getLogger(__name__)
@@ -106,40 +112,118 @@ class GTFSSources:
         self.__logger.info(f"Download source list from {download_base_url}, found {len(feed_import)} sources")
         return feed_import
 
-    def __get_sources_the_mobility_database(self) -> list:
-        """Download csv from the mobility_database site, parse it and return list of FeedImport objects"""
+    def __get_sources_the_mobility_database(self) -> pd.DataFrame:
+        """Download csv from the mobility_database site, return sources (feed_source, feed_name, feed_url, feed_dt)"""
         download_base_url = "https://www.google.com/url?" \
                             "q=https%3A%2F%2Fbit.ly%2Fcatalogs-csv&sa=D&sntz=1&usg=AOvVaw3QVLRlS_nDhkg_h8Id_C1K"
         r = requests.get(download_base_url)
         redirect_url = r.headers['Location']
-        data = pd.read_csv(redirect_url)
-        feed_import = list()
-        for index, row in data.iterrows():
-            try:
-                feed_ts = dateutil.parser.parse(row['location.bounding_box.extracted_on'])
-            except TypeError:
-                self.__logger.error(f"Failed to parse location.bounding_box.extracted_on:"
-                                    f" {row.get('location.bounding_box.extracted_on')}")
-                feed_ts = datetime.now()
-            feed_import.append(FeedImport(
-                feed_source='mobility_database',
-                feed_name=row['provider'][:1000],
-                feed_url=row['urls.direct_download'],
-                feed_dt=feed_ts
-            ))
-
-        self.__logger.info(f"Download source list from {download_base_url}, found {len(feed_import)} sources")
-        return feed_import
+        data = pd.read_csv(redirect_url, dtype=str,
+                           usecols=['provider', 'urls.direct_download', 'location.bounding_box.extracted_on'])
+        feed_dt = pd.to_datetime(data['location.bounding_box.extracted_on'], errors='coerce', utc=True)
+        failed = feed_dt.isna()
+        if failed.any():
+            self.__logger.error(f"Failed to parse location.bounding_box.extracted_on of {failed.sum()} sources: "
+                                f"{data.loc[failed, 'location.bounding_box.extracted_on'].head().tolist()}")
+        sources = pd.DataFrame({
+            'feed_source': 'mobility_database',
+            'feed_name': data['provider'].fillna('').str.slice(0, 1000),
+            'feed_url': data['urls.direct_download'],
+            # unknown date is null, not the sync time, else the source would be re-queued on every sync
+            'feed_dt': feed_dt.dt.tz_localize(None),
+        })
+        self.__logger.info(f"Download source list from {download_base_url}, found {len(sources)} sources")
+        return sources
+
+    @staticmethod
+    def normalize_url(url: str) -> str:
+        """Return url without surrounding spaces and fragment, scheme and host in lower case"""
+        parts = urlsplit(url.strip())
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, parts.query, ''))
+
+    @staticmethod
+    def __url_index() -> sqlalchemy.Index:
+        return [i for i in FeedImport.__table__.indexes if i.name == 'ix_gtfs_feed_import_feed_url'][0]
+
+    def __normalize_stored_urls(self):
+        """
+        Normalize the stored source urls (normalize_url), rows stored under another form of a synced url would not
+        match it. The feed_url unique index is dropped meanwhile, created again once the duplicates are superseded
+        """
+        changed = list()
+        for feed_id, feed_url in self.__sa_gtfs_session.query(FeedImport.feed_id, FeedImport.feed_url) \
+                .filter(FeedImport.feed_url.isnot(None)):
+            normalized = GTFSSources.normalize_url(feed_url)
+            if normalized != feed_url:
+                changed.append({'feed_id': feed_id, 'feed_url': normalized})
+        if not changed:
+            return
+        self.__url_index().drop(self.__sa_gtfs_session.connection(), checkfirst=True)
+        self.__sa_gtfs_session.bulk_update_mappings(FeedImport, changed)
+        self.__logger.info(f"{len(changed):,} stored source urls normalized")
+
+    def __supersede_duplicates(self):
+        """
+        Keep one row per source url (required by the feed_url unique index): duplicate pending rows are removed,
+        older duplicates of imported sources are marked SUPERSEDED, their data is kept
+        """
+        table = FeedImport.__table__.fullname
+        params = {'pending': FeedImport.PENDING, 'superseded': FeedImport.SUPERSEDED}
+        deleted = self.__sa_gtfs_session.execute(sqlalchemy.text(
+            f"DELETE FROM {table} AS a WHERE a.done = :pending AND EXISTS ("
+            f"SELECT 1 FROM {table} b WHERE b.feed_url = a.feed_url AND b.done <> :superseded "
+            f"AND (b.done <> :pending OR b.feed_id > a.feed_id))"), params).rowcount
+        superseded = self.__sa_gtfs_session.execute(sqlalchemy.text(
+            f"UPDATE {table} AS a SET done = :superseded WHERE a.done <> :superseded AND EXISTS ("
+            f"SELECT 1 FROM {table} b WHERE b.feed_url = a.feed_url AND b.done <> :superseded "
+            f"AND b.feed_id > a.feed_id)"), params).rowcount
+        if deleted or superseded:
+            self.__logger.warning(f"duplicate sources: {deleted:,} pending removed, {superseded:,} superseded")
+        self.__url_index().create(self.__sa_gtfs_session.connection(), checkfirst=True)
+
+    def __upsert(self, records: list) -> tuple:
+        """
+        Insert new sources, update the sources whose name or date changed and re-queue them (done = PENDING),
+        unchanged sources are not touched. Return (inserted, updated)
+        """
+        insert = postgresql.insert(FeedImport.__table__)
+        target = FeedImport.__table__
+        changed = sqlalchemy.tuple_(target.c.feed_source, target.c.feed_name, target.c.feed_dt).is_distinct_from(
+            sqlalchemy.tuple_(insert.excluded.feed_source, insert.excluded.feed_name, insert.excluded.feed_dt))
+        # a running import keeps its status, it is not claimed twice
+        requeue = sqlalchemy.case((target.c.done == FeedImport.RUNNING, target.c.done), else_=FeedImport.PENDING)
+        inserted = updated = 0
+        for start in range(0, len(records), self.UPSERT_ROWS):
+            statement = insert.values(records[start:start + self.UPSERT_ROWS]).on_conflict_do_update(
+                index_elements=[target.c.feed_url],
+                index_where=target.c.done != FeedImport.SUPERSEDED,
+                set_={'feed_source': insert.excluded.feed_source, 'feed_name': insert.excluded.feed_name,
+                      'feed_dt': insert.excluded.feed_dt, 'done': requeue, 'error': None},
+                where=changed,
+            ).returning(sqlalchemy.literal_column('xmax = 0'))
+            for is_insert, in self.__sa_gtfs_session.execute(statement):
+                if is_insert:
+                    inserted += 1
+                else:
+                    updated += 1
+        return inserted, updated
 
     def update_feed_sources(self):
-        """Read sources and save them to database"""
-        feed_import_list = list()
-        feed_import_list += self.__get_sources_the_mobility_database()
-        self.__logger.info(f"found {len(feed_import_list)} sources")
-        uniq_urls = list()
-        for feed in feed_import_list:
-            if feed.feed_url not in uniq_urls:
-                uniq_urls.append(feed)
-                self.__sa_gtfs_session.add(feed)
-        self.__logger.info(f'{len(uniq_urls):,} sources loaded')
+        """
+        Sync the sources catalogue to database (gtfs_feed_import), one row per normalized source url.
+        New sources are inserted, changed sources are updated and re-queued, the others are left as they are.
+        """
+        sources = self.__get_sources_the_mobility_database()
+        self.__logger.info(f"found {len(sources)} sources")
+        sources = sources.dropna(subset=['feed_url'])
+        sources['feed_url'] = sources['feed_url'].map(GTFSSources.normalize_url)
+        sources = sources[sources['feed_url'] != ''].drop_duplicates('feed_url', keep='last')
+        records = [dict(zip(sources.columns, row)) for row in sources.itertuples(index=False)]
+        for record in records:
+            record['feed_dt'] = None if pd.isna(record['feed_dt']) else record['feed_dt'].to_pydatetime()
+        self.__normalize_stored_urls()
+        self.__supersede_duplicates()
+        inserted, updated = self.__upsert(records)
         self.__sa_gtfs_session.commit()
+        self.__logger.info(f'{len(records):,} sources loaded: {inserted:,} new, {updated:,} changed (re-queued), '
+                           f'{len(records) - inserted - updated:,} unchanged')
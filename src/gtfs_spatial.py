@@ -0,0 +1,120 @@
+import logging
+import time
+
+import sqlalchemy
+
+from gtfs import FeedImport, RouteGeometry, Shape, Stop, Trip, spatial_indexes
+from gtfs_partitions import GTFSPartitions
+
+
+class GTFSSpatial:
+    """
+    Spatial indexes and post-load spatial stage of a feed.
+    Spatial indexes (model spatial_indexes) are built once the data is loaded, not maintained row by row while a new
+    table is filled. The post-load stage materializes the feed route geometries (gtfs_route_geometries: shapes of
+    the route trips by route and direction) and extent (gtfs_feed_import bbox and centroid, from the stops), clusters
+    the feed partitions on their GiST index and analyzes the feed tables, so the spatial work is done once at import
+    instead of in the queries.
+    """
+
+    def __init__(self, sa_session, gtfs_classes: list, partitions: GTFSPartitions = None):
+        """
+        :param sa_session: sqlalchemy session
+        :param gtfs_classes: GTFS models loaded by the import, analyzed by the post-load stage
+        :param partitions: partitioned schema, the feed partitions are clustered and analyzed
+        """
+        self.__sa_gtfs_session = sa_session
+        self.__gtfs_classes = gtfs_classes
+        self.__partitions = partitions
+        self.__logger = logging.getLogger(__name__)
+
+    def __execute(self, sql: str, params: dict = None):
+        return self.__sa_gtfs_session.execute(sqlalchemy.text(sql), params or dict())
+
+    def __index_method(self, schema: str, name: str) -> str:
+        """Return the access method of the index (gist, brin, ...), None when not exists"""
+        return self.__execute(
+            "SELECT am.amname FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "JOIN pg_am am ON am.oid = c.relam WHERE n.nspname = :schema AND c.relname = :name",
+            {'schema': schema, 'name': name}).scalar()
+
+    def build_indexes(self, gtfs_cls):
+        """Create the spatial indexes of gtfs_cls, an index of another method (older versions: GiST) is rebuilt"""
+        schema = gtfs_cls.__table__.schema
+        for name, using, column in spatial_indexes(gtfs_cls):
+            method = self.__index_method(schema, name)
+            if method == using:
+                continue
+            if method is not None:
+                self.__logger.info(f'rebuild {schema}.{name} using {using} (was {method})')
+                self.__execute(f'DROP INDEX {schema}.{name}')
+            self.__execute(f'CREATE INDEX {name} ON {gtfs_cls.__table__.fullname} USING {using} ({column})')
+            self.__sa_gtfs_session.commit()
+
+    def __route_geometries(self, feed_id: int) -> int:
+        """Replace the feed route geometries, return number of routes (and directions)"""
+        params = {'feed_id': feed_id}
+        self.__execute(f'DELETE FROM {RouteGeometry.__table__.fullname} WHERE feed_id = :feed_id', params)
+        return self.__execute(
+            f"INSERT INTO {RouteGeometry.__table__.fullname} "
+            f"(feed_id, route_id, direction_id, shapes, trips, geom) "
+            f"SELECT t.feed_id, t.route_id, t.direction_id, count(*), sum(t.trips), "
+            f"ST_SetSRID(ST_Multi(ST_Collect(s.shape)), 4326) "
+            f"FROM (SELECT feed_id, route_id, direction_id, shape_id, count(*) AS trips "
+            f"FROM {Trip.__table__.fullname} WHERE feed_id = :feed_id AND shape_id IS NOT NULL "
+            f"GROUP BY feed_id, route_id, direction_id, shape_id) t "
+            f"JOIN {Shape.__table__.fullname} s ON s.feed_id = t.feed_id AND s.shape_id = t.shape_id "
+            f"GROUP BY t.feed_id, t.route_id, t.direction_id", params).rowcount
+
+    def __feed_extent(self, feed_id: int):
+        """Set the feed bbox and centroid from its stops"""
+        self.__execute(
+            f"UPDATE {FeedImport.__table__.fullname} f SET bbox = e.bbox, centroid = e.centroid "
+            f"FROM (SELECT ST_SetSRID(ST_Extent(stop_loc::geometry)::geometry, 4326) AS bbox, "
+            f"ST_Centroid(ST_Collect(stop_loc::geometry)) AS centroid "
+            f"FROM {Stop.__table__.fullname} WHERE feed_id = :feed_id) e "
+            f"WHERE f.feed_id = :feed_id", {'feed_id': feed_id})
+
+    def __index_name(self, table: str, using: str, column: str) -> str:
+        """Return the name of the table index of the column using the access method, None when not exists"""
+        return self.__execute(
+            "SELECT i.relname FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+            "JOIN pg_am am ON am.oid = i.relam "
+            "JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0] "
+            "WHERE x.indrelid = to_regclass(:table) AND am.amname = :using AND a.attname = :column",
+            {'table': table, 'using': using, 'column': column}).scalar()
+
+    def __feed_tables(self, feed_id: int) -> list:
+        """Return (gtfs_cls, table) of the tables holding the feed rows: its partitions or the GTFS tables"""
+        tables = list()
+        for gtfs_cls in self.__gtfs_classes:
+            if self.__partitions is None:
+                tables.append((gtfs_cls, gtfs_cls.__table__.fullname))
+                continue
+            partition = f'{gtfs_cls.__table__.schema}.{self.__partitions.partition_name(gtfs_cls, feed_id)}'
+            if self.__execute('SELECT to_regclass(:name)', {'name': partition}).scalar() is not None:
+                tables.append((gtfs_cls, partition))
+        return tables
+
+    def build(self, feed_id: int):
+        """Run the post-load spatial stage of the loaded feed"""
+        start = time.perf_counter()
+        routes = self.__route_geometries(feed_id)
+        self.__feed_extent(feed_id)
+        self.__sa_gtfs_session.commit()
+        self.build_indexes(RouteGeometry)
+
+        tables = self.__feed_tables(feed_id)
+        if self.__partitions is not None:
+            # spatial ordering of the feed partitions, a shared table is not rewritten for one feed
+            for gtfs_cls, table in tables:
+                for _, using, column in spatial_indexes(gtfs_cls):
+                    index = self.__index_name(table, using, column) if using == 'gist' else None
+                    if index is not None:
+                        self.__execute(f'CLUSTER {table} USING {index}')
+            self.__sa_gtfs_session.commit()
+        for _, table in tables + [(RouteGeometry, RouteGeometry.__table__.fullname)]:
+            self.__execute(f'ANALYZE {table}')
+        self.__sa_gtfs_session.commit()
+        self.__logger.info(f'feed {feed_id} spatial stage: {routes:,} route geometries '
+                           f'in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,70 @@
+import logging
+
+import sqlalchemy
+
+
+class GTFSStaging:
+    """
+    Atomic publication of a new feed version into the (not partitioned) GTFS tables.
+    A feed is loaded into unindexed staging tables, one per table, kept until the feed is published so an
+    interrupted import resumes from them. The publish replaces the feed rows of every table by the staged rows
+    (DELETE / INSERT ... SELECT) in the transaction of the caller, readers see the previous or the new version.
+    """
+
+    def __init__(self, sa_session, gtfs_classes: list):
+        """
+        :param sa_session: sqlalchemy session
+        :param gtfs_classes: GTFS models of the feed tables (tables with a feed_id column)
+        """
+        self.__sa_gtfs_session = sa_session
+        self.__gtfs_classes = gtfs_classes
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def stage_name(gtfs_cls, feed_id: int) -> str:
+        return f'{gtfs_cls.__tablename__}_s{feed_id}'
+
+    def __execute(self, sql: str, params: dict = None) -> int:
+        return self.__sa_gtfs_session.execute(sqlalchemy.text(sql), params).rowcount
+
+    def stage(self, gtfs_cls, feed_id: int) -> str:
+        """Create an empty, unindexed staging table of the feed, return its full name"""
+        stage = f'{gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}'
+        self.__execute(f'DROP TABLE IF EXISTS {stage}')
+        # ids are drawn from the sequence of the table
+        self.__execute(f'CREATE TABLE {stage} (LIKE {gtfs_cls.__table__.fullname} INCLUDING DEFAULTS)')
+        self.__sa_gtfs_session.commit()
+        return stage
+
+    def is_staged(self, gtfs_cls, feed_id: int) -> bool:
+        """Return True when the feed staging table of gtfs_cls exists"""
+        stage = f'{gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}'
+        return self.__sa_gtfs_session.execute(sqlalchemy.text('SELECT to_regclass(:name)'),
+                                              {'name': stage}).scalar() is not None
+
+    def publish(self, feed_id: int, staged_classes: list):
+        """
+        Replace the feed rows by the staged rows, in the transaction of the caller (committed with the feed files
+        checkpoints). The rows of the tables not staged (files removed from the feed) are deleted
+        """
+        params = {'feed_id': feed_id}
+        for gtfs_cls in self.__gtfs_classes:
+            deleted = self.__execute(f'DELETE FROM {gtfs_cls.__table__.fullname} WHERE feed_id = :feed_id', params)
+            if gtfs_cls not in staged_classes:
+                continue
+            stage = f'{gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}'
+            columns = ', '.join(c.name for c in gtfs_cls.__table__.columns)
+            inserted = self.__execute(f'INSERT INTO {gtfs_cls.__table__.fullname} ({columns}) '
+                                      f'SELECT {columns} FROM {stage}')
+            self.__execute(f'DROP TABLE {stage}')
+            self.__logger.debug(f'{gtfs_cls.__tablename__} of feed {feed_id}: {deleted:,} rows replaced by '
+                                f'{inserted:,}')
+        self.__logger.info(f'feed {feed_id} staged rows swapped in')
+
+    def discard(self, feed_id: int) -> bool:
+        """Drop the feed staging tables, return True when there were some"""
+        staged = [gtfs_cls for gtfs_cls in self.__gtfs_classes if self.is_staged(gtfs_cls, feed_id)]
+        for gtfs_cls in staged:
+            self.__execute(f'DROP TABLE {gtfs_cls.__table__.schema}.{self.stage_name(gtfs_cls, feed_id)}')
+        self.__sa_gtfs_session.commit()
+        return bool(staged)
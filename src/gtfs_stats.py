@@ -0,0 +1,236 @@
+import datetime
+import json
+import logging
+import os
+import resource
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy import event
+
+from gtfs import FeedImport, ImportStat
+
+
+def peak_rss_kb() -> int:
+    """Return the process peak resident set size (KB)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """Reset the process peak resident set size (linux), so it is measured per feed"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+class FileStats:
+    """Timing and throughput of one GTFS file of a feed"""
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.rows = 0
+        self.bytes = 0
+        self.parse_s = 0.0
+        self.load_s = 0.0
+        self.total_s = 0.0
+        self.db_round_trips = 0
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.total_s if self.total_s else 0.0
+
+    def record(self) -> dict:
+        return dict(file_name=self.file_name, rows=self.rows, bytes=self.bytes, parse_s=self.parse_s,
+                    load_s=self.load_s, total_s=self.total_s, rows_per_s=self.rows_per_s,
+                    db_round_trips=self.db_round_trips)
+
+
+class FeedStats:
+    """
+    Timing and throughput of a feed import: download / unzip (zip directory) / validate stages, and for each file parse
+    (decompressing, reading and transforming rows, measured on the rows iterator) and load (the rest of the file
+    time, database writes)
+    """
+    PROGRESS_INTERVAL = 10
+
+    def __init__(self, feed_id: int):
+        self.feed_id = feed_id
+        self.status = None
+        self.download_s = 0.0
+        self.unzip_s = 0.0
+        self.validate_s = 0.0
+        self.total_s = 0.0
+        self.bytes = 0
+        self.peak_rss_kb = 0
+        self.db_round_trips = 0
+        self.files = list()
+        self.__current = None
+        self.__start = time.perf_counter()
+        self.__logger = logging.getLogger(__name__)
+
+    def round_trip(self, count: int = 1):
+        """Count database round trips, of the current file if any"""
+        self.db_round_trips += count
+        if self.__current is not None:
+            self.__current.db_round_trips += count
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure a feed stage (download, unzip, validate)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, f'{name}_s', getattr(self, f'{name}_s') + time.perf_counter() - start)
+
+    @contextmanager
+    def file(self, file_name: str, loader=None) -> Iterator[FileStats]:
+        """Measure a file import, the load time is the file time not spent in parse"""
+        file_stats = FileStats(file_name)
+        self.files.append(file_stats)
+        self.__current = file_stats
+        copy_round_trips = getattr(loader, 'round_trips', 0)
+        start = time.perf_counter()
+        try:
+            yield file_stats
+        finally:
+            file_stats.total_s = time.perf_counter() - start
+            file_stats.load_s = max(0.0, file_stats.total_s - file_stats.parse_s)
+            # COPY statements run on the raw dbapi cursor, not seen by the engine events
+            self.round_trip(getattr(loader, 'round_trips', 0) - copy_round_trips)
+            self.__current = None
+
+    def timed(self, items: Iterator) -> Iterator:
+        """Yield items (row batches / DataFrames), time spent producing them is parse time of the current file"""
+        file_stats = self.__current
+        rows = 0
+        start = last_report = time.perf_counter()
+        items = iter(items)
+        while True:
+            t = time.perf_counter()
+            item = next(items, None)
+            if item is None:
+                break
+            now = time.perf_counter()
+            file_stats.parse_s += now - t
+            rows += len(item)
+            if now - last_report >= self.PROGRESS_INTERVAL:
+                last_report = now
+                self.__logger.info(f"{file_stats.file_name}: {rows:,} rows ({rows / (now - start):,.0f} rows/s)")
+            yield item
+
+    def finish(self, status: int):
+        self.status = status
+        self.total_s = time.perf_counter() - self.__start
+        self.peak_rss_kb = peak_rss_kb()
+
+    def record(self) -> dict:
+        rows = sum(f.rows for f in self.files)
+        return dict(feed_id=self.feed_id, status=self.status, download_s=self.download_s, unzip_s=self.unzip_s,
+                    validate_s=self.validate_s, parse_s=sum(f.parse_s for f in self.files),
+                    load_s=sum(f.load_s for f in self.files),
+                    total_s=self.total_s, rows=rows, bytes=self.bytes,
+                    rows_per_s=rows / self.total_s if self.total_s else 0.0, peak_rss_kb=self.peak_rss_kb,
+                    db_round_trips=self.db_round_trips)
+
+
+class StatsRecorder:
+    """Collect feeds stats, store them to gtfs_import_stats and export them (JSON lines / Prometheus textfile)"""
+    STATUS = {FeedImport.DONE: 'done', FeedImport.ERROR: 'error', FeedImport.UNCHANGED: 'unchanged',
+              FeedImport.RUNNING: 'interrupted'}
+
+    def __init__(self, sa_session, json_path: str = None, prometheus_path: str = None):
+        """
+        :param sa_session: sqlalchemy session
+        :param json_path: append feeds stats as JSON lines to this file
+        :param prometheus_path: write run totals as Prometheus textfile collector metrics to this file
+        """
+        self.__sa_gtfs_session = sa_session
+        self.__json_path = json_path
+        self.__prometheus_path = prometheus_path
+        self.__totals = dict()
+        self.__stats = None
+        self.__logger = logging.getLogger(__name__)
+
+    def __on_execute(self, *args):
+        if self.__stats is not None:
+            self.__stats.round_trip()
+
+    def start(self, feed_id: int) -> FeedStats:
+        """Start measuring a feed import, its statements are counted until finish"""
+        reset_peak_rss()
+        self.__stats = FeedStats(feed_id)
+        # listening only while a feed is measured, the engine is shared by the recorders of the process
+        engine = self.__sa_gtfs_session.bind
+        if not event.contains(engine, 'before_cursor_execute', self.__on_execute):
+            event.listen(engine, 'before_cursor_execute', self.__on_execute)
+        return self.__stats
+
+    def finish(self, stats: FeedStats, status: int):
+        """Store and export the feed stats"""
+        stats.finish(status)
+        self.__stats = None
+        engine = self.__sa_gtfs_session.bind
+        if event.contains(engine, 'before_cursor_execute', self.__on_execute):
+            event.remove(engine, 'before_cursor_execute', self.__on_execute)
+        if status == FeedImport.ERROR:
+            # the failed import may have left the session transaction failed, the stats are recorded after it
+            self.__sa_gtfs_session.rollback()
+        now = datetime.datetime.now()
+        feed_record = stats.record()
+        self.__sa_gtfs_session.add(ImportStat(import_dt=now, **feed_record))
+        for file_stats in stats.files:
+            self.__sa_gtfs_session.add(ImportStat(feed_id=stats.feed_id, status=status, import_dt=now,
+                                                  **file_stats.record()))
+        self.__sa_gtfs_session.commit()
+        self.__logger.info(f"feed {stats.feed_id}: {feed_record['rows']:,} rows in {stats.total_s:.1f}s "
+                           f"({feed_record['rows_per_s']:,.0f} rows/s), peak rss {stats.peak_rss_kb / 1024:,.0f}MB")
+        if self.__json_path:
+            self.__export_json(stats, now)
+        if self.__prometheus_path:
+            self.__add_totals(stats)
+            self.__export_prometheus()
+
+    def __export_json(self, stats: FeedStats, dt: datetime.datetime):
+        record = dict(stats.record(), import_dt=dt.isoformat(), files=[f.record() for f in stats.files])
+        with open(self.__json_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    def __add(self, name: str, labels: tuple, value: float):
+        self.__totals[(name, labels)] = self.__totals.get((name, labels), 0) + value
+
+    def __add_totals(self, stats: FeedStats):
+        self.__add('gtfs_import_feeds_total', (('status', self.STATUS.get(stats.status, str(stats.status))),), 1)
+        for stage in ('download', 'unzip', 'validate'):
+            self.__add('gtfs_import_seconds_total', (('stage', stage), ('file', '')), getattr(stats, f'{stage}_s'))
+        self.__add('gtfs_import_download_bytes_total', (), stats.bytes)
+        self.__add('gtfs_import_db_round_trips_total', (), stats.db_round_trips)
+        for f in stats.files:
+            self.__add('gtfs_import_rows_total', (('file', f.file_name),), f.rows)
+            self.__add('gtfs_import_bytes_total', (('file', f.file_name),), f.bytes)
+            for stage in ('parse', 'load'):
+                self.__add('gtfs_import_seconds_total', (('stage', stage), ('file', f.file_name)),
+                           getattr(f, f'{stage}_s'))
+        self.__totals[('gtfs_import_peak_rss_bytes', ())] = max(
+            self.__totals.get(('gtfs_import_peak_rss_bytes', ()), 0), stats.peak_rss_kb * 1024)
+
+    def __export_prometheus(self):
+        lines = list()
+        for (name, labels), value in sorted(self.__totals.items()):
+            label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+            lines.append(f'{name}{{{label_text}}} {value}' if labels else f'{name} {value}')
+        # atomic replace, the collector never reads a partial file
+        tmp_path = f'{self.__prometheus_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.__prometheus_path)
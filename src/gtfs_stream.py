@@ -0,0 +1,90 @@
+import csv
+import io
+import logging
+from typing import Iterator
+from zipfile import ZipFile
+
+import pandas as pd
+
+
+class _PrefixedStream(io.RawIOBase):
+    """Binary stream of bytes already read from a stream (prefix) followed by the rest of the stream"""
+
+    def __init__(self, prefix: bytes, stream):
+        self.__prefix = memoryview(prefix)
+        self.__stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b) -> int:
+        if len(self.__prefix):
+            n = min(len(b), len(self.__prefix))
+            b[:n] = self.__prefix[:n]
+            self.__prefix = self.__prefix[n:]
+            return n
+        return self.__stream.readinto(b)
+
+
+class CSVStream:
+    """
+    Stream GTFS csv members out of the feed zip in bounded batches.
+    Members are decompressed and decoded incrementally (ZipFile.open + TextIOWrapper), so peak memory is
+    set by the batch size and not by the size of the file. A member is decompressed once per read, the sample
+    used to size the batches is the head of the same stream.
+    """
+    ENCODING = 'utf-8-sig'
+    SAMPLE_SIZE = 64 * 1024
+
+    def __init__(self, input_zip: ZipFile, chunk_rows: int = 50000, max_chunk_mb: float = 64):
+        """
+        :param input_zip: feed zip file
+        :param chunk_rows: max rows in batch
+        :param max_chunk_mb: max (estimated) size of batch in MB, the memory ceiling of a batch
+        """
+        # row_filter(filename, chunk): mask of the chunk rows yielded by frames, None: all rows (eg: quarantine)
+        self.row_filter = None
+        self.__zf = input_zip
+        self.__chunk_rows = chunk_rows
+        self.__max_chunk_bytes = int(max_chunk_mb * 1024 * 1024)
+        self.__logger = logging.getLogger(__name__)
+
+    def open(self, filename: str) -> io.TextIOWrapper:
+        """Return text stream of zip member"""
+        return io.TextIOWrapper(self.__zf.open(filename), encoding=self.ENCODING, errors='replace', newline='')
+
+    def size(self, filename: str) -> int:
+        """Return uncompressed size of zip member"""
+        return self.__zf.getinfo(filename).file_size
+
+    def header(self, filename: str) -> list:
+        """Return column names of zip member, as in the file"""
+        with self.open(filename) as data:
+            return next(csv.reader(data), [])
+
+    def frames(self, filename: str, usecols: list = None, dtype=None) -> Iterator[pd.DataFrame]:
+        """
+        Yield DataFrame chunks of zip member (pd.read_csv chunksize), bounded by chunk_rows and max_chunk_mb.
+        Only empty values are nulls, text such as NA or null is kept.
+        """
+        if self.size(filename) == 0:
+            return
+        with self.__zf.open(filename) as member:
+            head = member.read(self.SAMPLE_SIZE)
+            data = io.TextIOWrapper(io.BufferedReader(_PrefixedStream(head, member)), encoding=self.ENCODING,
+                                    errors='replace', newline='')
+            for chunk in pd.read_csv(data, usecols=usecols, dtype=dtype, keep_default_na=False, na_values=[''],
+                                     chunksize=self.__frame_rows(head, usecols)):
+                mask = self.row_filter(filename, chunk) if self.row_filter is not None else None
+                yield chunk if mask is None else chunk[mask]
+
+    def __frame_rows(self, head: bytes, usecols: list = None) -> int:
+        """Return rows per DataFrame chunk, estimated from the average line length of the member head"""
+        sample = head.splitlines()[1:-1]
+        if not sample:
+            return self.__chunk_rows
+        line_bytes = sum(len(line) for line in sample) / len(sample)
+        columns = len(usecols) if usecols else sample[0].count(b',') + 1
+        # parsed object columns cost about 64 bytes per value on top of the text
+        row_bytes = line_bytes + 64 * columns
+        return max(1, min(self.__chunk_rows, int(self.__max_chunk_bytes / row_bytes)))
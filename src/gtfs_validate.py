@@ -0,0 +1,259 @@
+import json
+import logging
+
+import pandas as pd
+from sqlalchemy.types import Date, Float, Integer
+
+from gtfs_columns import TableSchema
+from gtfs_stream import CSVStream
+
+
+class ErrorInvalidFeed(Exception):
+    """Feed rejected by the validation, the message is the JSON report"""
+
+    def __init__(self, report: dict):
+        super().__init__(json.dumps(report))
+        self.report = report
+
+
+class FeedValidator:
+    """
+    Pre-flight validation of a feed zip, before any database write.
+    The members are streamed once, in references order (stops, routes, calendars and shapes before trips, trips
+    before stop_times), reading only the checked columns. The keys of the valid rows (stop_id, route_id, trip_id,
+    service_id, shape_id) are kept as hash sets (pandas Index) to check the references of the next files.
+    Checks, from the models: required columns (NOT NULL and model required_columns) present and filled, formats of
+    the typed required columns (integers in the range of their column type) and of the GTFS times, coordinates
+    ranges, references (model references).
+    A missing required column rejects the feed. Invalid rows reject the feed (reject mode) or are left out of the
+    load (quarantine mode, valid_rows), rows referencing a quarantined row are quarantined as well.
+    The positions of the quarantined rows are kept, the load filters them without checking the rows again. In
+    quarantine mode the files no other file references (stop_times, ...) are only checked while they are loaded:
+    they are decompressed once, their rows and errors are part of the final report.
+    """
+    OFF = 'off'
+    QUARANTINE = 'quarantine'
+    REJECT = 'reject'
+    MODES = (OFF, QUARANTINE, REJECT)
+    # H:MM:SS, hours may be past 24
+    TIME_PATTERN = r'^\s*\d{1,3}:[0-5]\d:[0-5]\d\s*$'
+    # invalid values kept in the report, per check
+    SAMPLE_SIZE = 5
+
+    def __init__(self, stream: CSVStream, names: list, gtfs_classes: list, mode: str = QUARANTINE,
+                 required_files: tuple = ()):
+        """
+        :param stream: feed zip stream
+        :param names: feed zip members
+        :param gtfs_classes: GTFS file models to validate
+        :param mode: quarantine or reject invalid rows
+        :param required_files: files of a valid feed, the other files are optional (an empty one is skipped)
+        """
+        self.__stream = stream
+        self.__mode = mode
+        self.__required_files = required_files
+        self.__classes = self.__references_order([c for c in gtfs_classes if c.filename in names])
+        self.__keys = dict()
+        self.__errors = dict()
+        self.__rows = dict()
+        self.__invalid = dict()
+        # filename -> positions (rows index in the member) of the invalid rows
+        self.__positions = dict()
+        # files checked while they are loaded (valid_rows)
+        self.__inline = set()
+        self.__logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def __references(gtfs_cls) -> tuple:
+        return getattr(gtfs_cls, 'references', ())
+
+    @staticmethod
+    def __references_order(gtfs_classes: list) -> list:
+        """Return gtfs_classes, each after the files it references"""
+        names = {c.filename for c in gtfs_classes}
+        ordered, done = list(), set()
+        pending = list(gtfs_classes)
+        while pending:
+            for gtfs_cls in pending:
+                referenced = {f for _, _, filenames in FeedValidator.__references(gtfs_cls) for f in filenames}
+                if not (referenced & names) - done - {gtfs_cls.filename}:
+                    break
+            pending.remove(gtfs_cls)
+            ordered.append(gtfs_cls)
+            done.add(gtfs_cls.filename)
+        return ordered
+
+    @staticmethod
+    def __required(gtfs_cls) -> list:
+        """Return the file columns that must be present and filled"""
+        required = list(getattr(gtfs_cls, 'required_columns', ()))
+        point_columns = getattr(gtfs_cls, 'point_columns', dict())
+        for column in gtfs_cls.__table__.columns:
+            if not column.nullable and not column.primary_key and column.name not in point_columns \
+                    and column.name not in required:
+                required.append(column.name)
+        return required
+
+    @staticmethod
+    def __coordinates(gtfs_cls) -> list:
+        """Return (lon, lat) file columns of the model points"""
+        return list(getattr(gtfs_cls, 'point_columns', dict()).values()) + \
+            list(getattr(gtfs_cls, 'coordinate_columns', ()))
+
+    def __key_columns(self, gtfs_cls) -> list:
+        """Return the columns of gtfs_cls referenced by the other files"""
+        return sorted({key for c in self.__classes for _, key, filenames in self.__references(c)
+                       if gtfs_cls.filename in filenames})
+
+    def __columns(self, gtfs_cls) -> list:
+        """Return the columns read by the validation"""
+        columns = self.__required(gtfs_cls) + list(getattr(gtfs_cls, 'time_columns', ()))
+        columns += [c for pair in self.__coordinates(gtfs_cls) for c in pair]
+        columns += [column for column, _, _ in self.__references(gtfs_cls)] + self.__key_columns(gtfs_cls)
+        return list(dict.fromkeys(columns))
+
+    def __format_errors(self, gtfs_cls, name: str, values: pd.Series) -> pd.Series:
+        """Return mask of the filled values of name that are not valid for its column type"""
+        # GTFS values repeat (times, dates, flags): the distinct values are checked
+        distinct = pd.Series(values.dropna().unique())
+        if name in getattr(gtfs_cls, 'time_columns', ()):
+            invalid = ~distinct.astype(str).str.match(self.TIME_PATTERN)
+        else:
+            column = gtfs_cls.__table__.columns.get(name)
+            if column is not None and isinstance(column.type, Integer):
+                # out of the column type range as well
+                invalid = TableSchema.integers(distinct, column.type).isna()
+            elif column is not None and isinstance(column.type, Float):
+                invalid = pd.to_numeric(distinct, errors='coerce').isna()
+            elif column is not None and isinstance(column.type, Date):
+                # GTFS dates are YYYYMMDD
+                invalid = pd.to_datetime(distinct.astype(str).str.strip(), format='%Y%m%d', errors='coerce').isna()
+            else:
+                return pd.Series(False, index=values.index)
+        return values.isin(distinct[invalid])
+
+    def __checks(self, gtfs_cls, chunk: pd.DataFrame):
+        """Yield (check, column, mask of the invalid rows) of a chunk (columns named as the file columns)"""
+        time_columns = getattr(gtfs_cls, 'time_columns', ())
+        required = self.__required(gtfs_cls)
+        for name in required:
+            if name in chunk:
+                yield 'required', name, chunk[name].isna()
+        for name in list(dict.fromkeys(required + list(time_columns))):
+            if name in chunk:
+                yield 'format', name, self.__format_errors(gtfs_cls, name, chunk[name])
+        for lon, lat in self.__coordinates(gtfs_cls):
+            for name, limit in ((lon, 180), (lat, 90)):
+                if name in chunk:
+                    values = pd.to_numeric(chunk[name], errors='coerce')
+                    yield 'format', name, chunk[name].notna() & values.isna()
+                    yield 'range', name, values.notna() & ~values.between(-limit, limit)
+        for name, key, filenames in self.__references(gtfs_cls):
+            keys = [self.__keys[(f, key)] for f in filenames if (f, key) in self.__keys]
+            if name in chunk and keys:
+                yield 'reference', name, chunk[name].notna() & ~chunk[name].isin(keys[0].append(keys[1:]))
+
+    def __invalid_rows(self, gtfs_cls, chunk: pd.DataFrame, report: bool = False) -> pd.Series:
+        """Return mask of the invalid rows of a chunk, the errors are added to the report"""
+        invalid = pd.Series(False, index=chunk.index)
+        for check, name, mask in self.__checks(gtfs_cls, chunk):
+            if not mask.any():
+                continue
+            invalid |= mask
+            if report:
+                error = self.__errors.setdefault((gtfs_cls.filename, check, name), {'rows': 0, 'sample': list()})
+                error['rows'] += int(mask.sum())
+                sample = error['sample']
+                for value in chunk.loc[mask, name].dropna().drop_duplicates().head(self.SAMPLE_SIZE):
+                    if len(sample) < self.SAMPLE_SIZE and str(value) not in sample:
+                        sample.append(str(value))
+        return invalid
+
+    def __validate_file(self, gtfs_cls):
+        header = [name.strip() for name in self.__stream.header(gtfs_cls.filename)]
+        if not any(header) and gtfs_cls.filename not in self.__required_files:
+            # empty optional file (no header), as if absent
+            self.__logger.warning(f'{gtfs_cls.filename} is empty, skipped')
+            return
+        missing = [name for name in self.__required(gtfs_cls) if name not in header]
+        for name in missing:
+            self.__errors[(gtfs_cls.filename, 'missing_column', name)] = {'rows': None, 'sample': list()}
+        if missing:
+            return
+        if self.__mode == self.QUARANTINE and not self.__key_columns(gtfs_cls):
+            self.__inline.add(gtfs_cls.filename)
+            self.__rows[gtfs_cls.filename] = self.__invalid[gtfs_cls.filename] = 0
+            return
+        raw = self.__stream.header(gtfs_cls.filename)
+        usecols = [column for column in raw if column.strip() in self.__columns(gtfs_cls)]
+        rows = invalid_rows = 0
+        positions = list()
+        keys = {key: list() for key in self.__key_columns(gtfs_cls)}
+        for chunk in self.__stream.frames(gtfs_cls.filename, usecols=usecols or None, dtype=str):
+            chunk = chunk.rename(columns=lambda name: name.strip())
+            invalid = self.__invalid_rows(gtfs_cls, chunk, report=True)
+            rows += len(chunk)
+            invalid_rows += int(invalid.sum())
+            if invalid.any():
+                positions.append(chunk.index[invalid])
+            for key, values in keys.items():
+                if key in chunk:
+                    values.append(pd.Index(chunk.loc[~invalid, key].dropna().unique()))
+        for key, values in keys.items():
+            self.__keys[(gtfs_cls.filename, key)] = values[0].append(values[1:]).unique() if values else pd.Index([])
+        self.__rows[gtfs_cls.filename] = rows
+        self.__invalid[gtfs_cls.filename] = invalid_rows
+        if positions:
+            self.__positions[gtfs_cls.filename] = positions[0].append(positions[1:])
+
+    def validate(self) -> dict:
+        """
+        Validate the feed files, return the report (status, rows and invalid rows per file, errors), without the
+        files checked while they are loaded (see report)
+        :raise ErrorInvalidFeed: feed rejected
+        """
+        for gtfs_cls in self.__classes:
+            self.__validate_file(gtfs_cls)
+        report = self.__report()
+        if report['status'] == 'rejected':
+            raise ErrorInvalidFeed(report)
+        return report
+
+    def report(self) -> dict:
+        """Return the report of the validation, final once the files checked while they are loaded were read"""
+        report = self.__report()
+        invalid = sum(self.__invalid.values())
+        if invalid:
+            self.__logger.warning(f"{invalid:,} invalid rows quarantined: " + ', '.join(
+                f"{name} {count:,}" for name, count in self.__invalid.items() if count))
+        return report
+
+    def __report(self) -> dict:
+        structural = any(check == 'missing_column' for _, check, _ in self.__errors)
+        invalid = sum(self.__invalid.values())
+        if structural or (invalid and self.__mode == self.REJECT):
+            status = 'rejected'
+        else:
+            status = 'quarantined' if invalid else 'valid'
+        report = {'status': status, 'mode': self.__mode,
+                  'files': {name: {'rows': rows, 'invalid_rows': self.__invalid[name]}
+                            for name, rows in self.__rows.items()},
+                  'errors': [dict(file=filename, check=check, column=name, **error)
+                             for (filename, check, name), error in self.__errors.items()]}
+        return report
+
+    def valid_rows(self, filename: str, chunk: pd.DataFrame) -> pd.Series:
+        """
+        Return mask of the valid rows of a chunk of filename read for the load (all its columns), None when all rows
+        are valid
+        """
+        if filename in self.__inline:
+            gtfs_cls = [c for c in self.__classes if c.filename == filename][0]
+            invalid = self.__invalid_rows(gtfs_cls, chunk.rename(columns=lambda name: name.strip()), report=True)
+            self.__rows[filename] += len(chunk)
+            self.__invalid[filename] += int(invalid.sum())
+            return ~invalid if invalid.any() else None
+        positions = self.__positions.get(filename)
+        if positions is None:
+            return None
+        return pd.Series(~chunk.index.isin(positions), index=chunk.index)
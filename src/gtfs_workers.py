@@ -0,0 +1,50 @@
+import logging
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from sqlalchemy.orm import Session
+
+from gtfs_import import GTFSImport
+from gtfs_profile import LoadProfile
+
+logger = logging.getLogger(__name__)
+
+
+def import_worker(db_con_str: str, limit_v: int = None, **import_kwargs) -> int:
+    """Worker process entry point, drain the feed queue with its own engine and session"""
+    load_profile = import_kwargs.get('load_profile') or LoadProfile()
+    engine = load_profile.create_engine(db_con_str, pool_size=1, max_overflow=0)
+    if import_kwargs.get('stats_prometheus'):
+        # one metrics file per worker, the textfile collector merges them
+        root, ext = os.path.splitext(import_kwargs['stats_prometheus'])
+        import_kwargs['stats_prometheus'] = f'{root}_{os.getpid()}{ext}'
+    try:
+        with Session(engine) as sa_session:
+            return GTFSImport(sa_session, **import_kwargs).import_queue(limit_v)
+    finally:
+        engine.dispose()
+
+
+def run_workers(db_con_str: str, workers: int, limit_v: int = None, **import_kwargs) -> int:
+    """
+    Import pending feeds with a pool of worker processes.
+    Feeds are claimed with SELECT ... FOR UPDATE SKIP LOCKED, so several machines can drain the same queue.
+    :param db_con_str: database connection string
+    :param workers: number of worker processes
+    :param limit_v: max feeds to import (split between the workers)
+    :param import_kwargs: GTFSImport arguments (loader, chunk_rows, ...)
+    :return: number of feeds processed
+    """
+    worker_limit = math.ceil(limit_v / workers) if limit_v else None
+    # spawn, so workers do not inherit the parent connections
+    mp_context = multiprocessing.get_context('spawn')
+    total = 0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as executor:
+        futures = [executor.submit(import_worker, db_con_str, worker_limit, **import_kwargs)
+                   for _ in range(workers)]
+        for future in as_completed(futures):
+            total += future.result()
+    logger.info(f"{workers} workers processed {total:,} feeds")
+    return total
@@ -1,12 +1,16 @@
 import click
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
-
-from gtfs_import import GTFSImport
+import importlib.util
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+# the commands import the GTFS modules (pandas, sqlalchemy, geoalchemy2, ...) when they run, not at startup:
+# names of gtfs_loaders.LOADERS, LoadProfile.EXECUTEMANY_MODES and FeedValidator.MODES, checked by the commands
+LOADERS = ('copy', 'orm')
+DEFAULT_LOADER = 'copy'
+EXECUTEMANY_MODES = ('values_only', 'values_plus_batch', 'batch')
+VALIDATION_MODES = ('off', 'quarantine', 'reject')
+
 
 @click.group()
 def cli():
@@ -17,19 +21,186 @@ def cli():
 @click.argument('db_con_str', envvar='GTFS_DB')
 def load_sources(db_con_str):
     """Load GTFS sources Urls and info to database"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from gtfs_schema import GTFSSchema
+    from gtfs_sources import GTFSSources
+
     click.echo('Load GTFS sources')
     engine = create_engine(db_con_str)
     with Session(engine) as sa_session:
-        GTFSImport(sa_session=sa_session).update_feed_sources()
+        GTFSSchema(sa_session).bootstrap()
+        GTFSSources(sa_session).update_feed_sources()
+
+
+@cli.command()
+@click.argument('db_con_str', envvar='GTFS_DB')
+@click.option('--partitioned', is_flag=True, default=False, help='GTFS tables partitioned by feed_id (new database)')
+def init_db(db_con_str, partitioned):
+    """Create or migrate the GTFS schema (tables, indexes, new columns) and store its version"""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from gtfs import import_classes
+    from gtfs_partitions import GTFSPartitions
+    from gtfs_schema import GTFSSchema
+
+    engine = create_engine(db_con_str)
+    with Session(engine) as sa_session:
+        partitions = GTFSPartitions(sa_session, import_classes()) if partitioned else None
+        GTFSSchema(sa_session, partitions).migrate()
 
 
 @cli.command()
 @click.argument('db_con_str', envvar='GTFS_DB')
 @click.option('--offset_v', default=None, help='Offset from table gtfs_feed_import')
 @click.option('--limit_v', default=None, help='Limit from table gtfs_feed_import')
-def load_data(db_con_str, offset_v, limit_v):
+@click.option('--loader', default=DEFAULT_LOADER, type=click.Choice(LOADERS),
+              help='Loader engine, copy (COPY FROM STDIN) or orm (bulk_insert_mappings fallback)')
+@click.option('--chunk_rows', default=50000, help='Max rows read from a feed file at once')
+@click.option('--max_chunk_mb', default=64.0, help='Memory ceiling (MB) of rows read from a feed file at once')
+@click.option('--workers', default=1, type=click.IntRange(min=1),
+              help='Number of worker processes claiming feeds from gtfs_feed_import')
+@click.option('--download_workers', default=4, type=click.IntRange(min=1),
+              help='Max concurrent downloads (per worker), feeds are downloaded ahead of the import')
+@click.option('--spool_dir', default=None, help='Directory of downloaded feeds, default: temp dir')
+@click.option('--cache_dir', default=None, help='Directory of the downloaded feeds cache, default: no cache')
+@click.option('--cache_size_mb', default=10240.0, help='Max size (MB) of the downloaded feeds cache')
+@click.option('--partitioned', is_flag=True, default=False,
+              help='GTFS tables partitioned by feed_id, each feed is loaded to staging tables and swapped in')
+@click.option('--incremental', is_flag=True, default=False,
+              help='Re-import of a stored feed applies only the rows changed in the files changed since')
+@click.option('--parse_workers', default=1, type=click.IntRange(min=0),
+              help='Threads parsing the next files of a feed while the current file is written, 0: no pipeline')
+@click.option('--pipeline_batches', default=4, type=click.IntRange(min=1),
+              help='Max parsed batches of a file waiting for the writer')
+@click.option('--stats_json', default=None, help='Append feeds import stats as JSON lines to this file')
+@click.option('--stats_prometheus', default=None,
+              help='Write import stats as Prometheus textfile metrics to this file (one file per worker)')
+@click.option('--stale_claim_minutes', default=60.0,
+              help='A feed claimed by a worker without a file loaded for this long is claimed again and resumed')
+@click.option('--max_resumes', default=3, type=click.IntRange(min=0),
+              help='A feed resumed this many times in a row after a stale claim is marked failed')
+@click.option('--spatial', is_flag=True, default=False,
+              help='Post-load spatial stage: route geometries, feed bbox and centroid, clustering and ANALYZE')
+@click.option('--pool_size', default=None, type=click.IntRange(min=1),
+              help='Connections kept in the pool, default: 5 (1 per worker process)')
+@click.option('--max_overflow', default=None, type=click.IntRange(min=0),
+              help='Connections opened over pool_size, default: 10 (0 per worker process)')
+@click.option('--executemany_mode', default=None, type=click.Choice(EXECUTEMANY_MODES),
+              help='psycopg2 executemany mode of the orm loader inserts, default: values_only (execute_values)')
+@click.option('--executemany_page_size', default=None, type=click.IntRange(min=1),
+              help='Rows per statement of execute_values / execute_batch, default: 1000 / 100')
+@click.option('--async_commit', is_flag=True, default=False,
+              help='SET synchronous_commit = off, commits do not wait for the WAL flush')
+@click.option('--work_mem', default=None, help='postgres work_mem of the load sessions, eg: 256MB')
+@click.option('--maintenance_work_mem', default=None,
+              help='postgres maintenance_work_mem of the load sessions (index builds), eg: 1GB')
+@click.option('--parquet_dir', default=None,
+              help='Write the parsed tables of each feed as Parquet (partitioned by feed_id) to this directory')
+@click.option('--from_parquet', is_flag=True, default=False,
+              help='Reload the feeds stored in --parquet_dir instead of downloading and parsing them')
+@click.option('--validation', default='quarantine', type=click.Choice(VALIDATION_MODES),
+              help='Validation of each feed before it is loaded, quarantine: invalid rows are not loaded, '
+                   'reject: a feed with invalid rows is not loaded')
+@click.option('--defer_indexes', is_flag=True, default=False,
+              help='Drop the indexes of the GTFS tables during the load and build them once it is done (bulk load)')
+def load_data(db_con_str, offset_v, limit_v, loader, chunk_rows, max_chunk_mb, workers, download_workers, spool_dir,
+              cache_dir, cache_size_mb, partitioned, incremental, parse_workers, pipeline_batches, stats_json,
+              stats_prometheus, stale_claim_minutes, max_resumes, spatial, pool_size, max_overflow, executemany_mode,
+              executemany_page_size, async_commit, work_mem, maintenance_work_mem, parquet_dir, from_parquet,
+              validation, defer_indexes):
     """Download GTFS sources extract and load to db"""
+    from sqlalchemy.orm import Session
+    from gtfs_import import GTFSImport
+    from gtfs_profile import LoadProfile
+    from gtfs_workers import run_workers
+
+    if workers > 1 and offset_v:
+        raise click.BadParameter('offset is not supported with more than one worker', param_hint='--offset_v')
+    if from_parquet and not parquet_dir:
+        raise click.BadParameter('the directory of the feeds to reload is required', param_hint='--parquet_dir')
+    if from_parquet and workers > 1:
+        raise click.BadParameter('a reload from parquet runs in one process', param_hint='--workers')
+    if parquet_dir and importlib.util.find_spec('pyarrow') is None:
+        raise click.BadParameter('the parquet stage requires pyarrow (pip install gtfs_import[parquet])',
+                                 param_hint='--parquet_dir')
+    if defer_indexes and partitioned:
+        raise click.BadParameter('the feed partitions are indexed after their load', param_hint='--defer_indexes')
     click.echo('Download parse and store GTFS data')
-    engine = create_engine(db_con_str)
+    load_profile = LoadProfile(pool_size=pool_size, max_overflow=max_overflow, executemany_mode=executemany_mode,
+                               executemany_page_size=executemany_page_size, synchronous_commit=not async_commit,
+                               work_mem=work_mem, maintenance_work_mem=maintenance_work_mem)
+    import_kwargs = dict(loader=loader, chunk_rows=chunk_rows, max_chunk_mb=max_chunk_mb,
+                         spool_dir=spool_dir, download_workers=download_workers,
+                         cache_dir=cache_dir, cache_size_mb=cache_size_mb, partitioned=partitioned,
+                         incremental=incremental, parse_workers=parse_workers, pipeline_batches=pipeline_batches,
+                         stats_json=stats_json, stats_prometheus=stats_prometheus,
+                         stale_claim_minutes=stale_claim_minutes, max_resumes=max_resumes, spatial=spatial,
+                         load_profile=load_profile,
+                         parquet_dir=parquet_dir, validation=validation, defer_indexes=defer_indexes)
+    engine = load_profile.create_engine(db_con_str)
     with Session(engine) as sa_session:
-        GTFSImport(sa_session).import_sources(offset_v, limit_v)
+        # create the schema once, before the workers start
+        gtfs_import = GTFSImport(sa_session, **import_kwargs)
+        if defer_indexes:
+            gtfs_import.drop_indexes()
+        try:
+            if from_parquet:
+                gtfs_import.import_parquet(offset_v, limit_v)
+            elif workers == 1:
+                gtfs_import.import_sources(offset_v, limit_v)
+            else:
+                # the connections are not left open while the workers load
+                sa_session.close()
+                engine.dispose()
+                run_workers(db_con_str, workers, int(limit_v) if limit_v else None, **import_kwargs)
+        finally:
+            # built also when the load failed, the tables are not left unindexed
+            if defer_indexes:
+                gtfs_import.build_indexes()
+    engine.dispose()
+
+
+@cli.command()
+@click.option('--db_con_str', default=None, help='Benchmark database, default: file sink (no database)')
+@click.option('--work_dir', default='gtfs_bench', help='Directory of the generated feeds and the file sink')
+@click.option('--stop_times', default=100000, type=click.IntRange(min=1),
+              help='stop_times rows of the synthetic feed, the other files are scaled from it')
+@click.option('--stops_per_trip', default=20, type=click.IntRange(min=2), help='Stops of each trip')
+@click.option('--trips_per_route', default=50, type=click.IntRange(min=1), help='Trips of each route')
+@click.option('--shape_points', default=200, type=click.IntRange(min=2), help='Points of each shape')
+@click.option('--seed', default=0, help='Random seed of the synthetic feed')
+@click.option('--repeat', default=1, type=click.IntRange(min=1), help='Number of import runs')
+@click.option('--loader', default=DEFAULT_LOADER, type=click.Choice(LOADERS), help='Loader engine')
+@click.option('--chunk_rows', default=50000, help='Max rows read from a feed file at once')
+@click.option('--max_chunk_mb', default=64.0, help='Memory ceiling (MB) of rows read from a feed file at once')
+@click.option('--parse_workers', default=1, type=click.IntRange(min=0),
+              help='Threads parsing the next files of a feed while the current file is written, 0: no pipeline')
+@click.option('--output', default=None, help='Results JSON file, default: stdout')
+def bench(db_con_str, work_dir, stop_times, stops_per_trip, trips_per_route, shape_points, seed, repeat, loader,
+          chunk_rows, max_chunk_mb, parse_workers, output):
+    """Benchmark the import of a synthetic GTFS feed"""
+    from gtfs_bench import benchmark, write_results
+
+    if db_con_str is None and loader != DEFAULT_LOADER:
+        raise click.BadParameter('the file sink supports only the copy loader', param_hint='--loader')
+    results = benchmark(work_dir, db_con_str, stop_times=stop_times, stops_per_trip=stops_per_trip,
+                        trips_per_route=trips_per_route, shape_points=shape_points, seed=seed, repeat=repeat,
+                        loader=loader, chunk_rows=chunk_rows, max_chunk_mb=max_chunk_mb, parse_workers=parse_workers)
+    write_results(results, output)
+
+
+@cli.command()
+@click.option('--repeat', default=5, type=click.IntRange(min=1), help='Number of runs, the fastest is reported')
+@click.option('--max_ms', default=None, type=float, help='Fail when the CLI startup takes longer (ms)')
+@click.option('--output', default=None, help='Results JSON file, default: stdout')
+def bench_startup(repeat, max_ms, output):
+    """Benchmark the CLI startup (import time of main), fail when it imports a heavy library or exceeds max_ms"""
+    from gtfs_bench import startup_profile, write_results
+
+    results = startup_profile('main', repeat=repeat)
+    write_results(results, output)
+    if results['eager_modules']:
+        raise click.ClickException(f"main imports {', '.join(results['eager_modules'])} at startup")
+    if max_ms is not None and results['import_ms'] > max_ms:
+        raise click.ClickException(f"main import takes {results['import_ms']:.0f} ms, over {max_ms:.0f} ms")
@@ -0,0 +1,52 @@
+import os
+import time
+
+from gtfs_cache import FeedCache
+
+
+def put(cache, tmp_path, checksum, size, age_s):
+    """Put a file of size bytes in the cache, last used age_s seconds ago"""
+    spooled = tmp_path / f'{checksum}.download'
+    spooled.write_bytes(b'x' * size)
+    path = cache.put(str(spooled), checksum)
+    used = time.time() - age_s
+    os.utime(path, (used, used))
+    return path
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = FeedCache(str(tmp_path / 'cache'), max_size_mb=2500 / 1024 / 1024, in_use_s=0)
+    oldest = put(cache, tmp_path, 'aa01', 1000, 300)
+    put(cache, tmp_path, 'bb02', 1000, 200)
+    # a hit moves aa01 to the most recently used, bb02 is now the least recently used
+    assert cache.get('aa01') == oldest
+
+    put(cache, tmp_path, 'cc03', 1000, 0)
+    assert cache.get('bb02') is None
+    assert cache.get('aa01') == oldest and cache.get('cc03') is not None
+    assert (tmp_path / 'cache' / FeedCache.SIZE_FILE).read_text() == '2000'
+
+
+def test_files_in_use_not_evicted(tmp_path):
+    cache = FeedCache(str(tmp_path / 'cache'), max_size_mb=1500 / 1024 / 1024, in_use_s=60)
+    prefetched = put(cache, tmp_path, 'aa01', 1000, 10)
+    put(cache, tmp_path, 'bb02', 1000, 0)
+    assert os.path.exists(prefetched)
+    assert (tmp_path / 'cache' / FeedCache.SIZE_FILE).read_text() == '2000'
+
+    os.utime(prefetched, (time.time() - 120, time.time() - 120))
+    cache.evict()
+    assert not os.path.exists(prefetched)
+    assert (tmp_path / 'cache' / FeedCache.SIZE_FILE).read_text() == '1000'
+
+
+def test_cache_not_scanned_under_max_size(tmp_path, monkeypatch):
+    cache = FeedCache(str(tmp_path / 'cache'), max_size_mb=1)
+    put(cache, tmp_path, 'aa01', 1000, 0)
+
+    def walk(*args):
+        raise AssertionError('cache scanned')
+    monkeypatch.setattr(os, 'walk', walk)
+    put(cache, tmp_path, 'bb02', 1000, 0)
+    put(cache, tmp_path, 'bb02', 1000, 0)
+    assert (tmp_path / 'cache' / FeedCache.SIZE_FILE).read_text() == '2000'
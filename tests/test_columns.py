@@ -0,0 +1,53 @@
+import pandas as pd
+
+from gtfs import Route, Stop, StopTime
+from gtfs_columns import TableSchema
+
+
+def test_integers_out_of_range_are_null():
+    chunk = pd.DataFrame({'route_id': ['r1', 'r2', 'r3', 'r4', 'r5'],
+                          'route_type': ['3', '1e20', '99999999999', '2.6', ''],
+                          'route_sort_order': ['2147483647', '2147483648', '-2147483648', 'x', '1']})
+    frame = TableSchema(Route).transform(chunk)
+    assert frame['route_type'].tolist() == [3, pd.NA, pd.NA, 3, pd.NA]
+    assert frame['route_sort_order'].tolist() == [2147483647, pd.NA, -2147483648, pd.NA, 1]
+
+
+def test_small_integers_range():
+    chunk = pd.DataFrame({'trip_id': ['t'] * 3, 'stop_id': ['s'] * 3, 'stop_sequence': ['1', '2', '3'],
+                          'pickup_type': ['1', '32768', '-32768']})
+    frame = TableSchema(StopTime).transform(chunk)
+    assert frame['pickup_type'].tolist() == [1, pd.NA, -32768]
+
+
+def test_times_past_midnight_blank_and_invalid():
+    chunk = pd.DataFrame({'trip_id': ['t'] * 5, 'stop_id': ['s'] * 5, 'stop_sequence': ['1', '2', '3', '4', '5'],
+                          'arrival_time': ['08:00:00', ' 7:05:30', '25:10:00', '', 'noon'],
+                          'departure_time': ['08:00:00', '08:00:00', '48:00:01', '08:00:00', '']})
+    frame = TableSchema(StopTime).transform(chunk)
+    assert frame['arrival_time'].tolist() == [28800, 25530, 90600, pd.NA, pd.NA]
+    assert frame['departure_time'].tolist() == [28800, 28800, 172801, 28800, pd.NA]
+
+
+def test_strings_blank_as_null_and_truncated():
+    chunk = pd.DataFrame({'route_id': ['r1', 'r2'], 'route_short_name': ['', 'a\x00b'],
+                          'route_long_name': ['x' * 300, None]})
+    frame = TableSchema(Route).transform(chunk)
+    assert pd.isna(frame['route_short_name'][0])
+    assert frame['route_short_name'][1] == 'ab'
+    assert len(frame['route_long_name'][0]) == Route.__table__.c.route_long_name.type.length
+    assert pd.isna(frame['route_long_name'][1])
+
+
+def test_points_as_ewkt():
+    chunk = pd.DataFrame({'stop_id': ['s1', 's2', 's3', 's4'],
+                          'stop_lon': ['2.35', ' -0.5 ', '', 'east'],
+                          'stop_lat': ['48.85', '51.0', '48.85', '48.85']})
+    frame = TableSchema(Stop).transform(chunk)
+    assert frame['stop_loc'].tolist()[:2] == ['SRID=4326;POINT(2.35 48.85)', 'SRID=4326;POINT(-0.5 51.0)']
+    assert frame['stop_loc'][2:].isna().all()
+
+
+def test_points_without_coordinates_columns():
+    frame = TableSchema(Stop).transform(pd.DataFrame({'stop_id': ['s1']}))
+    assert frame['stop_loc'].isna().all()
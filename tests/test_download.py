@@ -0,0 +1,19 @@
+import os
+
+from gtfs_cache import FeedCache
+from gtfs_download import FeedDownloader
+
+
+def test_cached_version_not_downloaded(tmp_path):
+    cache = FeedCache(str(tmp_path / 'cache'))
+    spooled = tmp_path / 'feed.zip'
+    spooled.write_bytes(b'zip')
+    path = cache.put(str(spooled), 'abcdef')
+    downloader = FeedDownloader(spool_dir=str(tmp_path / 'spool'), cache=cache)
+
+    # the url is not reachable, a download would fail
+    result = downloader.download('http://127.0.0.1:9/feed.zip', checksum='abcdef')
+    assert result.path == path and result.cached and result.size == 3
+
+    FeedDownloader.remove(result)
+    assert os.path.exists(path)
@@ -0,0 +1,54 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gtfs import FeedFile, FeedImport, ImportStat
+from gtfs_import import GTFSImport
+
+
+@pytest.fixture
+def sa_session(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "main.db"}')
+
+    @event.listens_for(engine, 'connect')
+    def attach_schema(dbapi_con, connection_record):
+        dbapi_con.execute(f"ATTACH '{tmp_path / 'gtfs.db'}' AS gtfs")
+        # geometry columns of gtfs_feed_import, not used by the claims
+        for name, arguments in (('RecoverGeometryColumn', 6), ('DiscardGeometryColumn', 3), ('CheckSpatialIndex', 2)):
+            dbapi_con.create_function(name, arguments, lambda *args: 1)
+        for name in ('ST_AsEWKB', 'AsEWKB', 'GeomFromEWKT', 'ST_GeomFromEWKT'):
+            dbapi_con.create_function(name, 1, lambda value: value)
+
+    for gtfs_cls in (FeedImport, FeedFile, ImportStat):
+        gtfs_cls.__table__.create(engine)
+    with Session(engine) as sa_session:
+        yield sa_session
+
+
+def test_stale_claim_resumed_at_most_max_resumes(sa_session):
+    sa_session.add(FeedImport(feed_id=1, feed_url='http://example.org/a.zip', done=FeedImport.PENDING))
+    sa_session.commit()
+    # every RUNNING claim is stale
+    gtfs_import = GTFSImport(sa_session, create_schema=False, stale_claim_minutes=-1, max_resumes=2)
+
+    feed = gtfs_import.claim_feed()
+    assert (feed.feed_id, feed.done, feed.resumes) == (1, FeedImport.RUNNING, 0)
+    for resumes in (1, 2):
+        feed = gtfs_import.claim_feed()
+        assert (feed.feed_id, feed.resumes) == (1, resumes)
+
+    assert gtfs_import.claim_feed() is None
+    feed = sa_session.get(FeedImport, 1)
+    assert feed.done == FeedImport.ERROR
+    assert feed.error.startswith('import abandoned after 2 resumes')
+
+
+def test_pending_claim_resets_resumes(sa_session):
+    sa_session.add(FeedImport(feed_id=1, feed_url='http://example.org/a.zip', done=FeedImport.PENDING, resumes=3))
+    sa_session.commit()
+    gtfs_import = GTFSImport(sa_session, create_schema=False, max_resumes=3)
+
+    feed = gtfs_import.claim_feed()
+    assert (feed.feed_id, feed.done, feed.resumes) == (1, FeedImport.RUNNING, 0)
+    assert gtfs_import.claim_feed() is None
@@ -0,0 +1,40 @@
+import csv
+import io
+
+import pandas as pd
+
+from gtfs import Route, TripPattern
+from gtfs_loaders import CopyLoader
+
+
+def copy_rows(gtfs_cls, frame: pd.DataFrame) -> list:
+    """Return the rows of the COPY csv data of frame, as read back by a csv parser"""
+    data = ''.join(batch.data for batch in CopyLoader.prepare_frames(gtfs_cls, 7, [frame]))
+    return list(csv.reader(io.StringIO(data, newline='')))
+
+
+def test_format_array_escaped():
+    assert CopyLoader.format_array(['S1', 'a,b', 'say "hi"', 'c:\\d', '{x}']) == \
+        '{"S1","a,b","say \\"hi\\"","c:\\\\d","{x}"}'
+    assert CopyLoader.format_array([]) == '{}'
+
+
+def test_csv_quotes_separators_and_line_breaks():
+    frame = pd.DataFrame({'route_id': ['r1', 'r2', 'r3'],
+                          'route_long_name': ['a "quoted", name', 'two\r\nlines', 'cr\ronly'],
+                          'route_type': pd.array([3, None, 1], dtype='Int64')})
+    rows = copy_rows(Route, frame)
+    columns = [c.name for c in CopyLoader.copy_columns(Route)]
+    assert len(rows) == 3
+    by_name = [dict(zip(columns, row)) for row in rows]
+    assert [row['route_long_name'] for row in by_name] == ['a "quoted", name', 'two\r\nlines', 'cr\ronly']
+    assert [row['route_type'] for row in by_name] == ['3', '', '1']
+    assert {row['feed_id'] for row in by_name} == {'7'}
+
+
+def test_array_column_as_literal():
+    frame = pd.DataFrame({'pattern_id': [1, 2], 'stops': [['S1', 'S "2"'], None]})
+    rows = copy_rows(TripPattern, frame)
+    columns = [c.name for c in CopyLoader.copy_columns(TripPattern)]
+    stops = [dict(zip(columns, row))['stops'] for row in rows]
+    assert stops == ['{"S1","S \\"2\\""}', '']
@@ -0,0 +1,32 @@
+import datetime
+import importlib.util
+
+import pytest
+from click.testing import CliRunner
+
+import main
+from gtfs import FeedFile, FeedImport
+from gtfs_parquet import ParquetStore
+
+
+def test_records_partitioned_by_feed_id(tmp_path):
+    dataset = pytest.importorskip('pyarrow.dataset')
+    store = ParquetStore(str(tmp_path), [])
+    feed = FeedImport(feed_id=7, feed_url='http://example.org/feed.zip', feed_checksum='abc', done=FeedImport.DONE)
+    files = [FeedFile(feed_id=7, file_name='stops.txt', checksum='def', rows=2,
+                      import_dt=datetime.datetime(2024, 1, 1))]
+    store.write_records(feed, files)
+
+    table = dataset.dataset(str(tmp_path / FeedFile.__tablename__), partitioning='hive').to_table()
+    assert table.column_names.count('feed_id') == 1
+    assert table.column('feed_id').to_pylist() == [7]
+    record, = store.feed(7).records(FeedImport)
+    assert record['feed_id'] == 7 and record['feed_checksum'] == 'abc'
+
+
+def test_parquet_dir_requires_pyarrow(monkeypatch, tmp_path):
+    find_spec = importlib.util.find_spec
+    monkeypatch.setattr(importlib.util, 'find_spec', lambda name, *args: None if name == 'pyarrow'
+                        else find_spec(name, *args))
+    result = CliRunner().invoke(main.cli, ['load-data', 'postgresql://localhost/', '--parquet_dir', str(tmp_path)])
+    assert result.exit_code == 2 and 'requires pyarrow' in result.output
@@ -0,0 +1,35 @@
+import pandas as pd
+
+from gtfs_patterns import TripPatterns
+
+
+def build_patterns(stops_by_trip: dict) -> TripPatterns:
+    rows = [(trip_id, stop_id, seq) for trip_id, stops in stops_by_trip.items() for seq, stop_id in enumerate(stops)]
+    patterns = TripPatterns()
+    patterns.add(pd.DataFrame(rows, columns=['trip_id', 'stop_id', 'stop_sequence']))
+    patterns.build()
+    return patterns
+
+
+def test_pattern_ids_exact_with_trips_without_stop_times():
+    patterns = build_patterns({'T1': ['S1', 'S2', 'S3'], 'T2': ['S3', 'S2'], 'T3': ['S1', 'S2', 'S3']})
+    stored = pd.concat(list(patterns.frames(10)))
+    by_stops = {tuple(stops): pattern_id for pattern_id, stops in zip(stored['pattern_id'], stored['stops'])}
+
+    # a chunk mixing trips with and without stop_times
+    ids = patterns.pattern_ids(pd.Series(['T1', 'TX', 'T2', 'T3', 'TY'], index=[10, 11, 12, 13, 14]))
+
+    assert str(ids.dtype) == 'Int64'
+    assert list(ids.index) == [10, 11, 12, 13, 14]
+    assert ids[11] is pd.NA and ids[14] is pd.NA
+    assert ids[10] == by_stops[('S1', 'S2', 'S3')] == TripPatterns.pattern_id(['S1', 'S2', 'S3'])
+    assert ids[12] == by_stops[('S3', 'S2')] == TripPatterns.pattern_id(['S3', 'S2'])
+    assert ids[13] == ids[10]
+    # the trips ids are the stored ids, not rounded
+    assert set(ids.dropna()) <= set(stored['pattern_id'])
+
+
+def test_pattern_ids_without_stop_times():
+    ids = TripPatterns().pattern_ids(pd.Series(['T1', 'T2']))
+    assert str(ids.dtype) == 'Int64'
+    assert ids.isna().all()
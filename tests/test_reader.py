@@ -0,0 +1,84 @@
+import threading
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+from gtfs_reader import FeedIndex, GTFSReader
+
+
+def feed_index(feed_id: int = 1, feed_checksum: str = 'abc', stops: int = 3) -> FeedIndex:
+    # S1 and S2 on both sides of the lon 2.35 and lat 48.85 cell boundaries, about 15 m apart
+    stops = pd.DataFrame({'stop_id': ['S1', 'S2', 'S3', 'S4'][:stops], 'lon': [2.34991, 2.35009, 2.36, None][:stops],
+                          'lat': [48.84995, 48.85005, 48.85, None][:stops]})
+    routes = pd.DataFrame({'route_id': ['R1', 'R2']})
+    trips = pd.DataFrame({'trip_id': ['T1', 'T2', 'T3'], 'route_id': ['R1', 'R1', 'R2'],
+                          'pattern_id': ['10', '10', None]})
+    patterns = pd.DataFrame({'pattern_id': ['10'], 'stops': [['S1', 'S2', 'S3']]})
+    return FeedIndex(feed_id, feed_checksum, stops, routes, trips, patterns)
+
+
+def test_stops_within_across_cells():
+    feed = feed_index(stops=4)
+    stops = feed.stops_within(2.34995, 48.85, 50)
+    assert [stop_id for stop_id, _ in stops] == ['S1', 'S2']
+    assert all(distance < 50 for _, distance in stops)
+    assert [stop_id for stop_id, _ in feed.stops_within(2.34991, 48.84995, 1000)] == ['S1', 'S2', 'S3']
+    assert feed.stops_within(3, 50, 100) == []
+
+
+def test_trip_stops():
+    feed = feed_index()
+    assert feed.trip_stops('T1') == ['S1', 'S2', 'S3']
+    assert feed.trip_stops('T3') == []
+    assert feed.trip_stops('T9') is None
+    assert feed.route_trips('R1') == ['T1', 'T2']
+
+
+def reader(feeds: dict, **kwargs) -> GTFSReader:
+    """GTFSReader of the feed indexes (feed_id -> FeedIndex), without database reads"""
+    gtfs_reader = GTFSReader(Session(sqlalchemy.create_engine('sqlite://')), **kwargs)
+    gtfs_reader._GTFSReader__feed_checksum = lambda feed_id: feeds[feed_id].feed_checksum if feed_id in feeds else None
+    gtfs_reader._GTFSReader__load = lambda feed_id, feed_checksum: feeds[feed_id]
+    return gtfs_reader
+
+
+def test_least_recently_used_feed_evicted():
+    feeds = {feed_id: feed_index(feed_id) for feed_id in (1, 2, 3)}
+    gtfs_reader = reader(feeds, max_cache_mb=2.5 * feeds[1].nbytes / 1024 / 1024)
+    loads = list()
+    load = gtfs_reader._GTFSReader__load
+
+    def counted_load(feed_id, feed_checksum):
+        loads.append(feed_id)
+        return load(feed_id, feed_checksum)
+    gtfs_reader._GTFSReader__load = counted_load
+
+    for feed_id in (1, 2, 1, 3, 1, 2):
+        assert gtfs_reader.feed(feed_id) is feeds[feed_id]
+    # feed 2 evicted by feed 3, feed 3 by feed 2
+    assert loads == [1, 2, 3, 2]
+    assert gtfs_reader.feed(4) is None
+
+
+def test_feed_loaded_without_blocking_other_feeds():
+    feeds = {feed_id: feed_index(feed_id) for feed_id in (1, 2)}
+    gtfs_reader = reader(feeds)
+    loading, release = threading.Event(), threading.Event()
+    load = gtfs_reader._GTFSReader__load
+
+    def slow_load(feed_id, feed_checksum):
+        if feed_id == 1:
+            loading.set()
+            release.wait(5)
+        return load(feed_id, feed_checksum)
+    gtfs_reader._GTFSReader__load = slow_load
+
+    thread = threading.Thread(target=gtfs_reader.feed, args=(1,))
+    thread.start()
+    assert loading.wait(5)
+    # feed 1 is loading, feed 2 is not blocked
+    assert gtfs_reader.feed(2) is feeds[2]
+    release.set()
+    thread.join()
+    assert gtfs_reader.feed(1) is feeds[1]
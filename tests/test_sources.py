@@ -0,0 +1,60 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gtfs import FeedImport
+from gtfs_sources import GTFSSources
+
+
+@pytest.fixture
+def sa_session():
+    engine = sqlalchemy.create_engine('sqlite://')
+
+    @event.listens_for(engine, 'connect')
+    def attach_schema(dbapi_con, connection_record):
+        dbapi_con.execute("ATTACH ':memory:' AS gtfs")
+        # geometry columns of gtfs_feed_import, not used by the sources sync
+        for name, arguments in (('RecoverGeometryColumn', 6), ('DiscardGeometryColumn', 3), ('CheckSpatialIndex', 2)):
+            dbapi_con.create_function(name, arguments, lambda *args: 1)
+        for name in ('ST_AsEWKB', 'AsEWKB', 'GeomFromEWKT', 'ST_GeomFromEWKT'):
+            dbapi_con.create_function(name, 1, lambda value: value)
+
+    FeedImport.__table__.create(engine)
+    with Session(engine) as sa_session:
+        yield sa_session
+
+
+@pytest.mark.parametrize('url, normalized', [
+    (' HTTPS://Example.ORG/Feed.zip ', 'https://example.org/Feed.zip'),
+    ('http://example.org/feed.zip?Key=A#latest', 'http://example.org/feed.zip?Key=A'),
+    ('http://example.org/feed.zip', 'http://example.org/feed.zip'),
+])
+def test_normalize_url(url, normalized):
+    assert GTFSSources.normalize_url(url) == normalized
+
+
+def test_stored_urls_normalized_and_superseded(sa_session):
+    sa_session.add_all([
+        FeedImport(feed_id=1, feed_url='HTTP://Example.org/a.zip', done=FeedImport.DONE),
+        FeedImport(feed_id=2, feed_url='http://example.org/a.zip#v2', done=FeedImport.ERROR),
+        FeedImport(feed_id=3, feed_url='http://example.org/b.zip', done=FeedImport.DONE),
+        FeedImport(feed_id=4, feed_url=' http://EXAMPLE.org/b.zip', done=FeedImport.PENDING),
+    ])
+    sa_session.commit()
+    sources = GTFSSources(sa_session)
+    sources._GTFSSources__normalize_stored_urls()
+    sources._GTFSSources__supersede_duplicates()
+    sa_session.commit()
+
+    rows = {feed_id: (feed_url, done) for feed_id, feed_url, done in
+            sa_session.query(FeedImport.feed_id, FeedImport.feed_url, FeedImport.done)}
+    assert rows == {
+        1: ('http://example.org/a.zip', FeedImport.SUPERSEDED),
+        2: ('http://example.org/a.zip', FeedImport.ERROR),
+        3: ('http://example.org/b.zip', FeedImport.DONE),
+    }
+    # the feed_url unique index is created again, over the active rows
+    sa_session.add(FeedImport(feed_id=5, feed_url='http://example.org/b.zip', done=FeedImport.PENDING))
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        sa_session.flush()
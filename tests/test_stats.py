@@ -0,0 +1,43 @@
+import pytest
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from gtfs import FeedFile, FeedImport, ImportStat
+from gtfs_stats import StatsRecorder
+
+
+@pytest.fixture
+def sa_session():
+    engine = sqlalchemy.create_engine('sqlite://')
+
+    @event.listens_for(engine, 'connect')
+    def attach_schema(dbapi_con, connection_record):
+        dbapi_con.execute("ATTACH ':memory:' AS gtfs")
+
+    ImportStat.__table__.create(engine)
+    FeedFile.__table__.create(engine)
+    with Session(engine) as sa_session:
+        yield sa_session
+
+
+def test_round_trips_listener_not_left_on_engine(sa_session):
+    engine = sa_session.bind
+    for feed_id in range(3):
+        recorder = StatsRecorder(sa_session)
+        stats = recorder.start(feed_id)
+        sa_session.execute(sqlalchemy.text('SELECT 1'))
+        assert len(engine.dispatch.before_cursor_execute) == 1
+        recorder.finish(stats, FeedImport.DONE)
+        assert stats.db_round_trips == 1
+    assert len(engine.dispatch.before_cursor_execute) == 0
+
+
+def test_failed_import_stats_recorded(sa_session):
+    recorder = StatsRecorder(sa_session)
+    stats = recorder.start(1)
+    sa_session.add_all([FeedFile(id=1), FeedFile(id=1)])
+    with pytest.raises(sqlalchemy.exc.IntegrityError):
+        sa_session.flush()
+    recorder.finish(stats, FeedImport.ERROR)
+    assert sa_session.query(ImportStat).filter(ImportStat.feed_id == 1).count() == 1
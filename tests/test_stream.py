@@ -0,0 +1,68 @@
+import io
+import struct
+import zipfile
+
+import pytest
+
+from gtfs_import import GTFSImport
+from gtfs_stream import CSVStream
+
+
+def feed_stream(files: dict, **kwargs) -> CSVStream:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, text in files.items():
+            zf.writestr(name, text.encode('utf-8'))
+    return CSVStream(zipfile.ZipFile(data), **kwargs)
+
+
+def test_frames_bounded_by_chunk_rows():
+    stops = '\ufeffstop_id,stop_name\r\n' + ''.join(f'S{i},"Stop, {i}"\r\n' for i in range(5)) + \
+        'S5,"two\r\nlines"\r\n'
+    stream = feed_stream({'stops.txt': stops}, chunk_rows=2)
+    chunks = list(stream.frames('stops.txt', dtype=str))
+    assert [len(chunk) for chunk in chunks] == [2, 2, 2]
+    # the byte order mark is not part of the first column name
+    assert list(chunks[0].columns) == ['stop_id', 'stop_name']
+    assert chunks[0]['stop_name'].tolist() == ['Stop, 0', 'Stop, 1']
+    assert chunks[-1]['stop_name'].tolist() == ['Stop, 4', 'two\r\nlines']
+
+
+def test_empty_member_has_no_frames():
+    stream = feed_stream({'transfers.txt': ''})
+    assert list(stream.frames('transfers.txt')) == []
+
+
+def line_points(wkb_hex: str) -> list:
+    wkb = bytes.fromhex(wkb_hex)
+    byte_order, geometry_type, count = struct.unpack_from('<BII', wkb)
+    assert (byte_order, geometry_type) == (1, 2)
+    values = struct.unpack_from(f'<{2 * count}d', wkb, 9)
+    return list(zip(values[::2], values[1::2]))
+
+
+def test_shapes_wkb_ordered_by_sequence():
+    # points out of order and split across chunks, a shape of a single point
+    shapes = ('shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n'
+              'A,48.5,2.5,2\n'
+              'B,1,3,1\n'
+              'A,48,2,1\n'
+              'C,0,0,1\n'
+              'B,1.5,3.5,10\n'
+              'A,49,3,3\n')
+    stream = feed_stream({'shapes.txt': shapes}, chunk_rows=2)
+    frames = list(GTFSImport(None, create_schema=False)._GTFSImport__build_shapes(stream))
+    shapes = {shape_id: line_points(wkb) for frame in frames
+              for shape_id, wkb in zip(frame['shape_id'], frame['shape'])}
+    assert shapes == {'A': [(2.0, 48.0), (2.5, 48.5), (3.0, 49.0)], 'B': [(3.0, 1.0), (3.5, 1.5)]}
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 1000])
+def test_shapes_batches_bounded_by_chunk_rows(chunk_rows):
+    shapes = 'shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n' + \
+        ''.join(f'S{i},{j},{j},{j}\n' for i in range(3) for j in range(2))
+    stream = feed_stream({'shapes.txt': shapes})
+    gtfs_import = GTFSImport(None, create_schema=False, chunk_rows=chunk_rows)
+    frames = list(gtfs_import._GTFSImport__build_shapes(stream))
+    assert sum(len(frame) for frame in frames) == 3
+    assert max(len(frame) for frame in frames) == min(chunk_rows, 3)
@@ -0,0 +1,71 @@
+import io
+import zipfile
+
+import pytest
+
+from gtfs import Base, Route, StopTime, Trip
+from gtfs_stream import CSVStream
+from gtfs_validate import ErrorInvalidFeed, FeedValidator
+
+FILES = {
+    'agency.txt': 'agency_id,agency_name,agency_url,agency_timezone\na1,Agency,http://a,Europe/Paris\n',
+    'routes.txt': 'route_id,agency_id,route_type\nr1,a1,3\nr2,a1,99999999999\n',
+}
+
+
+def validator(files: dict, mode: str) -> tuple:
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        for name, text in files.items():
+            zf.writestr(name, text)
+    stream = CSVStream(zipfile.ZipFile(data))
+    gtfs_classes = [c for c in Base.__subclasses__() if c.filename is not None]
+    return FeedValidator(stream, list(files), gtfs_classes, mode), stream
+
+
+def rows(stream: CSVStream, filename: str, column: str) -> list:
+    return [value for chunk in stream.frames(filename, dtype=str) for value in chunk[column]]
+
+
+def test_integer_out_of_range_quarantined():
+    feed_validator, stream = validator(FILES, FeedValidator.QUARANTINE)
+    feed_validator.validate()
+    stream.row_filter = feed_validator.valid_rows
+    # routes.txt is referenced by no file here, it is checked while it is loaded
+    assert rows(stream, Route.filename, 'route_id') == ['r1']
+    report = feed_validator.report()
+    assert report['status'] == 'quarantined'
+    assert report['files']['routes.txt'] == {'rows': 2, 'invalid_rows': 1}
+    assert report['errors'][0]['check'] == 'format' and report['errors'][0]['sample'] == ['99999999999']
+
+
+def test_integer_out_of_range_rejected():
+    feed_validator, _ = validator(FILES, FeedValidator.REJECT)
+    with pytest.raises(ErrorInvalidFeed):
+        feed_validator.validate()
+
+
+def test_quarantined_rows_filtered_by_position():
+    files = dict(FILES, **{'trips.txt': 'route_id,service_id,trip_id\nr1,s,t1\nr2,s,t2\n',
+                           'stop_times.txt': 'trip_id,stop_id,stop_sequence\nt1,s1,1\nt2,s1,1\nt1,s2,x\n'})
+    feed_validator, stream = validator(files, FeedValidator.QUARANTINE)
+    report = feed_validator.validate()
+    # checked before the load: routes and the trips referencing a quarantined route
+    assert report['files']['trips.txt'] == {'rows': 2, 'invalid_rows': 1}
+    assert 'stop_times.txt' not in {name for name, f in report['files'].items() if f['rows']}
+    stream.row_filter = feed_validator.valid_rows
+    assert rows(stream, Route.filename, 'route_id') == ['r1']
+    assert rows(stream, Trip.filename, 'trip_id') == ['t1']
+    assert rows(stream, StopTime.filename, 'stop_sequence') == ['1']
+    report = feed_validator.report()
+    assert report['files']['stop_times.txt'] == {'rows': 3, 'invalid_rows': 2}
+
+
+@pytest.mark.parametrize('mode', [FeedValidator.QUARANTINE, FeedValidator.REJECT])
+def test_missing_required_column_rejected(mode):
+    files = dict(FILES, **{'trips.txt': 'route_id,service_id,trip_id\nr1,s,t1\n',
+                           'stop_times.txt': 'stop_id,stop_sequence\ns1,1\n'})
+    feed_validator, _ = validator(files, mode)
+    with pytest.raises(ErrorInvalidFeed) as error:
+        feed_validator.validate()
+    assert 'trip_id' in str(error.value)